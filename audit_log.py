@@ -0,0 +1,472 @@
+"""
+Tamper-evident local log of door events, queryable on the device while the network is down.
+
+Every event is a JSON line holding the SHA-256 of the previous one, so editing, removing or
+reordering lines breaks the chain, which `verify` detects. Lines are appended to segment files
+of a few MB. Next to every segment a time index holds the timestamp and file offset of every
+INDEX_EVERY-th line, so a time range is found with binary searches over the segments and their
+index instead of reading the whole log.
+
+Appends never wait for the disk: they are queued and a writer thread writes everything queued
+since its last round with a single write and fsync (group commit). The scan path pays for a
+hash and a lock, the fsync is shared by all events of a burst.
+
+    python audit_log.py query --since 2025-01-10T10:00 --until 2025-01-10T10:15
+    python audit_log.py export --output door_events.csv
+    python audit_log.py verify
+"""
+import argparse
+import csv
+import datetime
+import hashlib
+import heapq
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+INDEX_ENTRY = struct.Struct("!dQ")  # timestamp, byte offset of the line
+INDEX_EVERY = 64
+SEGMENT_BYTES = 4 * 1024 * 1024
+GENESIS = "0" * 64  # "previous hash" of the very first event
+
+GRANTED = "granted"
+DENIED = "denied"
+CSV_FIELDS = ["seq", "ts", "time", "event", "direction", "name", "customer_uuid", "entrance_log_uuid", "reason", "hash"]
+
+logger = logging.getLogger("audit_log")
+
+
+def default_directory():
+    return os.getenv("AUDIT_LOG_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "audit_log")
+
+
+def record_hash(record):
+    """SHA-256 of a record without its own ``hash`` field, over canonical JSON."""
+    body = {key: value for key, value in record.items() if key != "hash"}
+    return hashlib.sha256(json.dumps(body, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def _segment_name(first_seq):
+    return f"{SEGMENT_PREFIX}{first_seq:012d}{SEGMENT_SUFFIX}"
+
+
+def _index_path(segment_path):
+    return segment_path[: -len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+
+class AuditLog:
+    """
+    Append-only, hash-chained event log in `directory`. Only one process may append to a directory.
+
+    The log is opened on the first append, so creating an instance has no side effects.
+
+    Args:
+        directory (str): Directory of the segments.
+        segment_bytes (int): Size from which a new segment is started.
+        fsync (bool): Set to False to skip the fsync after every group of lines, e.g. in tests.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, fsync=True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.seq = 0
+        self.last_hash = GENESIS
+        self.last_ts = 0.0
+        self.durable_seq = 0  # last event on disk
+        self._durable_hash = GENESIS  # hash of that event, the chain continues from it after a failed write
+        self.lost = 0  # events dropped because the disk failed
+        self.commits = 0  # write + fsync rounds, each covering every line queued meanwhile
+        self._pending = []  # (record, encoded line)
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._thread = None
+        self._closing = False
+        self._segment = None
+        self._segment_size = 0
+        self._index = None
+
+    def append(self, event, **fields):
+        """
+        Queue an event, e.g. ``append("granted", name="Ana")``. Returns the record without waiting for the disk.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._open()
+            # Kept monotonic so the time index stays sorted when the wall clock is stepped back
+            self.last_ts = max(round(time.time(), 6), self.last_ts)
+            record = {"seq": None, "ts": self.last_ts, "event": event}
+            record.update((key, value) for key, value in fields.items() if value is not None)
+            self._pending.append(self._chain(record))
+            self._written.notify_all()
+        return record
+
+    def _chain(self, record):
+        """Link `record` to the last event, returns it with its encoded line. Called with the lock held."""
+        self.seq += 1
+        record["seq"] = self.seq
+        record["prev"] = self.last_hash
+        record["hash"] = self.last_hash = record_hash(record)
+        return record, (json.dumps(record, separators=(",", ":")) + "\n").encode()
+
+    def flush(self, timeout=None):
+        """Wait until every event appended so far is on disk. Returns False on timeout or if events were lost meanwhile."""
+        with self._lock:
+            target, lost = self.seq, self.lost
+            written = self._written.wait_for(lambda: self.durable_seq >= target or self.lost != lost, timeout)
+            return written and self.lost == lost
+
+    def close(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._closing = True
+            self._written.notify_all()
+        self._thread.join()
+        self._thread = None
+        self._closing = False
+
+    def query(self, since=None, until=None):
+        """Events with ``since <= ts < until``, oldest first. Appended events count once flushed."""
+        return query(self.directory, since, until)
+
+    def verify(self):
+        return verify(self.directory)
+
+    # Writer side
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+        self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+        self._thread.start()
+
+    def _recover(self):
+        """Continue the chain of an existing log, cutting off a line torn by a crash."""
+        segments = list_segments(self.directory)
+        if not segments:
+            return
+        path = segments[-1]
+        good_bytes, last = 0, None
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                good_bytes += len(line)
+                last = record
+        if good_bytes < os.path.getsize(path):
+            logger.warning(f"Cutting a torn line off the end of {path}.")
+            os.truncate(path, good_bytes)
+        _rebuild_index(path)
+        if last is None:
+            # An empty segment continues the chain of the one before it
+            last = next(_read_backwards(segments[:-1]), None)
+        if last is not None:
+            self.seq, self.last_hash, self.last_ts = last["seq"], last["hash"], last["ts"]
+            self.durable_seq = self.seq
+            self._durable_hash = self.last_hash
+        self._open_segment(path)
+
+    def _open_segment(self, path):
+        self._close_segment()
+        segment = open(path, "ab")
+        try:
+            self._index = open(_index_path(path), "ab")
+        except OSError:
+            segment.close()
+            raise
+        self._segment = segment
+        self._segment_size = segment.tell()
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._index.close()
+            self._segment = None
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._written.wait_for(lambda: self._pending or self._closing)
+                batch, self._pending = self._pending, []
+                if not batch and self._closing:
+                    self._close_segment()
+                    return
+            try:
+                self._write(batch)
+            except OSError as e:
+                # The door must keep working with a full or failing disk, the events are lost
+                logger.error(f"Failed to write {batch[-1][0]['seq'] - self.durable_seq} audit events: {e}")
+            with self._lock:
+                lost = batch[-1][0]["seq"] - self.durable_seq
+                if lost:
+                    self.lost += lost
+                    self._rechain()
+                self.commits += 1
+                self._written.notify_all()
+
+    def _rechain(self):
+        """
+        Continue the chain from the last event on disk, so the lost ones don't look like tampering
+        to `verify`. The events queued meanwhile take over their numbers. Called with the lock held.
+        """
+        self.seq, self.last_hash = self.durable_seq, self._durable_hash
+        self._pending = [self._chain(record) for record, _ in self._pending]
+
+    def _write(self, batch):
+        lines, index_entries = [], []
+        for record, line in batch:
+            if self._segment is None or (self._segment_size and self._segment_size + len(line) > self.segment_bytes):
+                if lines:
+                    self._commit(lines, index_entries, previous)
+                lines, index_entries = [], []
+                self._open_segment(os.path.join(self.directory, _segment_name(record["seq"])))
+            if self._segment_size == 0 or record["seq"] % INDEX_EVERY == 0:
+                index_entries.append(INDEX_ENTRY.pack(record["ts"], self._segment_size))
+            lines.append(line)
+            self._segment_size += len(line)
+            previous = record
+        self._commit(lines, index_entries, previous)
+
+    def _commit(self, lines, index_entries, last):
+        """Write the `lines` up to the event `last` to the segment."""
+        data = b"".join(lines)
+        try:
+            self._segment.write(data)
+            self._segment.flush()
+            if self.fsync:
+                os.fsync(self._segment.fileno())
+        except OSError:
+            self._discard(self._segment_size - len(data))
+            raise
+        with self._lock:
+            self.durable_seq, self._durable_hash = last["seq"], last["hash"]
+        # The index is rebuilt from the segment after a crash, it needs no fsync
+        self._index.write(b"".join(index_entries))
+        self._index.flush()
+
+    def _discard(self, size):
+        """
+        Cut a failed write off the segment, back to `size` bytes. A torn line left in front of
+        later events would make `_recover` cut those off too and `query` fail on it. If the
+        segment can't be cut, the next events go to a new one.
+        """
+        segment, index = self._segment, self._index
+        self._segment = self._index = None
+        for f in (segment, index):
+            try:
+                f.close()  # the segment retries writing its buffer, it is cut off below anyway
+            except OSError:
+                pass
+        try:
+            os.truncate(segment.name, size)
+            self._open_segment(segment.name)
+        except OSError as e:
+            logger.error(f"Failed to cut the failed write off {segment.name}, continuing in a new segment: {e}")
+
+
+def list_segments(directory):
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        os.path.join(directory, name) for name in names if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+    )
+
+
+def _rebuild_index(path):
+    entries, offset = [], 0
+    with open(path, "rb") as f:
+        for line in f:
+            record = json.loads(line)
+            if offset == 0 or record["seq"] % INDEX_EVERY == 0:
+                entries.append(INDEX_ENTRY.pack(record["ts"], offset))
+            offset += len(line)
+    with open(_index_path(path), "wb") as f:
+        f.write(b"".join(entries))
+
+
+def _read_index(path):
+    try:
+        with open(_index_path(path), "rb") as f:
+            return list(INDEX_ENTRY.iter_unpack(f.read()))
+    except (FileNotFoundError, struct.error):
+        return []
+
+
+def _segment_start(path):
+    """Timestamp of the first event of a segment, None if it is empty."""
+    try:
+        with open(_index_path(path), "rb") as f:
+            entry = f.read(INDEX_ENTRY.size)
+    except FileNotFoundError:
+        entry = b""
+    if len(entry) == INDEX_ENTRY.size:
+        return INDEX_ENTRY.unpack(entry)[0]
+    with open(path, "rb") as f:
+        line = f.readline()
+    return json.loads(line)["ts"] if line.endswith(b"\n") else None
+
+
+def _read_backwards(segments):
+    """Last complete event of the newest non-empty segment."""
+    for path in reversed(segments):
+        last = None
+        for last in _read_segment(path, 0):
+            pass
+        if last is not None:
+            yield last
+            return
+
+
+def _read_segment(path, offset):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                return  # being written right now
+            yield json.loads(line)
+
+
+def query(directory, since=None, until=None):
+    """Events of the log in `directory` with ``since <= ts < until``, oldest first."""
+    segments = list_segments(directory)
+    first = 0
+    if since is not None and segments:
+        # Binary search for the last segment starting before `since`, reading one index entry per probe
+        low, high = 0, len(segments) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            start = _segment_start(segments[middle])
+            if start is not None and start < since:
+                low = middle
+            else:
+                high = middle - 1
+        first = low
+    for number, path in enumerate(segments[first:]):
+        offset = 0
+        if since is not None and number == 0:
+            entries = _read_index(path)
+            low, high = 0, len(entries)
+            while low < high:
+                middle = (low + high) // 2
+                if entries[middle][0] < since:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low:
+                offset = entries[low - 1][1]  # the last indexed line before `since`
+        for record in _read_segment(path, offset):
+            if until is not None and record["ts"] >= until:
+                return
+            if since is None or record["ts"] >= since:
+                yield record
+
+
+def verify(directory):
+    """
+    Check the hash chain of the whole log.
+
+    Returns:
+        dict: ``ok``, the number of ``records`` checked and the ``error`` with the ``seq`` it was found at.
+    """
+    previous = None
+    count = 0
+    for path in list_segments(directory):
+        for record in _read_segment(path, 0):
+            count += 1
+            error = None
+            if record.get("hash") != record_hash(record):
+                error = "content doesn't match its hash"
+            elif previous is None and record["seq"] == 1 and record["prev"] != GENESIS:
+                error = "first event doesn't start the chain"
+            elif previous is not None and record["prev"] != previous["hash"]:
+                error = "chain broken, the previous event was changed or removed"
+            elif previous is not None and record["seq"] != previous["seq"] + 1:
+                error = f"sequence jumps from {previous['seq']}"
+            if error:
+                return {"ok": False, "records": count, "seq": record.get("seq"), "error": error}
+            previous = record
+    return {"ok": True, "records": count, "seq": previous["seq"] if previous else 0, "error": None}
+
+
+def _parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()  # local time unless an offset is given
+
+
+def _directories(args):
+    if args.dir:
+        return args.dir
+    root = default_directory()
+    # qr.py keeps one log per entrance direction below the root
+    subdirectories = [os.path.join(root, name) for name in sorted(os.listdir(root))] if os.path.isdir(root) else []
+    return [path for path in subdirectories if list_segments(path)] or [root]
+
+
+def _write_records(records, output, output_format):
+    if output_format == "csv":
+        writer = csv.DictWriter(output, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+    for record in records:
+        if output_format == "json":
+            output.write(json.dumps(record) + "\n")
+            continue
+        record = dict(record, time=datetime.datetime.fromtimestamp(record["ts"]).isoformat(timespec="seconds"))
+        if output_format == "csv":
+            writer.writerow(record)
+        else:
+            who = record.get("name") or record.get("customer_uuid") or "?"
+            reason = f" ({record['reason']})" if record.get("reason") else ""
+            output.write(f"{record['time']}  {record.get('direction') or '-'}  {record['event']:<8} {who}{reason}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", action="append", help="Log directory, may be repeated. Defaults to every log below AUDIT_LOG_DIR")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("query", "export"):
+        command = commands.add_parser(name)
+        command.add_argument("--since", type=_parse_time, help="ISO time or Unix timestamp, inclusive")
+        command.add_argument("--until", type=_parse_time, help="ISO time or Unix timestamp, exclusive")
+        command.add_argument("--event", choices=[GRANTED, DENIED])
+        command.add_argument("--format", choices=["text", "json", "csv"], default="text" if name == "query" else "csv")
+        if name == "export":
+            command.add_argument("--output", required=True)
+    commands.add_parser("verify")
+    args = parser.parse_args(argv)
+
+    directories = _directories(args)
+    if args.command == "verify":
+        results = {directory: verify(directory) for directory in directories}
+        print(json.dumps(results, indent=2))
+        return 0 if all(result["ok"] for result in results.values()) else 1
+
+    # Every direction has its own log, merged by time
+    records = heapq.merge(*(query(directory, args.since, args.until) for directory in directories), key=lambda record: record["ts"])
+    if args.event:
+        records = (record for record in records if record["event"] == args.event)
+    if args.command == "export":
+        with open(args.output, "w", newline="") as f:
+            _write_records(records, f, args.format)
+    else:
+        _write_records(records, sys.stdout, args.format)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Append throughput and latency of the audit log and the cost of a range query.
+
+    python benchmarks/audit_append.py
+    python benchmarks/audit_append.py --events 20000 --threads 4 --dir /home/manager/bench
+
+Appends only queue the event, the writer thread commits everything queued with one fsync.
+"commits" shows how many fsyncs the events shared, "append_p99_us" what a scan pays.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from audit_log import AuditLog
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(directory, events, threads, fsync):
+    log = AuditLog(directory, fsync=fsync)
+    latencies = []
+
+    def append(count):
+        for i in range(count):
+            start = time.perf_counter()
+            log.append("granted", direction="A", customer_uuid=f"customer-{i}", name="Ana")
+            latencies.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=append, args=(events // threads,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    queued = time.perf_counter() - start
+    log.flush()
+    durable = time.perf_counter() - start
+
+    records = list(log.query())
+    middle = records[len(records) // 2]["ts"]
+    start = time.perf_counter()
+    found = sum(1 for _ in log.query(middle, middle + 0.001))
+    query_seconds = time.perf_counter() - start
+    log.close()
+    return {
+        "events": len(latencies),
+        "threads": threads,
+        "fsync": fsync,
+        "appends_per_second": round(len(latencies) / durable),
+        "append_p50_us": round(percentile(latencies, 0.5) * 1e6, 1),
+        "append_p99_us": round(percentile(latencies, 0.99) * 1e6, 1),
+        "queued_seconds": round(queued, 3),
+        "durable_seconds": round(durable, 3),
+        "commits": log.commits,
+        "query_ms": round(query_seconds * 1000, 3),
+        "query_matches": found,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--dir", help="Parent directory of the logs, on the disk to measure. Defaults to a temporary one")
+    parser.add_argument("--no-fsync", action="store_true")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for threads in args.threads:
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+            result = run(directory, args.events, threads, not args.no_fsync)
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Compare encode throughput and CPU usage of the video encoder backends.
+
+    python benchmarks/encoders.py --input sample.mp4
+    python benchmarks/encoders.py --frames 180 --width 640 --height 480
+
+Without --input a synthetic clip is encoded, so the script also runs on machines without a camera.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera.encoders import ENCODERS, SoftwareEncoder
+from camera.synthetic import SyntheticFrameSource
+
+sys.path.append("/usr/lib/python3/dist-packages")
+import cv2
+
+
+def load_frames(args):
+    source = cv2.VideoCapture(args.input) if args.input else SyntheticFrameSource(args.width, args.height)
+    frames = []
+    while len(frames) < args.frames:
+        ret, frame = source.read()
+        if not ret:
+            break
+        frames.append(frame)
+    source.release()
+    if not frames:
+        sys.exit(f"Could not read any frames from {args.input}")
+    return frames
+
+
+def cpu_seconds():
+    """CPU time of this process plus finished children, e.g. ffmpeg."""
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def benchmark(encoder_class, frames, fps, codec):
+    height, width = frames[0].shape[:2]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "clip.mp4")
+        options = {"codec": codec} if encoder_class is SoftwareEncoder else {}
+        start_wall, start_cpu = time.perf_counter(), cpu_seconds()
+        encoder = encoder_class(path, fps, (width, height), **options)
+        for frame in frames:
+            encoder.write(frame)
+        encoder.release()
+        wall, cpu = time.perf_counter() - start_wall, cpu_seconds() - start_cpu
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+    return {
+        "backend": encoder_class.name,
+        "frames": len(frames),
+        "seconds": round(wall, 3),
+        "encode_fps": round(len(frames) / wall, 1),
+        "cpu_percent": round(cpu / wall * 100, 1),
+        "cpu_ms_per_frame": round(cpu / len(frames) * 1000, 2),
+        "bytes": size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", help="recorded sample footage, synthetic frames if omitted")
+    parser.add_argument("--frames", type=int, default=180)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--codec", default="avc1", help="fourcc of the software backend")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    frames = load_frames(args)
+    results = []
+    for encoder_class in ENCODERS.values():
+        if not encoder_class.is_available():
+            print(f"{encoder_class.name}: not available on this machine, skipped")
+            continue
+        result = benchmark(encoder_class, frames, args.fps, args.codec)
+        results.append(result)
+        print(
+            f"{result['backend']:>10}: {result['encode_fps']:7.1f} fps, {result['cpu_percent']:6.1f}% CPU, "
+            f"{result['cpu_ms_per_frame']:6.2f} ms CPU/frame, {result['bytes']} bytes"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Compare the idle CPU cost of polling RECORDING_DIR with waiting on the directory watcher.
+
+    python benchmarks/idle_cpu.py --seconds 10 --files 200
+
+Each service's previous polling loop and its watcher-based replacement run for --seconds on a
+directory holding --files clips, while nothing happens. The CPU time of each is reported.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dir_watch import DirectoryWatcher
+
+
+async def poll_mqtt_sender(recording_dir):
+    # mqtt_sender.scan_and_send before: listdir every 30 ms
+    while True:
+        for filename in os.listdir(recording_dir):
+            if filename.endswith(".txt") and filename != "record.txt":
+                os.path.getmtime(os.path.join(recording_dir, filename))
+        await asyncio.sleep(0.03)
+
+
+async def poll_videorecorder(recording_dir):
+    # VideoCamera.find_trigger before: try to open record.txt every 200 ms
+    while True:
+        try:
+            open(os.path.join(recording_dir, "record.txt")).close()
+        except FileNotFoundError:
+            pass
+        await asyncio.sleep(0.2)
+
+
+async def poll_uploader(recording_dir):
+    # VideoUploader.upload_loop before: list and stat the directory every 5 s
+    while True:
+        files = [os.path.join(recording_dir, f) for f in os.listdir(recording_dir)]
+        sorted((f for f in files if os.path.isfile(f)), key=os.path.getmtime, reverse=True)
+        await asyncio.sleep(5)
+
+
+async def watch(recording_dir, use_inotify, poll_interval):
+    watcher = DirectoryWatcher(recording_dir, poll_interval=poll_interval, use_inotify=use_inotify)
+    watcher.open()
+    try:
+        while True:
+            await watcher.wait()
+    finally:
+        watcher.close()
+
+
+async def measure(loop_factory, seconds):
+    start_cpu, start_wall = time.process_time(), time.perf_counter()
+    task = asyncio.ensure_future(loop_factory())
+    await asyncio.sleep(seconds)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    cpu, wall = time.process_time() - start_cpu, time.perf_counter() - start_wall
+    return {"cpu_seconds": round(cpu, 4), "cpu_percent": round(100 * cpu / wall, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--files", type=int, default=200, help="Clips waiting in the recording directory")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    services = [
+        ("mqtt_sender", poll_mqtt_sender, 0.03),
+        ("videorecorder", poll_videorecorder, 0.2),
+        ("uploader", poll_uploader, 5),
+    ]
+    results = []
+    with tempfile.TemporaryDirectory() as recording_dir:
+        for index in range(args.files):
+            with open(os.path.join(recording_dir, f"clip-{index:04d}.mp4"), "wb") as f:
+                f.write(b"\0" * 1024)
+        for name, poll_loop, poll_interval in services:
+            variants = [
+                ("polling loop", lambda: poll_loop(recording_dir)),
+                ("watcher inotify", lambda: watch(recording_dir, True, poll_interval)),
+                ("watcher polling fallback", lambda: watch(recording_dir, False, poll_interval)),
+            ]
+            for variant, loop_factory in variants:
+                result = {"service": name, "variant": variant, **asyncio.run(measure(loop_factory, args.seconds))}
+                results.append(result)
+                print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"seconds": args.seconds, "files": args.files, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Bytes saved per clip by the motion-adaptive recording of VideoCamera (MOTION_ADAPTIVE).
+
+    python benchmarks/motion.py --input sample.mp4
+    python benchmarks/motion.py --fps 15 --codec mp4v
+
+Each clip is PREROLL seconds before the trigger plus RECORDING_DURATION after it, encoded once
+as before and once with still tails trimmed and still segments thinned out. Without --input
+synthetic scenes with sensor noise are used: someone walking through and leaving, a scene where
+nothing moves and one with constant motion.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera.encoders import SoftwareEncoder
+from camera.motion import MotionMeter, StaticFrameHold, idle_tail_end, select_profile
+from camera.synthetic import SyntheticFrameSource
+
+sys.path.append("/usr/lib/python3/dist-packages")
+import cv2
+
+PREROLL = 2  # Seconds
+RECORDING_DURATION = 6  # Seconds, as in VideoCamera
+
+
+def load_frames(source, count):
+    frames = []
+    while len(frames) < count:
+        ret, frame = source.read()
+        if not ret:
+            break
+        frames.append(frame)
+    source.release()
+    return frames
+
+
+def scenes(args, count):
+    if args.input:
+        return {os.path.basename(args.input): load_frames(cv2.VideoCapture(args.input), count)}
+    walk_frames = int((PREROLL + 2) * args.fps)  # the person is gone 2 s after the scan
+    return {
+        "walk-through": load_frames(
+            SyntheticFrameSource(args.width, args.height, moving=lambda i: i < walk_frames, noise=args.noise), count
+        ),
+        "static": load_frames(SyntheticFrameSource(args.width, args.height, moving=lambda i: False, noise=args.noise), count),
+        "busy": load_frames(SyntheticFrameSource(args.width, args.height, noise=args.noise), count),
+    }
+
+
+def encode(frames, fps, codec):
+    height, width = frames[0].shape[:2]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "clip.mp4")
+        encoder = SoftwareEncoder(path, fps, (width, height), codec=codec)
+        for frame in frames:
+            encoder.write(frame)
+        encoder.release()
+        return os.path.getsize(path)
+
+
+def adaptive_frames(frames, args):
+    """Replay the clip through the same motion logic FrameCapture and VideoCamera.record use."""
+    now = [0.0]
+    meter = MotionMeter(threshold=args.threshold, clock=lambda: now[0])
+    hold = StaticFrameHold(args.hold)
+    trigger_index = PREROLL * args.fps
+    trigger_time = trigger_index / args.fps
+    output, profile = [], None
+    for index, frame in enumerate(frames):
+        now[0] = index / args.fps
+        meter.measure(frame)
+        if index < trigger_index:
+            output.append(frame)  # pre-roll is written as captured
+            continue
+        if profile is None:
+            profile = select_profile(meter.level)
+        end = idle_tail_end(trigger_time, meter.last_motion_time, args.min_after_trigger, args.idle_seconds)
+        if now[0] >= min(end, trigger_time + RECORDING_DURATION):
+            break
+        output.append(hold.next(frame, meter.moving))
+    return output, profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", help="Sample footage, the trigger is assumed PREROLL seconds in")
+    parser.add_argument("--fps", type=int, default=15)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--noise", type=int, default=6, help="Sensor noise of the synthetic scenes")
+    parser.add_argument("--codec", default="mp4v")
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--hold", type=int, default=3)
+    parser.add_argument("--min-after-trigger", type=float, default=2)
+    parser.add_argument("--idle-seconds", type=float, default=1.5)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    count = (PREROLL + RECORDING_DURATION) * args.fps
+    results = []
+    for name, frames in scenes(args, count).items():
+        if not frames:
+            sys.exit(f"Could not read any frames from {name}")
+        adaptive, profile = adaptive_frames(frames, args)
+        baseline_bytes = encode(frames, args.fps, args.codec)
+        adaptive_bytes = encode(adaptive, args.fps, args.codec)
+        result = {
+            "scene": name,
+            "profile": profile,
+            "baseline_seconds": round(len(frames) / args.fps, 2),
+            "adaptive_seconds": round(len(adaptive) / args.fps, 2),
+            "baseline_bytes": baseline_bytes,
+            "adaptive_bytes": adaptive_bytes,
+            "saved_bytes": baseline_bytes - adaptive_bytes,
+            "saved_percent": round(100 * (baseline_bytes - adaptive_bytes) / baseline_bytes, 1),
+        }
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"fps": args.fps, "codec": args.codec, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+CPU cost per clip of flipping at upload time (old) versus at capture time (new).
+
+    python benchmarks/orientation.py --input sample.mp4
+    python benchmarks/orientation.py --frames 180
+
+The old uploader decoded the whole clip, flipped every frame twice and re-encoded it. Now every
+frame is flipped once with cv2.flip(frame, -1) as it is captured and the clip is uploaded as is.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera.encoders import SoftwareEncoder
+from camera.synthetic import SyntheticFrameSource
+
+sys.path.append("/usr/lib/python3/dist-packages")
+import cv2
+
+
+def write_sample_clip(path, frames, fps, codec):
+    height, width = frames[0].shape[:2]
+    encoder = SoftwareEncoder(path, fps, (width, height), codec=codec)
+    for frame in frames:
+        encoder.write(frame)
+    encoder.release()
+
+
+def flip_at_upload(path, output_path, codec):
+    """The removed VideoUploader.flip_video: decode, flip twice, re-encode."""
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    out = SoftwareEncoder(output_path, fps, size, codec=codec)
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        out.write(cv2.flip(cv2.flip(frame, 0), 1))
+    cap.release()
+    out.release()
+
+
+def flip_at_capture(frames):
+    for frame in frames:
+        cv2.flip(frame, -1)
+
+
+def cpu_seconds(function, *args):
+    start = time.process_time()
+    function(*args)
+    return time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", help="recorded sample clip, a synthetic clip is generated if omitted")
+    parser.add_argument("--frames", type=int, default=180, help="length of the synthetic clip")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--codec", default="avc1", help="fourcc used for re-encoding")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        clip_path = args.input
+        if clip_path is None:
+            source = SyntheticFrameSource(max_frames=args.frames)
+            frames = [source.read()[1] for _ in range(args.frames)]
+            clip_path = os.path.join(tmp_dir, "sample.mp4")
+            write_sample_clip(clip_path, frames, args.fps, args.codec)
+        else:
+            cap = cv2.VideoCapture(clip_path)
+            frames = []
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frames.append(frame)
+            cap.release()
+
+        upload_cpu = cpu_seconds(flip_at_upload, clip_path, os.path.join(tmp_dir, "flipped.mp4"), args.codec)
+        capture_cpu = cpu_seconds(flip_at_capture, frames)
+
+    result = {
+        "frames": len(frames),
+        "flip_at_upload_cpu_seconds": round(upload_cpu, 3),
+        "flip_at_capture_cpu_seconds": round(capture_cpu, 3),
+        "cpu_seconds_saved_per_clip": round(upload_cpu - capture_cpu, 3),
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
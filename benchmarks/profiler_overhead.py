@@ -0,0 +1,92 @@
+"""
+What a capture of the sampling profiler costs the service it profiles.
+
+    python benchmarks/profiler_overhead.py
+    python benchmarks/profiler_overhead.py --intervals 1 5 10 --threads 8 --seconds 5 --output profiler.json
+
+An event loop verifies synthetic scans as fast as it can (JSON parsing and the uuid5 hashing of
+qr.py) while --threads idle threads wait like the capture and upload threads of the services.
+Throughput is measured without the profiler and during a capture, for every sampling interval.
+"slowdown" is the throughput lost to the capture, "overhead" the share of a core the profiler
+measured for itself.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from profiler import DEFAULT_MAX_OVERHEAD, SamplingProfiler
+
+SCAN = json.dumps({"customer_uuid": str(uuid.UUID(int=7)), "timestamp": 1725628212})
+
+
+async def verify_scans(seconds):
+    """Scans verified per second, the loop yields after every scan like the reader loops do."""
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        data = json.loads(SCAN)
+        uuid.uuid5(uuid.NAMESPACE_DNS, str(data))
+        count += 1
+        await asyncio.sleep(0)
+    return count / seconds
+
+
+def throughput(seconds, profiler=None):
+    summary = {}
+    sampler = None
+    if profiler is not None:
+        sampler = threading.Thread(target=lambda: summary.update(profiler.capture(seconds)[1]), daemon=True)
+        sampler.start()
+    rate = asyncio.run(verify_scans(seconds))
+    if sampler is not None:
+        sampler.join()
+    return rate, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--intervals", type=float, nargs="+", default=[1, 5, 10], help="Sampling intervals in ms")
+    parser.add_argument("--max-overhead", type=float, default=DEFAULT_MAX_OVERHEAD)
+    parser.add_argument("--threads", type=int, default=4, help="Idle threads next to the event loop")
+    parser.add_argument("--seconds", type=float, default=3.0, help="Seconds per measurement")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    for i in range(args.threads):
+        threading.Thread(target=stop.wait, name=f"idle-{i}", daemon=True).start()
+
+    results = []
+    for interval_ms in args.intervals:
+        baseline, _ = throughput(args.seconds)
+        profiler = SamplingProfiler("benchmark", interval=interval_ms / 1000, max_overhead=args.max_overhead)
+        profiled, summary = throughput(args.seconds, profiler)
+        result = {
+            "interval_ms": interval_ms,
+            "threads": args.threads + 1,
+            "baseline_scans_per_s": round(baseline),
+            "profiled_scans_per_s": round(profiled),
+            "slowdown": round(1 - profiled / baseline, 4),
+            "overhead": summary["overhead"],
+            "max_overhead": args.max_overhead,
+            "samples": summary["samples"],
+            "mean_interval_ms": summary["mean_interval_ms"],
+            "sample_cost_ms": summary["sample_cost_ms"],
+        }
+        print(json.dumps(result))
+        results.append(result)
+    stop.set()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Decode rate and detection latency of the camera QR pipeline of scan.py.
+
+    python benchmarks/qr_decode.py
+    python benchmarks/qr_decode.py --frames recorded/ --fps 30
+    python benchmarks/qr_decode.py --frames clip.mp4 --modes baseline pipeline --output qr_decode.json
+
+Frames come from --frames, a directory of images or a video file recorded at the turnstile, or
+from a synthetic scene: a noisy static background in front of which --codes QR codes are held
+up one after another for --hold seconds, with --gap seconds of empty scene in between.
+
+Every mode runs twice. Offline, every frame goes through the decoder as fast as possible:
+"frames_per_s" is the frame rate the pipeline keeps up with on this machine. In real time, the
+frames are replayed at --fps through the capture and decode threads: "latency" runs from the
+capture of the decoded frame to the report, "detection_delay" from the first frame showing a
+code to its report (synthetic scenes only).
+
+Modes: "baseline" decodes every full color frame like scan.py did, "grayscale" converts on
+capture, "roi" adds the region of interest around the last code, "pipeline" also skips still frames.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera.motion import MotionMeter
+from camera.qr_pipeline import QrScanPipeline, prepare_frame, select_decoder
+from camera.synthetic import SyntheticFrameSource, cv2
+
+MODES = {
+    "baseline": {"grayscale": False, "roi": False, "motion": False},
+    "grayscale": {"grayscale": True, "roi": False, "motion": False},
+    "roi": {"grayscale": True, "roi": True, "motion": False},
+    "pipeline": {"grayscale": True, "roi": True, "motion": True},
+}
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def qr_image(data, size):
+    code = cv2.QRCodeEncoder.create().encode(data)
+    code = cv2.copyMakeBorder(code, 4, 4, 4, 4, cv2.BORDER_CONSTANT, value=255)  # quiet zone
+    return cv2.cvtColor(cv2.resize(code, (size, size), interpolation=cv2.INTER_NEAREST), cv2.COLOR_GRAY2BGR)
+
+
+def synthetic_frames(args):
+    """(frame, code shown in it or None), the same scene on every call."""
+    rng = np.random.default_rng(args.seed)
+    background = SyntheticFrameSource(args.width, args.height, moving=lambda index: False, noise=args.noise)
+    size = args.code_size
+    for index in range(args.codes):
+        data = json.dumps({"customer_uuid": f"00000000-0000-4000-8000-{index:012d}", "timestamp": 1725628212})
+        code = qr_image(data, size)
+        x = int(rng.integers(0, args.width - size))
+        y = int(rng.integers(0, args.height - size))
+        for _ in range(int(args.gap * args.fps)):
+            yield background.read()[1], None
+        for _ in range(int(args.hold * args.fps)):
+            # Held by hand, it never stands perfectly still
+            dx, dy = (int(value) for value in rng.integers(-args.jitter, args.jitter + 1, 2))
+            left, top = min(max(x + dx, 0), args.width - size), min(max(y + dy, 0), args.height - size)
+            frame = background.read()[1]
+            frame[top:top + size, left:left + size] = code
+            yield frame, data
+    for _ in range(int(args.gap * args.fps)):
+        yield background.read()[1], None
+
+
+def recorded_frames(path):
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.lower().endswith(IMAGE_SUFFIXES):
+                yield cv2.imread(os.path.join(path, name)), None
+        return
+    capture = cv2.VideoCapture(path)
+    try:
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                return
+            yield frame, None
+    finally:
+        capture.release()
+
+
+def frames(args):
+    return recorded_frames(args.frames) if args.frames else synthetic_frames(args)
+
+
+def pipeline_for(mode, args, read_frame, on_scan):
+    options = MODES[mode]
+    return QrScanPipeline(
+        read_frame,
+        on_scan,
+        decoder=select_decoder(args.decoder)(),
+        fps=args.fps,
+        width=args.scan_width,
+        grayscale=options["grayscale"],
+        roi_margin=0.5 if options["roi"] else None,
+        motion=MotionMeter(step=4) if options["motion"] else None,
+        repeat_after=args.hold,
+    )
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else None
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def run_offline(mode, args):
+    scans = []
+    pipeline = pipeline_for(mode, args, None, scans.append)
+    shown = set()
+    count, busy = 0, 0.0
+    for frame, data in frames(args):
+        if data is not None:
+            shown.add(data)
+        started = time.perf_counter()
+        pipeline.process(prepare_frame(frame, pipeline.width, pipeline.grayscale), time.monotonic())
+        busy += time.perf_counter() - started
+        count += 1
+    stats = pipeline.stats
+    return {
+        "frames": count,
+        "frames_per_s": round(count / busy, 1) if busy else None,
+        "decode_ms": milliseconds(pipeline.decode_seconds / stats["decoded"]) if stats["decoded"] else None,
+        "decoded_frames": stats["decoded"],
+        "still_frames": stats["still"],
+        "roi_hits": stats["roi_hits"],
+        "scans": len(scans),
+        "missed_codes": len(shown - {scan.data for scan in scans}) if not args.frames else None,
+    }
+
+
+def run_realtime(mode, args):
+    source = frames(args)
+    first_shown = {}
+    finished = threading.Event()
+
+    def read_frame():
+        try:
+            frame, data = next(source)
+        except StopIteration:
+            finished.set()
+            return None
+        if data is not None:
+            first_shown.setdefault(data, time.monotonic())
+        return frame
+
+    scans = []
+    pipeline = pipeline_for(mode, args, read_frame, scans.append)
+    pipeline.start()
+    finished.wait()
+    time.sleep(0.5)  # the last frames are still being decoded
+    pipeline.stop()
+    latencies = [scan.decoded_at - scan.captured_at for scan in scans]
+    delays = [scan.decoded_at - first_shown[scan.data] for scan in scans if scan.data in first_shown]
+    return {
+        "dropped_frames": pipeline.stats["dropped"],
+        "latency_p50_ms": milliseconds(percentile(latencies, 0.5)),
+        "latency_p90_ms": milliseconds(percentile(latencies, 0.9)),
+        "detection_delay_p50_ms": milliseconds(percentile(delays, 0.5)),
+        "detection_delay_max_ms": milliseconds(max(delays, default=None)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", help="Directory of images or a video file, a synthetic scene by default")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--decoder", choices=["auto", "zbar", "opencv"], default="auto")
+    parser.add_argument("--fps", type=int, default=15, help="Replay and capture rate")
+    parser.add_argument("--scan-width", type=int, default=400, help="Frames are shrunk to this width for decoding")
+    parser.add_argument("--width", type=int, default=640, help="Width of the synthetic frames")
+    parser.add_argument("--height", type=int, default=480, help="Height of the synthetic frames")
+    parser.add_argument("--codes", type=int, default=4, help="QR codes shown in the synthetic scene")
+    parser.add_argument("--code-size", type=int, default=300, help="Side of the codes in pixels")
+    parser.add_argument("--hold", type=float, default=1.5, help="Seconds each code is held up")
+    parser.add_argument("--gap", type=float, default=1.0, help="Seconds of empty scene between the codes")
+    parser.add_argument("--jitter", type=int, default=2, help="Pixels the hand holding a code shakes")
+    parser.add_argument("--noise", type=int, default=2, help="Sensor noise of the synthetic frames")
+    parser.add_argument("--no-realtime", action="store_true", help="Only run the offline measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes:
+        result = {"mode": mode, "decoder": select_decoder(args.decoder).name, **run_offline(mode, args)}
+        if not args.no_realtime:
+            result.update(run_realtime(mode, args))
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""
+End-to-end latency of the door path, from scanner input to the relay.
+
+    python benchmarks/scan_path.py
+    python benchmarks/scan_path.py --readers serial --arrival bursty --rate 2 --burst-size 5 --scans 100
+    python benchmarks/scan_path.py --backend-latency 0.3 --failure-rate 0.1 --output scan_path.json
+    python benchmarks/scan_path.py --replay scans.jsonl
+
+Every reader gets its own qr.TurnstileService on the simulated hardware backend: the serial one
+reads the lines of a simulated serial scanner, the HID one the key events of a simulated
+keyboard scanner. The backend is a local HTTP stub with configurable latency and failure rate.
+--cache-hit-ratio of the customers are served from the offline customer cache.
+
+Latency runs from the arrival of a scan to the relay command of a granted entry or to the
+recorded denial, both observed through the service's record_event. Heartbeat jitter is how far the
+intervals between heartbeat file writes deviate from HEARTBEAT_INTERVAL, i.e. how long the
+reader loop keeps the event loop blocked.
+
+--replay takes recorded scanner input as JSON lines ``{"at": seconds, "data": "raw line"}``.
+Timestamps inside QR codes are moved to the time of the replay so they don't expire.
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import qr
+from hardware import SimulatedBackend
+from hardware.simulated import KEYBOARD_SCANNER_PATH, KEYCODES, SERIAL_SCANNER_PATH
+
+TIMESTAMP_PATTERN = re.compile(r'("timestamp"\s*:\s*)\d+')
+
+
+def _token():
+    claims = json.dumps({"exp": int(time.time()) + 24 * 3600}).encode()
+    return "header." + base64.urlsafe_b64encode(claims).decode().rstrip("=") + ".signature"
+
+
+class BackendHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/api/token"):
+            self.reply(200, {"access": self.server.token, "refresh": "refresh"})
+            return
+        backend = self.server
+        with backend.lock:
+            delay = backend.latency + backend.random.uniform(0, backend.jitter)
+            failed = backend.random.random() < backend.failure_rate
+        time.sleep(delay)
+        if failed:
+            self.reply(500, {"detail": "backend stub failure"})
+        else:
+            self.reply(200, {"status_code": "UserExists", "first_name": "Bench"})
+
+    def do_PUT(self):
+        # Entrance logs
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.reply(200, {})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class Backend(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, jitter, failure_rate, seed):
+        super().__init__(("127.0.0.1", 0), BackendHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.token = _token()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class Scan:
+    def __init__(self, offset, data):
+        self.offset = offset
+        self.data = data
+        self.customer = None
+        self.at = None  # planned arrival, time.perf_counter()
+        self.arrived = None
+        self.done = None
+        self.outcome = None
+        self.reason = None
+
+    def line(self):
+        return TIMESTAMP_PATTERN.sub(lambda match: f"{match.group(1)}{int(time.time())}", self.data)
+
+
+def synthetic_scans(count, arrival, rate, burst_size, burst_spacing, seed):
+    """QR codes of distinct customers. Keyboard scanners can't type "_", hence "customer-uuid"."""
+    rng = random.Random(seed)
+    offsets, now = [], 0.0
+    if arrival == "steady":
+        offsets = [i / rate for i in range(count)]
+    else:
+        # Groups of people queueing at the turnstile, the groups arrive as a Poisson process
+        while len(offsets) < count:
+            offsets.extend(now + i * burst_spacing for i in range(min(burst_size, count - len(offsets))))
+            now += burst_size * burst_spacing + rng.expovariate(rate / burst_size)
+    return [
+        Scan(offset, json.dumps({"customer-uuid": str(uuid.UUID(int=rng.getrandbits(128))), "timestamp": 0}, separators=(",", ":")))
+        for offset in offsets
+    ]
+
+
+def replayed_scans(path):
+    scans = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                scans.append(Scan(float(record["at"]), record["data"]))
+    return scans
+
+
+def check_typeable(scans):
+    for scan in scans:
+        missing = set(scan.data) - set(KEYCODES)
+        if missing:
+            raise ValueError(f"A keyboard scanner can't type {sorted(missing)} of {scan.data!r}")
+
+
+def feed(scanner, scans, stop):
+    for scan in scans:
+        if stop.wait(max(scan.at - time.perf_counter(), 0)):
+            return
+        scan.arrived = time.perf_counter()
+        scanner.feed(scan.line())
+
+
+def heartbeat_mtime(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    # The service truncates the file before writing it, an empty file is half a heartbeat
+    return stat.st_mtime_ns if stat.st_size else None
+
+
+def watch_heartbeat(path, stop, writes):
+    last = heartbeat_mtime(path)  # left by an earlier run
+    while not stop.wait(0.001):
+        mtime = heartbeat_mtime(path)
+        if mtime is not None and mtime != last:
+            writes.append(time.perf_counter())
+            last = mtime
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else None
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+class ObservedService(qr.TurnstileService):
+    """Reports the outcome of every scan to `observe(event, payload, reason)` before recording it."""
+
+    def __init__(self, settings, observe, **kwargs):
+        super().__init__(settings, **kwargs)
+        self.observe = observe
+
+    def record_event(self, event, payload, name=None, reason=None):
+        self.observe(event, payload, reason)
+        super().record_event(event, payload, name=name, reason=reason)
+
+
+def customer_of(data):
+    """The customer uuid qr.py derives from a scanner line, see its reader loops."""
+    processed = qr._process_ascii_data(data, qr.AS_HEX)
+    try:
+        qr_dict = qr._load_json_data(processed)
+        return qr_dict.get("customer-uuid", qr_dict.get("customer_uuid"))
+    except (ValueError, TypeError, AttributeError, KeyError):
+        return processed
+
+
+async def run_reader(reader, scans, args, backend, hardware, customers, workdir):
+    waiting = collections.defaultdict(collections.deque)
+    for scan in scans:
+        scan.customer = customer_of(scan.data)
+        scan.arrived = scan.done = scan.outcome = scan.reason = None
+        waiting[scan.customer].append(scan)
+
+    def observe(event, payload, reason):
+        pending = waiting.get((payload or {}).get("customer_uuid"))
+        if pending:
+            scan = pending.popleft()
+            scan.done, scan.outcome, scan.reason = time.perf_counter(), event, reason
+
+    if reader == "hid":
+        check_typeable(scans)
+    settings = qr.TurnstileSettings(
+        hostname=backend.url,
+        username="bench",
+        password="bench",
+        scanner_path=SERIAL_SCANNER_PATH if reader == "serial" else KEYBOARD_SCANNER_PATH,
+        is_serial_device=reader == "serial",
+        use_lcd=not args.no_lcd,
+        heartbeat_path=os.path.join(workdir, "heartbeat.json"),
+        heartbeat_interval=args.heartbeat_interval,
+        audit_log_dir=os.path.join(workdir, "audit_log"),
+    )
+    service = ObservedService(settings, observe, hardware=hardware, customers=customers)
+    gpio = hardware.gpio()
+    relay_writes = len(gpio.trace)
+
+    stop = threading.Event()
+    heartbeat_writes = []
+    threads = [
+        threading.Thread(target=watch_heartbeat, args=(settings.heartbeat_path, stop, heartbeat_writes), daemon=True),
+        threading.Thread(target=feed, args=(hardware.scanner(settings.scanner_path), scans, stop), daemon=True),
+    ]
+    await service.start()
+    start = time.perf_counter() + args.warmup
+    for scan in scans:
+        scan.at = start + scan.offset
+    deadline = scans[-1].at + args.timeout
+    for thread in threads:
+        thread.start()
+    try:
+        while time.perf_counter() < deadline and not all(scan.done for scan in scans):
+            await asyncio.sleep(0.05)
+    finally:
+        stop.set()
+        await service.stop()
+        for thread in threads:
+            thread.join()
+
+    relay_on = sum(
+        1 for _, pin, level in list(gpio.trace)[relay_writes:] if pin == settings.relay_pin_door and level == service.relay_on
+    )
+    result = summarize(reader, scans, heartbeat_writes, relay_on, args)
+    result["lcd"] = service.lcd is not None
+    return result
+
+
+def summarize(reader, scans, heartbeat_writes, relay_on, args):
+    completed = [scan for scan in scans if scan.done]
+    latencies = [scan.done - scan.arrived for scan in completed]
+    granted = [scan.done - scan.arrived for scan in completed if scan.outcome == "granted"]
+    span = max(scan.done for scan in completed) - min(scan.arrived for scan in completed) if completed else None
+    deviations = [abs(later - earlier - args.heartbeat_interval) for earlier, later in zip(heartbeat_writes, heartbeat_writes[1:])]
+    return {
+        "reader": reader,
+        "arrival": "replay" if args.replay else args.arrival,
+        "scans": len(scans),
+        "granted": sum(1 for scan in completed if scan.outcome == "granted"),
+        "denied": sum(1 for scan in completed if scan.outcome == "denied"),
+        "lost": len(scans) - len(completed),
+        "relay_openings": relay_on,  # scans while the door is open extend the opening
+        "latency_p50_ms": milliseconds(percentile(latencies, 0.5)),
+        "latency_p90_ms": milliseconds(percentile(latencies, 0.9)),
+        "latency_p99_ms": milliseconds(percentile(latencies, 0.99)),
+        "latency_max_ms": milliseconds(max(latencies, default=None)),
+        "granted_p50_ms": milliseconds(percentile(granted, 0.5)),
+        "throughput_per_s": round(len(completed) / span, 2) if span else None,
+        "heartbeats": len(heartbeat_writes),
+        "heartbeat_jitter_p50_ms": milliseconds(percentile(deviations, 0.5)),
+        "heartbeat_jitter_p99_ms": milliseconds(percentile(deviations, 0.99)),
+        "heartbeat_jitter_max_ms": milliseconds(max(deviations, default=None)),
+        "backend_latency_ms": milliseconds(args.backend_latency),
+        "failure_rate": args.failure_rate,
+        "cache_hit_ratio": args.cache_hit_ratio,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", nargs="+", choices=["serial", "hid"], default=["serial", "hid"])
+    parser.add_argument("--scans", type=int, default=30)
+    parser.add_argument("--arrival", choices=["steady", "bursty"], default="bursty")
+    parser.add_argument("--rate", type=float, default=1.0, help="Mean scans per second")
+    parser.add_argument("--burst-size", type=int, default=4, help="Scans per burst with --arrival bursty")
+    parser.add_argument("--burst-spacing", type=float, default=0.5, help="Seconds between the scans of a burst")
+    parser.add_argument("--replay", help="JSON lines of recorded scanner input instead of synthetic scans")
+    parser.add_argument("--backend-latency", type=float, default=0.05, help="Seconds the backend takes to verify")
+    parser.add_argument("--backend-jitter", type=float, default=0.02, help="Uniformly distributed extra seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of verifications failing with 500")
+    parser.add_argument("--cache-hit-ratio", type=float, default=0.5, help="Fraction of customers in the offline cache")
+    parser.add_argument("--heartbeat-interval", type=float, default=0.5)
+    parser.add_argument("--no-lcd", action="store_true", help="Run without the simulated LCD and its display delays")
+    parser.add_argument("--hardware-trace", help="Write the timing report of the simulated devices to this file")
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds after the last arrival to wait for outcomes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.replay:
+        scans = replayed_scans(args.replay)
+    else:
+        scans = synthetic_scans(args.scans, args.arrival, args.rate, args.burst_size, args.burst_spacing, args.seed)
+    if not scans:
+        parser.error("No scans to run")
+
+    # Only errors of qr.py go to the terminal, next to the results
+    errors = logging.StreamHandler()
+    errors.setLevel(logging.ERROR)
+    logging.getLogger().addHandler(errors)
+
+    backend = Backend(args.backend_latency, args.backend_jitter, args.failure_rate, args.seed)
+    threading.Thread(target=backend.serve_forever, daemon=True).start()
+    hardware = SimulatedBackend(trace_path=args.hardware_trace)
+    rng = random.Random(args.seed)
+    cached = {
+        customer: {"first_name": "Cached", "active_membership": True, "is_staff": False}
+        for customer in sorted({customer_of(scan.data) for scan in scans})
+        if rng.random() < args.cache_hit_ratio
+    }
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for reader in args.readers:
+            result = asyncio.run(run_reader(reader, scans, args, backend, hardware, cached, workdir))
+            print(json.dumps(result))
+            results.append(result)
+    hardware.close()
+    backend.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
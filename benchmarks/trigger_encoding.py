@@ -0,0 +1,70 @@
+"""
+Encode/decode cost and size per trigger of the MQTT trigger payload formats.
+
+    python benchmarks/trigger_encoding.py
+    python benchmarks/trigger_encoding.py --batch-sizes 1 8 64 --iterations 50000
+
+"json" is the legacy ``[uuid, timestamp]`` list with one trigger per message, "binary" the
+struct-packed format of trigger_payload with up to MAX_BATCH triggers per message.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import trigger_payload
+from trigger_payload import Trigger
+
+
+def measure(function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+
+def run(payload_format, batch_size, iterations):
+    triggers = [Trigger(str(uuid.uuid4()), time.time(), "A") for _ in range(batch_size)]
+    if payload_format == trigger_payload.JSON:
+        # One message per trigger
+        payloads = [trigger_payload.encode([trigger], payload_format) for trigger in triggers]
+        encode_seconds = measure(lambda: [trigger_payload.encode([trigger], payload_format) for trigger in triggers], iterations)
+        decode_seconds = measure(lambda: [trigger_payload.decode(payload) for payload in payloads], iterations)
+    else:
+        payloads = [trigger_payload.encode(triggers, payload_format)]
+        encode_seconds = measure(lambda: trigger_payload.encode(triggers, payload_format), iterations)
+        decode_seconds = measure(lambda: trigger_payload.decode(payloads[0]), iterations)
+    return {
+        "format": payload_format,
+        "batch_size": batch_size,
+        "messages": len(payloads),
+        "bytes_per_trigger": round(sum(len(payload) for payload in payloads) / batch_size, 1),
+        "encode_us_per_trigger": round(encode_seconds / batch_size * 1e6, 3),
+        "decode_us_per_trigger": round(decode_seconds / batch_size * 1e6, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for batch_size in args.batch_sizes:
+        for payload_format in trigger_payload.FORMATS:
+            result = run(payload_format, batch_size, max(args.iterations // batch_size, 1))
+            results.append(result)
+            print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Measure how fast the uploader drains a backlog of clips against a local S3 stand-in.
+
+    python benchmarks/upload_backlog.py --clips 50 --size-mb 2 --concurrency 1 2 4
+    python benchmarks/upload_backlog.py --endpoint-url http://localhost:9000  # e.g. minio
+
+Without --endpoint-url a moto server is started in-process (pip install "moto[server]").
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera.upload_to_s3 import VideoUploader
+
+
+class Settings:
+    S3_ACCESS_KEY = "benchmark"
+    S3_SECRET_ACCESS_KEY = "benchmark"
+    GYM_UUID = "upload-backlog-benchmark"
+
+    def __init__(self, endpoint_url, recording_dir, concurrency, multipart_threshold, bandwidth_kbps):
+        self.S3_ENDPOINT_URL = endpoint_url
+        self.RECORDING_DIR = recording_dir
+        self.UPLOAD_CONCURRENCY = concurrency
+        self.MULTIPART_THRESHOLD = multipart_threshold
+        self.UPLOAD_BANDWIDTH_KBPS = bandwidth_kbps
+        self.BUSY_SIGNAL_DIR = os.path.join(recording_dir, "busy")
+
+
+def create_backlog(recording_dir, clips, size):
+    payload = os.urandom(size)
+    for index in range(clips):
+        path = os.path.join(recording_dir, f"clip-{index:04d}.mp4")
+        with open(path, "wb") as f:
+            f.write(payload)
+        os.utime(path, (index, index))
+
+
+async def drain(settings):
+    """Upload everything in the recording directory once, the way upload_loop does, and time it."""
+    uploader = VideoUploader(settings)
+    async with uploader.create_client() as s3_client:
+        start = time.perf_counter()
+        workers = [asyncio.create_task(uploader.upload_worker(s3_client)) for _ in range(uploader.concurrency)]
+        uploader.enqueue_recordings()
+        await uploader.queue.join()
+        seconds = time.perf_counter() - start
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return seconds, uploader.uploaded_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clips", type=int, default=50)
+    parser.add_argument("--size-mb", type=float, default=2)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--multipart-threshold-mb", type=float, default=8)
+    parser.add_argument("--bandwidth-kbps", type=float, default=0, help="Upload bandwidth cap, 0 for none")
+    parser.add_argument("--endpoint-url", help="S3 compatible endpoint, defaults to an in-process moto server")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    server = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        from moto.server import ThreadedMotoServer
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = ThreadedMotoServer(port=0, verbose=False)
+        server.start()
+        host, port = server.get_host_and_port()
+        endpoint_url = f"http://{host}:{port}"
+
+    size = int(args.size_mb * 1024 * 1024)
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            with tempfile.TemporaryDirectory() as recording_dir:
+                create_backlog(recording_dir, args.clips, size)
+                settings = Settings(
+                    endpoint_url, recording_dir, concurrency, int(args.multipart_threshold_mb * 1024 * 1024),
+                    args.bandwidth_kbps,
+                )
+                seconds, uploaded = asyncio.run(drain(settings))
+            results.append({
+                "concurrency": concurrency,
+                "clips": uploaded,
+                "seconds": round(seconds, 3),
+                "clips_per_second": round(uploaded / seconds, 2),
+                "mb_per_second": round(uploaded * size / seconds / 1024 / 1024, 2),
+            })
+            print(json.dumps(results[-1]))
+    finally:
+        if server is not None:
+            server.stop()
+
+    report = {
+        "endpoint_url": args.endpoint_url or "moto",
+        "clip_size_mb": args.size_mb,
+        "bandwidth_kbps": args.bandwidth_kbps,
+        # The previous uploader sent a single clip per 5 s scan of the recording directory
+        "one_clip_per_scan_seconds": args.clips * 5,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
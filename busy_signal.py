@@ -0,0 +1,68 @@
+"""
+Local signal telling background services that a scan is being verified right now.
+
+qr.py marks every verification it has in flight with a file in a tmpfs directory shared by all
+services on the device. The uploader checks for these files and holds back clip uploads so the
+verification gets the whole uplink.
+"""
+import os
+import time
+
+DEFAULT_DIRECTORY = "/dev/shm/turnstile-busy"
+# A marker this old belongs to a process that died mid-verification
+STALE_AFTER = 30  # Seconds
+
+
+def busy_directory():
+    return os.getenv("BUSY_SIGNAL_DIR") or DEFAULT_DIRECTORY
+
+
+class BusySignal:
+    """
+    Context manager marking the uplink as busy while any of the `with` blocks using it is active.
+
+    Args:
+        name (str): Marker name, unique per process, e.g. the entrance direction.
+        directory (str, optional): Directory of the markers. Defaults to `busy_directory()`.
+    """
+
+    def __init__(self, name, directory=None):
+        self.directory = directory or busy_directory()
+        self.path = os.path.join(self.directory, name)
+        self.in_flight = 0
+
+    def __enter__(self):
+        self.in_flight += 1
+        if self.in_flight == 1:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self.path, "w") as f:
+                    f.write(str(time.time()))
+            except OSError:
+                pass  # never let the signal get in the way of a scan
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+def is_busy(directory=None, stale_after=STALE_AFTER):
+    """Return True if any process has a verification in flight."""
+    directory = directory or busy_directory()
+    now = time.time()
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if now - entry.stat().st_mtime < stale_after:
+                        return True
+                except FileNotFoundError:
+                    continue  # finished while scanning
+    except FileNotFoundError:
+        pass
+    return False
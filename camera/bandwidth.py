@@ -0,0 +1,216 @@
+import asyncio
+import collections
+import io
+import threading
+import time
+
+from busy_signal import is_busy
+
+
+class TokenBucket:
+    """
+    Paces byte transfers to `rate` bytes per second.
+
+    Requests larger than the bucket are let through once it is full and leave it in debt, which
+    the following requests wait for. That keeps the average rate exact without having to split
+    requests the caller can't split, e.g. a single S3 part.
+
+    Args:
+        rate (float): Bytes per second, 0 for no limit.
+        burst (float): Bucket size in bytes. Defaults to one second worth of `rate`.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.clock = clock
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0
+        self.updated = clock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        self._refill()
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = min(self.tokens, self.burst)
+
+    def delay(self, nbytes):
+        """Seconds until `nbytes` may be sent."""
+        if not self.rate:
+            return 0
+        self._refill()
+        needed = min(nbytes, self.burst)
+        return max(needed - self.tokens, 0) / self.rate
+
+    def consume(self, nbytes):
+        self._refill()
+        if self.rate:
+            self.tokens -= nbytes
+
+    def _refill(self):
+        now = self.clock()
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+
+def parse_hours(hours):
+    """
+    Parse an hour range like ``"22-6"`` into ``(start, end)``. The range may wrap around midnight.
+
+    Returns None for an empty string.
+    """
+    if not hours:
+        return None
+    start, end = (int(hour) for hour in hours.split("-"))
+    if not (0 <= start < 24 and 0 <= end <= 24):
+        raise ValueError(f"Invalid hour range {hours!r}, expected e.g. '22-6'")
+    return start, end
+
+
+def in_hours(hour, hours):
+    start, end = hours
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+class UploadThrottle:
+    """
+    Shares the uplink between clip uploads and door verification.
+
+    Request bodies are sent through ThrottledBody, which waits for `acquire` before every chunk.
+    While qr.py has a verification in flight (see busy_signal) uploads are paused, also in the
+    middle of a request. Otherwise they are paced by a token bucket using
+    `off_peak_rate` during `off_peak_hours` and `rate` the rest of the day.
+
+    Args:
+        rate (float): Bytes per second during business hours, 0 for no limit.
+        off_peak_rate (float): Bytes per second during off-peak hours, 0 for no limit.
+        off_peak_hours (tuple[int, int]): Local ``(start, end)`` hours, see `parse_hours`. None disables off-peak.
+        busy_dir (str, optional): Directory of the busy markers, see `busy_signal.busy_directory`.
+        busy_poll_interval (float): Seconds between checks for the end of a verification.
+        window (float): Seconds over which `stats` computes the throughput.
+    """
+
+    def __init__(self, rate, off_peak_rate=0, off_peak_hours=None, busy_dir=None, busy_poll_interval=0.2, window=60):
+        self.rate = rate
+        self.off_peak_rate = off_peak_rate
+        self.off_peak_hours = off_peak_hours
+        self.busy_dir = busy_dir
+        self.busy_poll_interval = busy_poll_interval
+        self.window = window
+        self.bucket = TokenBucket(self.current_rate())
+        self.uploaded_bytes = 0
+        self.deferred_bytes = 0  # bytes waiting for the throttle right now
+        self.deferred_bytes_total = 0  # bytes that had to wait at all
+        self.paused_seconds = 0.0
+        self._transfers = collections.deque()  # (monotonic end time, bytes)
+
+    def current_rate(self):
+        if self.off_peak_hours and in_hours(time.localtime().tm_hour, self.off_peak_hours):
+            return self.off_peak_rate
+        return self.rate
+
+    async def acquire(self, nbytes):
+        """Wait until `nbytes` may be uploaded."""
+        deferred = False
+        try:
+            while True:
+                if is_busy(self.busy_dir):
+                    delay = self.busy_poll_interval
+                    self.paused_seconds += delay
+                else:
+                    rate = self.current_rate()
+                    if rate != self.bucket.rate:
+                        self.bucket.set_rate(rate)
+                    delay = self.bucket.delay(nbytes)
+                    if delay == 0:
+                        self.bucket.consume(nbytes)
+                        return
+                if not deferred:
+                    deferred = True
+                    self.deferred_bytes += nbytes
+                    self.deferred_bytes_total += nbytes
+                # Wake up at least every busy_poll_interval to notice verifications starting
+                await asyncio.sleep(min(delay, self.busy_poll_interval))
+        finally:
+            if deferred:
+                self.deferred_bytes -= nbytes
+
+    def record(self, nbytes):
+        """Count `nbytes` as uploaded."""
+        self.uploaded_bytes += nbytes
+        self._transfers.append((time.monotonic(), nbytes))
+
+    def stats(self):
+        cutoff = time.monotonic() - self.window
+        while self._transfers and self._transfers[0][0] < cutoff:
+            self._transfers.popleft()
+        return {
+            "timestamp": int(time.time()),
+            "rate_limit_bps": self.current_rate(),
+            "throughput_bps": round(sum(nbytes for _, nbytes in self._transfers) / self.window),
+            "uploaded_bytes": self.uploaded_bytes,
+            "deferred_bytes": self.deferred_bytes,
+            "deferred_bytes_total": self.deferred_bytes_total,
+            "paused_seconds": round(self.paused_seconds, 1),
+        }
+
+
+class ThrottledBody(io.RawIOBase):
+    """
+    Request body that is paced by an UploadThrottle while it is sent.
+
+    aiohttp sends file bodies in chunks read on a worker thread. Each of those reads first waits
+    for `UploadThrottle.acquire` on the event loop, so the rate limit and the pause during a
+    verification apply within a request instead of only between requests. Reads on the event
+    loop's own thread, botocore computing the checksum, go through unthrottled.
+
+    Args:
+        data (bytes): The whole body.
+        throttle (UploadThrottle): Paces the reads.
+        loop (asyncio.AbstractEventLoop): The loop the throttle runs on.
+    """
+
+    def __init__(self, data, throttle, loop):
+        super().__init__()
+        self._data = memoryview(data)
+        self._position = 0
+        self.throttle = throttle
+        self.loop = loop
+        self._loop_thread = threading.get_ident()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._data)}[whence]
+        self._position = min(max(base + offset, 0), len(self._data))
+        return self._position
+
+    def __len__(self):
+        return len(self._data)
+
+    def read(self, size=-1):
+        end = len(self._data) if size is None or size < 0 else min(self._position + size, len(self._data))
+        chunk = self._data[self._position:end]
+        if chunk and threading.get_ident() != self._loop_thread:
+            asyncio.run_coroutine_threadsafe(self._send(len(chunk)), self.loop).result()
+        self._position = end
+        return bytes(chunk)
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    async def _send(self, nbytes):
+        await self.throttle.acquire(nbytes)
+        self.throttle.record(nbytes)
@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+
+from camera.frame_buffer import compress_frame, decompress_frame
+from camera.motion import StaticFrameHold
+
+
+class FrameCapture(threading.Thread):
+    """
+    Reads frames from the camera at a fixed rate on its own thread.
+
+    While idle every frame is compressed into the pre-roll buffer. While a recording is active the
+    raw frames are handed to the encoder through a bounded queue instead; frames that don't fit
+    because the encoder is falling behind are dropped and counted.
+
+    With a `motion` meter every frame is scored on the capture thread, and while recording still
+    segments are thinned out by `static_hold`, see StaticFrameHold.
+
+    Args:
+        read_frame (callable): Returns the next frame, or ``None`` if the camera failed.
+        fps (int): Capture rate in frames per second.
+        preroll (FrameRingBuffer): Buffer receiving the frames while not recording.
+        motion (MotionMeter, optional): Scores the scene activity.
+        static_hold (int): Repeat every fresh frame of a still segment this many times. Needs `motion`.
+    """
+
+    def __init__(self, read_frame, fps, preroll, motion=None, static_hold=1):
+        super().__init__(name="frame-capture", daemon=True)
+        self.read_frame = read_frame
+        self.frame_interval = 1.0 / fps
+        self.preroll = preroll
+        self.motion = motion
+        self.hold = StaticFrameHold(static_hold) if motion is not None and static_hold > 1 else None
+        self.captured_frames = 0
+        self.dropped_frames = 0
+        self.held_frames = 0
+        self._frame_queue = None
+        self._stopped = threading.Event()
+
+    def start_recording(self, frame_queue):
+        self.captured_frames = 0
+        self.dropped_frames = 0
+        self.held_frames = 0
+        if self.hold is not None:
+            self.hold.reset()
+        self._frame_queue = frame_queue
+
+    def stop_recording(self):
+        self._frame_queue = None
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        next_frame_time = time.monotonic()
+        while not self._stopped.is_set():
+            frame = self.read_frame()
+            if frame is not None:
+                self._dispatch(frame)
+
+            next_frame_time += self.frame_interval
+            delay = next_frame_time - time.monotonic()
+            if delay > 0:
+                self._stopped.wait(delay)
+            else:
+                next_frame_time = time.monotonic()  # fell behind, don't try to catch up
+
+    def _dispatch(self, frame):
+        if self.motion is not None:
+            self.motion.measure(frame)
+        frame_queue = self._frame_queue
+        if frame_queue is None:
+            self.preroll.append(time.time(), compress_frame(frame))
+            return
+        self.captured_frames += 1
+        if self.hold is not None:
+            held = self.hold.next(frame, self.motion.moving)
+            if held is not frame:
+                self.held_frames += 1
+            frame = held
+        try:
+            frame_queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped_frames += 1
+
+
+class FrameEncoder(threading.Thread):
+    """
+    Writes the pre-roll and then the queued frames of one recording, releasing the writer at the end.
+
+    Put ``None`` on the queue to finish the recording.
+    """
+
+    def __init__(self, writer, frame_queue, preroll_frames=()):
+        super().__init__(name="frame-encoder", daemon=True)
+        self.writer = writer
+        self.frame_queue = frame_queue
+        self.preroll_frames = preroll_frames
+        self.written_frames = 0
+
+    def run(self):
+        try:
+            for _, data in self.preroll_frames:
+                self.writer.write(decompress_frame(data))
+                self.written_frames += 1
+            while True:
+                frame = self.frame_queue.get()
+                if frame is None:
+                    break
+                self.writer.write(frame)
+                self.written_frames += 1
+        finally:
+            self.writer.release()
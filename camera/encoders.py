@@ -0,0 +1,96 @@
+import functools
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+# Add the global Python library path to sys.path to use cv2 just like in the videorecorder
+sys.path.append("/usr/lib/python3/dist-packages")
+import cv2
+
+logger = logging.getLogger("VideoCamera")
+
+
+class SoftwareEncoder:
+    """Encodes on the CPU through cv2.VideoWriter. It has no bitrate control, `bitrate` is accepted and ignored."""
+
+    name = "software"
+
+    def __init__(self, path, fps, frame_size, codec="avc1", bitrate=None):
+        self.path = path
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, frame_size)
+
+    @staticmethod
+    def is_available():
+        return True
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+
+
+class V4L2M2MEncoder:
+    """
+    Encodes on the Raspberry Pi's hardware H.264 encoder by piping raw frames into ffmpeg.
+
+    Frames must be BGR and exactly `frame_size`, like the ones cv2.VideoCapture returns.
+    """
+
+    name = "v4l2m2m"
+    DEVICE = "/dev/video11"  # bcm2835-codec encode node
+
+    def __init__(self, path, fps, frame_size, bitrate="2M"):
+        self.path = path
+        width, height = frame_size
+        command = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+            "-c:v", "h264_v4l2m2m", "-b:v", bitrate, "-pix_fmt", "yuv420p",
+            "-movflags", "+faststart", path,
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def is_available():
+        if not shutil.which("ffmpeg") or not os.path.exists(V4L2M2MEncoder.DEVICE):
+            return False
+        try:
+            result = subprocess.run(
+                ["ffmpeg", "-hide_banner", "-encoders"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return b"h264_v4l2m2m" in result.stdout
+
+    def write(self, frame):
+        self.process.stdin.write(frame.tobytes())
+
+    def release(self):
+        self.process.stdin.close()
+        if self.process.wait(timeout=30) != 0:
+            logger.error(f"ffmpeg exited with code {self.process.returncode} while encoding {self.path}")
+
+
+ENCODERS = {encoder.name: encoder for encoder in (SoftwareEncoder, V4L2M2MEncoder)}
+
+
+def select_encoder(name="auto"):
+    """
+    Return the encoder class for `name`, one of "auto", "software" or "v4l2m2m".
+
+    "auto" prefers the hardware encoder. A backend that isn't available on this device falls back
+    to software encoding.
+    """
+    if name == "auto":
+        return V4L2M2MEncoder if V4L2M2MEncoder.is_available() else SoftwareEncoder
+    encoder = ENCODERS.get(name)
+    if encoder is None:
+        raise ValueError(f"Unknown video encoder {name!r}, expected one of {['auto', *ENCODERS]}")
+    if not encoder.is_available():
+        logger.warning(f"Video encoder {name} is not available, falling back to software encoding.")
+        return SoftwareEncoder
+    return encoder
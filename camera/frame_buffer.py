@@ -0,0 +1,65 @@
+import collections
+import sys
+import threading
+
+# Add the global Python library path to sys.path to use cv2 just like in the videorecorder
+sys.path.append("/usr/lib/python3/dist-packages")
+import cv2
+import numpy as np
+
+
+def compress_frame(frame, jpeg_quality=80):
+    ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    if not ok:
+        raise ValueError("Failed to JPEG-encode frame.")
+    return encoded.tobytes()
+
+
+def decompress_frame(data):
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+class FrameRingBuffer:
+    """
+    Bounded in-memory buffer of the most recent compressed frames, used as recording pre-roll.
+
+    The buffer never holds more than `max_frames` frames nor more than `max_bytes` bytes of
+    compressed data; the oldest frames are dropped first.
+    """
+
+    def __init__(self, max_frames, max_bytes):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self._frames = collections.deque()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def size(self):
+        """Bytes of compressed frame data currently buffered."""
+        return self._size
+
+    def append(self, timestamp, data):
+        with self._lock:
+            self._frames.append((timestamp, data))
+            self._size += len(data)
+            while self._frames and (len(self._frames) > self.max_frames or self._size > self.max_bytes):
+                _, dropped = self._frames.popleft()
+                self._size -= len(dropped)
+
+    def drain(self, since=None):
+        """
+        Remove all buffered frames and return the ``(timestamp, data)`` pairs, oldest first.
+
+        With `since` only the frames taken at or after that Unix time are returned.
+        """
+        with self._lock:
+            frames = list(self._frames)
+            self._frames.clear()
+            self._size = 0
+        if since is not None:
+            frames = [frame for frame in frames if frame[0] >= since]
+        return frames
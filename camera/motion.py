@@ -0,0 +1,107 @@
+import sys
+import time
+
+import numpy as np
+
+# Add the global Python library path to sys.path to use cv2 just like in the videorecorder
+sys.path.append("/usr/lib/python3/dist-packages")
+import cv2
+
+# Encoder options per scene activity, the hardware encoder takes the bitrate, see select_profile
+QUALITY_PROFILES = {
+    "static": {"bitrate": "1M"},
+    "normal": {"bitrate": "2M"},
+    "busy": {"bitrate": "3M"},
+}
+
+
+class MotionMeter:
+    """
+    Lightweight measure of scene activity for a stream of frames.
+
+    Each frame is shrunk by `step` in both directions with area averaging, which also averages out
+    sensor noise, and reduced to its green channel as a cheap stand-in for luma, grayscale frames
+    are used as they are. The score is the percentage of the resulting cells that changed by more
+    than `cell_threshold` since the previous frame. At 640x480 and the default step that is 80x60
+    cells.
+
+    Args:
+        step (int): Downscaling factor.
+        threshold (float): Percentage of changed cells from which a frame counts as moving.
+        cell_threshold (int): Change of a cell on the 0-255 scale that counts as motion.
+        smoothing (float): Weight of the newest score in `level`, an exponential moving average.
+    """
+
+    def __init__(self, step=8, threshold=0.5, cell_threshold=12, smoothing=0.1, clock=time.time):
+        self.step = step
+        self.threshold = threshold
+        self.cell_threshold = cell_threshold
+        self.smoothing = smoothing
+        self.clock = clock
+        self.score = 0.0
+        self.level = 0.0
+        self.moving = False
+        self.last_motion_time = None
+        self._previous = None
+
+    def measure(self, frame):
+        """Score `frame` against the previous one and return the score."""
+        height, width = frame.shape[:2]
+        small = cv2.resize(frame, (width // self.step, height // self.step), interpolation=cv2.INTER_AREA)
+        sample = (small if small.ndim == 2 else small[:, :, 1]).astype(np.int16)
+        if self._previous is not None and self._previous.shape == sample.shape:
+            changed = np.count_nonzero(np.abs(sample - self._previous) > self.cell_threshold)
+            self.score = 100.0 * changed / sample.size
+        self._previous = sample
+        self.level += self.smoothing * (self.score - self.level)
+        self.moving = self.score >= self.threshold
+        if self.moving:
+            self.last_motion_time = self.clock()
+        return self.score
+
+
+class StaticFrameHold:
+    """
+    Lowers the effective frame rate of still segments without changing the clip's timing.
+
+    While nothing moves only every `hold`-th frame is passed on and the frames in between repeat
+    it. Encoders store a repeated frame in a few bytes, while a fresh frame of a still scene
+    still costs bits for its sensor noise. The first moving frame is always passed on.
+    """
+
+    def __init__(self, hold):
+        self.hold = max(int(hold), 1)
+        self._held = None
+        self._count = 0
+
+    def next(self, frame, moving):
+        if moving or self._held is None or self._count >= self.hold - 1:
+            self._held = frame
+            self._count = 0
+            return frame
+        self._count += 1
+        return self._held
+
+    def reset(self):
+        self._held = None
+        self._count = 0
+
+
+def idle_tail_end(last_trigger_time, last_motion_time, min_after_trigger, idle_seconds):
+    """
+    Earliest time a clip may end: `min_after_trigger` seconds after the last trigger and
+    `idle_seconds` after the last motion, whichever is later.
+    """
+    end = last_trigger_time + min_after_trigger
+    if last_motion_time is not None:
+        end = max(end, last_motion_time + idle_seconds)
+    return end
+
+
+def select_profile(level, static_below=0.2, busy_above=10.0):
+    """Name of the quality profile for a scene whose `MotionMeter.level` is `level`."""
+    if level < static_below:
+        return "static"
+    if level > busy_above:
+        return "busy"
+    return "normal"
@@ -0,0 +1,250 @@
+"""
+QR scanning with the camera for scan.py, capture and decoding on separate threads.
+
+The capture thread converts every frame to a downscaled grayscale image, the decoders only look
+at luma anyway, and keeps only the newest one: a decoder that falls behind skips frames instead
+of working through a backlog of stale ones. The decode thread skips frames in which nothing moved
+since the last decoded frame, every `full_frame_every`-th frame is decoded regardless in case the
+first look at a code held still was blurred. After a detection the decoder first looks at a
+region of interest around the last code and only falls back to the whole frame when the code
+isn't there anymore.
+"""
+import collections
+import logging
+import sys
+import threading
+import time
+
+# Add the global Python library path to sys.path to use cv2 just like in the videorecorder
+sys.path.append("/usr/lib/python3/dist-packages")
+import cv2
+
+logger = logging.getLogger("qr_pipeline")
+
+# `rect` is (x, y, width, height) in the coordinates of the decoded image
+Detection = collections.namedtuple("Detection", "data rect")
+# A code the pipeline reports, `captured_at` and `decoded_at` are time.monotonic()
+Scan = collections.namedtuple("Scan", "data captured_at decoded_at")
+
+
+class ZbarDecoder:
+    """pyzbar, restricted to QR codes. Its cost grows with the number of pixels."""
+
+    name = "zbar"
+
+    @staticmethod
+    def is_available():
+        try:
+            import pyzbar.pyzbar  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def __init__(self):
+        from pyzbar import pyzbar
+
+        self.pyzbar = pyzbar
+
+    def decode(self, image):
+        return [
+            Detection(barcode.data.decode("utf-8"), tuple(barcode.rect))
+            for barcode in self.pyzbar.decode(image, symbols=[self.pyzbar.ZBarSymbol.QRCODE])
+        ]
+
+
+class OpenCVDecoder:
+    """cv2.QRCodeDetector, for devices without zbar."""
+
+    name = "opencv"
+
+    @staticmethod
+    def is_available():
+        return hasattr(cv2, "QRCodeDetector")
+
+    def __init__(self):
+        self.detector = cv2.QRCodeDetector()
+
+    def decode(self, image):
+        data, points, _ = self.detector.detectAndDecode(image)
+        if not data or points is None:
+            return []
+        return [Detection(data, cv2.boundingRect(points.reshape(-1, 2).astype("float32")))]
+
+
+DECODERS = {ZbarDecoder.name: ZbarDecoder, OpenCVDecoder.name: OpenCVDecoder}
+
+
+def select_decoder(name="auto"):
+    """
+    Return the decoder class for `name`, one of "auto", "zbar" or "opencv".
+
+    "auto" prefers zbar, which scan.py always used. A decoder that isn't installed falls back
+    to OpenCV.
+    """
+    if name == "auto":
+        return ZbarDecoder if ZbarDecoder.is_available() else OpenCVDecoder
+    decoder = DECODERS.get(name)
+    if decoder is None:
+        raise ValueError(f"Unknown QR decoder {name!r}, expected one of {['auto', *DECODERS]}")
+    if not decoder.is_available():
+        logger.warning(f"QR decoder {name} is not available, falling back to OpenCV.")
+        return OpenCVDecoder
+    return decoder
+
+
+def prepare_frame(frame, width, grayscale=True):
+    """Shrink `frame` to `width` keeping its aspect ratio, and drop the color."""
+    height, frame_width = frame.shape[:2]
+    if frame_width > width:
+        frame = cv2.resize(frame, (width, height * width // frame_width), interpolation=cv2.INTER_AREA)
+    if grayscale and frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return frame
+
+
+def expand_rect(rect, margin, shape):
+    """`rect` grown by `margin` times its size on every side, clipped to an image of `shape`."""
+    x, y, width, height = rect
+    dx, dy = int(width * margin), int(height * margin)
+    x0, y0 = max(x - dx, 0), max(y - dy, 0)
+    x1, y1 = min(x + width + dx, shape[1]), min(y + height + dy, shape[0])
+    return x0, y0, x1 - x0, y1 - y0
+
+
+class QrScanPipeline:
+    """
+    Reads frames on one thread and decodes QR codes on another, see the module docstring.
+
+    Args:
+        read_frame (callable): Returns the next frame, or ``None`` if the camera failed.
+        on_scan (callable): ``on_scan(Scan)``, called on the decode thread for every new code.
+            It should hand the scan off rather than verify it in place.
+        decoder (optional): Object with ``decode(image) -> [Detection]``. Defaults to `select_decoder()`.
+        fps (int): Capture rate in frames per second.
+        width (int): Frames are shrunk to this width before decoding.
+        grayscale (bool): Drop the color on capture.
+        roi_margin (float, optional): Size of the region of interest around the last code, as a
+            fraction of the code's size on each side. ``None`` always decodes the whole frame.
+        motion (camera.motion.MotionMeter, optional): Skips still frames, ``None`` decodes every frame.
+        full_frame_every (int): Decode at least every this many frames, even without motion.
+        repeat_after (float): Seconds before the same code is reported again, see `restart_repeat`.
+    """
+
+    def __init__(self, read_frame, on_scan, decoder=None, fps=30, width=400, grayscale=True, roi_margin=0.5,
+                 motion=None, full_frame_every=10, repeat_after=3.0):
+        self.read_frame = read_frame
+        self.on_scan = on_scan
+        self.decoder = decoder or select_decoder()()
+        self.frame_interval = 1.0 / fps
+        self.width = width
+        self.grayscale = grayscale
+        self.roi_margin = roi_margin
+        self.motion = motion
+        self.full_frame_every = full_frame_every
+        self.repeat_after = repeat_after
+        self.roi = None
+        self.stats = collections.Counter()
+        self.decode_seconds = 0.0
+        self._latest = None  # (captured_at, frame) not taken by the decoder yet
+        self._frame_ready = threading.Condition()
+        self._last_scan = (None, None)  # (data, decoded_at)
+        self._since_decode = full_frame_every  # frames skipped in a row, the first frame is never skipped
+        self._stopped = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._capture, name="qr-capture", daemon=True),
+            threading.Thread(target=self._decode, name="qr-decode", daemon=True),
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        with self._frame_ready:
+            self._frame_ready.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def restart_repeat(self, data):
+        """Count `repeat_after` for `data` from now, e.g. once its verification finished."""
+        self._last_scan = (data, time.monotonic())
+
+    def _capture(self):
+        next_frame_time = time.monotonic()
+        while not self._stopped.is_set():
+            frame = self.read_frame()
+            if frame is not None:
+                captured_at = time.monotonic()
+                frame = prepare_frame(frame, self.width, self.grayscale)
+                with self._frame_ready:
+                    if self._latest is not None:
+                        self.stats["dropped"] += 1
+                    self._latest = (captured_at, frame)
+                    self.stats["captured"] += 1
+                    self._frame_ready.notify()
+
+            next_frame_time += self.frame_interval
+            delay = next_frame_time - time.monotonic()
+            if delay > 0:
+                self._stopped.wait(delay)
+            else:
+                next_frame_time = time.monotonic()  # fell behind, don't try to catch up
+
+    def _decode(self):
+        while True:
+            with self._frame_ready:
+                while self._latest is None and not self._stopped.is_set():
+                    self._frame_ready.wait()
+                if self._stopped.is_set():
+                    return
+                captured_at, frame = self._latest
+                self._latest = None
+            self.process(frame, captured_at)
+
+    def process(self, frame, captured_at):
+        """Decode a prepared frame unless it can be skipped, and report its new codes."""
+        if self.motion is not None:
+            self.motion.measure(frame)
+            if not self.motion.moving and self._since_decode < self.full_frame_every - 1:
+                self._since_decode += 1
+                self.stats["still"] += 1
+                return
+        self._since_decode = 0
+        started = time.perf_counter()
+        detections = self._find_codes(frame)
+        self.decode_seconds += time.perf_counter() - started
+        self.stats["decoded"] += 1
+        now = time.monotonic()
+        for detection in detections:
+            last_data, last_time = self._last_scan
+            if detection.data == last_data and now - last_time < self.repeat_after:
+                continue
+            self._last_scan = (detection.data, now)
+            self.stats["scans"] += 1
+            self.on_scan(Scan(detection.data, captured_at, now))
+
+    def _find_codes(self, frame):
+        if self.roi is not None:
+            x, y, width, height = self.roi
+            detections = self.decoder.decode(frame[y:y + height, x:x + width])
+            if detections:
+                self.stats["roi_hits"] += 1
+                detections = [Detection(d.data, (d.rect[0] + x, d.rect[1] + y, *d.rect[2:])) for d in detections]
+                self._track(detections, frame.shape)
+                return detections
+        detections = self.decoder.decode(frame)
+        self.stats["full_frames"] += 1
+        self._track(detections, frame.shape)
+        return detections
+
+    def _track(self, detections, shape):
+        if self.roi_margin is None or not detections:
+            self.roi = None
+        else:
+            self.roi = expand_rect(detections[0].rect, self.roi_margin, shape)
+
+    def decode_fps(self):
+        """Frames per second the decoder could sustain, from the time spent decoding so far."""
+        return self.stats["decoded"] / self.decode_seconds if self.decode_seconds else None
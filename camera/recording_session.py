@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+
+
+class RecordingSession:
+    """
+    A single clip shared by every entrance-log uuid triggered while it is being recorded.
+
+    Each trigger extends the clip to `duration` seconds after it, up to `max_duration` seconds
+    after the clip started. The part of the clip belonging to a uuid is kept as a
+    ``(start, end)`` range in seconds from the beginning of the clip.
+
+    Args:
+        clip_start (float): Unix time of the first frame in the clip, i.e. the oldest pre-roll frame.
+        duration (float): Seconds to keep recording after each trigger.
+        max_duration (float): Upper bound for the length of the whole clip.
+    """
+
+    def __init__(self, clip_start, duration, max_duration):
+        self.clip_start = clip_start
+        self.duration = duration
+        self.max_end_time = clip_start + max_duration
+        self.end_time = clip_start
+        self.last_trigger_time = None
+        self.ranges = {}
+
+    @property
+    def uuids(self):
+        return list(self.ranges)
+
+    def add(self, uuid, trigger_time):
+        """Register a trigger and extend the recording to cover it."""
+        end_time = min(trigger_time + self.duration, self.max_end_time)
+        self.end_time = max(self.end_time, end_time)
+        self.last_trigger_time = max(self.last_trigger_time or trigger_time, trigger_time)
+        if uuid not in self.ranges:
+            # A scan from before the first frame, e.g. with an empty pre-roll, starts at the beginning
+            start = max(trigger_time - self.clip_start, 0)
+            self.ranges[uuid] = (round(start, 3), round(end_time - self.clip_start, 3))
+
+    def trim(self, end_time):
+        """End the clip before `end_time`, e.g. once the scene went still. The ranges are cut to match."""
+        if end_time >= self.end_time:
+            return
+        self.end_time = end_time
+        clip_end = round(end_time - self.clip_start, 3)
+        self.ranges = {uuid: (start, min(end, clip_end)) for uuid, (start, end) in self.ranges.items()}
+
+    def save(self, clip_path, recording_dir, video_format):
+        """
+        Move the finished clip into place for every uuid of the session.
+
+        The first uuid gets the clip itself, the others get hardlinks to it. Each uuid also gets
+        a ``{uuid}.range.json`` sidecar with its time range, which the uploader attaches to the
+        S3 object.
+
+        Returns:
+            list[str]: Paths of the per-uuid clips.
+        """
+        paths = []
+        for uuid in self.uuids:
+            path = os.path.join(recording_dir, f"{uuid}.{video_format}")
+            # The uploader picks the clip up as soon as it appears, so its sidecar has to be there first
+            write_range(recording_dir, uuid, *self.ranges[uuid])
+            if not paths:
+                os.rename(clip_path, path)
+            else:
+                link_or_copy(paths[0], path)
+            paths.append(path)
+        return paths
+
+
+def link_or_copy(source, destination):
+    """Hardlink `destination` to `source`, copying only if the filesystem can't link."""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Copy under a temporary name so directory watchers never see a partial clip
+        shutil.copy(source, f"{destination}.part")
+        os.replace(f"{destination}.part", destination)
+
+
+def range_path(recording_dir, uuid):
+    return os.path.join(recording_dir, f"{uuid}.range.json")
+
+
+def write_range(recording_dir, uuid, start, end):
+    with open(range_path(recording_dir, uuid), "w") as f:
+        json.dump({"start": start, "end": end}, f)
+
+
+DENIED_MARKER_SUFFIX = ".denied"
+
+
+def denied_marker_path(recording_dir, uuid):
+    """qr.py marks entries it denied, their clips are kept longest when the disk runs full."""
+    return os.path.join(recording_dir, f"{uuid}{DENIED_MARKER_SUFFIX}")
+
+
+def write_denied_marker(recording_dir, uuid):
+    with open(denied_marker_path(recording_dir, uuid), "w"):
+        pass
+
+
+def upload_state_path(clip_path):
+    """Progress of an interrupted multipart upload of the clip."""
+    return f"{clip_path}.upload.json"
+
+
+def read_range(recording_dir, uuid):
+    """Return ``(start, end)`` of the uuid within its clip, or ``None`` if there is no sidecar."""
+    try:
+        with open(range_path(recording_dir, uuid)) as f:
+            data = json.load(f)
+        return data["start"], data["end"]
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
@@ -0,0 +1,188 @@
+import logging
+import os
+import time
+
+from camera.recording_session import DENIED_MARKER_SUFFIX, denied_marker_path, range_path, upload_state_path
+
+logger = logging.getLogger("VideoUploader")
+
+OLDEST_FIRST = "oldest"
+KEEP_DENIED = "keep-denied"
+POLICIES = (OLDEST_FIRST, KEEP_DENIED)
+DENIED_MARKER_TTL = 3600  # Seconds a denied marker may wait for its clip
+
+
+class RetentionManager:
+    """
+    Keeps the clips in RECORDING_DIR within a disk budget while they wait for upload.
+
+    The size of every clip is kept in an in-memory index that is updated as clips appear and are
+    uploaded, so checking the budget doesn't touch the disk. Hardlinked clips of a shared recording
+    are counted once. When the clips grow beyond `high_water` bytes, or the filesystem has less
+    than `min_free` bytes left, clips are evicted until they are back under `low_water` bytes.
+    Denied markers whose clip didn't show up within `marker_ttl` seconds are removed on rescan.
+
+    Policies:
+        "oldest": Evict the oldest clips first.
+        "keep-denied": Like "oldest", but clips of denied entries (see `denied_marker_path`) go last.
+
+    Args:
+        recording_dir (str): Directory holding the clips.
+        high_water (int): Bytes of clips that trigger an eviction.
+        low_water (int): Bytes of clips left after an eviction.
+        min_free (int): Free bytes on the filesystem below which clips are evicted as well.
+        policy (str): One of `POLICIES`.
+        marker_ttl (float): Seconds after which a denied marker without a clip is removed.
+    """
+
+    def __init__(self, recording_dir, high_water, low_water, min_free=0, policy=OLDEST_FIRST, marker_ttl=DENIED_MARKER_TTL):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown retention policy {policy!r}, expected one of {list(POLICIES)}")
+        if low_water > high_water:
+            raise ValueError("The low-water mark must not be above the high-water mark")
+        self.recording_dir = recording_dir
+        self.high_water = high_water
+        self.low_water = low_water
+        self.min_free = min_free
+        self.policy = policy
+        self.marker_ttl = marker_ttl
+        self.clips = {}  # path -> (mtime, size, inode)
+        self.inodes = {}  # inode -> number of indexed links
+        self.total_bytes = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+
+    def rescan(self, is_clip):
+        """
+        Rebuild the index from the directory, `is_clip(name)` selects the files to track. Denied
+        markers still without a clip after `marker_ttl` seconds are removed.
+        """
+        self.clips.clear()
+        self.inodes.clear()
+        self.total_bytes = 0
+        markers = []
+        with os.scandir(self.recording_dir) as entries:
+            for entry in entries:
+                try:
+                    if is_clip(entry.name):
+                        self._add(entry.path, entry.stat())
+                    elif entry.name.endswith(DENIED_MARKER_SUFFIX):
+                        markers.append((entry.path, entry.stat().st_mtime))
+                except FileNotFoundError:
+                    continue
+        self._remove_orphaned_markers(markers)
+
+    def _remove_orphaned_markers(self, markers):
+        """Remove the `(path, mtime)` markers without a clip, e.g. because the clip was never recorded."""
+        clip_uuids = {_uuid(path) for path in self.clips}
+        deadline = time.time() - self.marker_ttl
+        removed = 0
+        for path, mtime in markers:
+            if mtime > deadline or os.path.basename(path)[: -len(DENIED_MARKER_SUFFIX)] in clip_uuids:
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        if removed:
+            logger.info(f"Removed {removed} denied markers without a clip from {self.recording_dir}.")
+
+    def add(self, path):
+        """Index a new clip or update a changed one."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.discard(path)
+            return
+        self.discard(path)
+        self._add(path, stat)
+
+    def discard(self, path):
+        """Drop a clip that was uploaded or removed from the index."""
+        clip = self.clips.pop(path, None)
+        if clip is None:
+            return
+        _, size, inode = clip
+        self.inodes[inode] -= 1
+        if self.inodes[inode] == 0:
+            del self.inodes[inode]
+            self.total_bytes -= size
+
+    def free_bytes(self):
+        stat = os.statvfs(self.recording_dir)
+        return stat.f_bavail * stat.f_frsize
+
+    def headroom(self):
+        """Bytes that can still be recorded before clips are evicted, and what that is based on."""
+        free_bytes = self.free_bytes()
+        return {
+            "clip_bytes": self.total_bytes,
+            "clip_files": len(self.clips),
+            "free_bytes": free_bytes,
+            "headroom_bytes": max(min(self.high_water - self.total_bytes, free_bytes - self.min_free), 0),
+            "evicted_files": self.evicted_files,
+            "evicted_bytes": self.evicted_bytes,
+        }
+
+    def enforce(self, keep=()):
+        """
+        Evict clips if a high-water mark is reached. Clips in `keep`, e.g. the ones being uploaded, are never evicted.
+
+        Returns:
+            list[str]: Paths of the evicted clips.
+        """
+        target_bytes = self.low_water if self.total_bytes > self.high_water else self.total_bytes
+        if self.min_free:
+            # The disk is shared with other data, free what is missing to min_free as well
+            shortfall = self.min_free - self.free_bytes()
+            if shortfall > 0:
+                target_bytes = min(target_bytes, self.total_bytes - shortfall)
+        if self.total_bytes <= target_bytes:
+            return []
+
+        evicted = []
+        for path in self._eviction_order():
+            if self.total_bytes <= target_bytes:
+                break
+            if path in keep:
+                continue
+            freed = self._evict(path)
+            evicted.append(path)
+            self.evicted_files += 1
+            self.evicted_bytes += freed
+        if evicted:
+            logger.warning(
+                f"Evicted {len(evicted)} clips to keep {self.recording_dir} within its budget, "
+                f"{self.total_bytes} bytes of clips left."
+            )
+        return evicted
+
+    def _add(self, path, stat):
+        self.clips[path] = (stat.st_mtime, stat.st_size, stat.st_ino)
+        self.inodes[stat.st_ino] = self.inodes.get(stat.st_ino, 0) + 1
+        if self.inodes[stat.st_ino] == 1:
+            self.total_bytes += stat.st_size
+
+    def _eviction_order(self):
+        if self.policy == KEEP_DENIED:
+            denied = {path: os.path.exists(denied_marker_path(self.recording_dir, _uuid(path))) for path in self.clips}
+            return sorted(self.clips, key=lambda path: (denied[path], self.clips[path][0]))
+        return sorted(self.clips, key=lambda path: self.clips[path][0])
+
+    def _evict(self, path):
+        """Remove a clip with its sidecars, returning the bytes that actually became free."""
+        before = self.total_bytes
+        self.discard(path)
+        uuid = _uuid(path)
+        sidecars = (range_path(self.recording_dir, uuid), denied_marker_path(self.recording_dir, uuid), upload_state_path(path))
+        for file_path in (path, *sidecars):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        return before - self.total_bytes
+
+
+def _uuid(path):
+    return os.path.splitext(os.path.basename(path))[0]
@@ -0,0 +1,67 @@
+import sys
+
+import numpy as np
+
+# Add the global Python library path to sys.path to use cv2 just like in the videorecorder
+sys.path.append("/usr/lib/python3/dist-packages")
+import cv2
+
+
+class SyntheticFrameSource:
+    """
+    Stand-in for cv2.VideoCapture producing deterministic moving frames.
+
+    Used to exercise the recording and encoding paths without a camera, e.g. in CI or in the
+    benchmarks. Only the parts of the VideoCapture API the recorder uses are implemented.
+
+    Args:
+        moving (callable, optional): ``moving(frame_index)`` decides whether the block moves in a
+            frame, it always moves by default. Lets benchmarks script still segments.
+        noise (int): Amplitude of random per-pixel noise, like the sensor noise of a real camera.
+    """
+
+    def __init__(self, width=640, height=480, max_frames=None, moving=None, noise=0):
+        self.width = width
+        self.height = height
+        self.max_frames = max_frames
+        self.moving = moving
+        self.noise = noise
+        self.rng = np.random.default_rng(0)
+        self.frame_index = 0
+        self.position = 0
+        self.opened = True
+        # Static textured background so encoders have realistic work to do
+        y, x = np.mgrid[0:height, 0:width]
+        self.background = np.dstack([(x * 255 // width), (y * 255 // height), ((x + y) % 256)]).astype(np.uint8)
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop, value):
+        return False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        return 0
+
+    def read(self):
+        if not self.opened or (self.max_frames is not None and self.frame_index >= self.max_frames):
+            return False, None
+        frame = self.background.copy()
+        # A block sweeping across the frame as the "person" walking through
+        size = self.height // 4
+        x = (self.position * 8) % max(self.width - size, 1)
+        if self.moving is None or self.moving(self.frame_index):
+            self.position += 1
+        frame[self.height // 2 - size // 2: self.height // 2 + size // 2, x: x + size] = 255
+        if self.noise:
+            noise = self.rng.integers(-self.noise, self.noise + 1, size=frame.shape, dtype=np.int16)
+            frame = np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        self.frame_index += 1
+        return True, frame
+
+    def release(self):
+        self.opened = False
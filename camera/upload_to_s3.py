@@ -1,4 +1,5 @@
 import asyncio
+import json
 import logging
 import os
 import sys
@@ -8,9 +9,13 @@ from systemd.journal import JournalHandler
 from botocore.config import Config
 import sentry_sdk
 
-# Add the global Python library path to sys.path to use cv2 just like in the videorecorder
-sys.path.append("/usr/lib/python3/dist-packages")
-import cv2
+# Make the camera package and the shared root modules importable when running this file as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera.bandwidth import ThrottledBody, UploadThrottle, parse_hours
+from camera.recording_session import denied_marker_path, range_path, read_range, upload_state_path
+from camera.retention import OLDEST_FIRST, RetentionManager
+from dir_watch import CLOSED, CREATED, MOVED, OVERFLOW, DirectoryWatcher
+import profiler
 
 
 logger = logging.getLogger("VideoUploader")
@@ -21,11 +26,79 @@ logger.propagate = False
 
 
 class VideoUploader:
+    """
+    Uploads finished clips from RECORDING_DIR to the gym's bucket.
+
+    One S3 client is kept open for the lifetime of the uploader. Clips are queued newest first as
+    soon as the recorder moves them into the recording directory, so the latest entrance is
+    uploaded before an older backlog. A full scan every `RESCAN_INTERVAL` seconds picks up clips
+    whose upload failed. `UPLOAD_CONCURRENCY` workers drain the queue. Clips larger than
+    `MULTIPART_THRESHOLD` are sent as multipart uploads whose progress is kept next to the clip in
+    ``{clip}.upload.json``, so an interrupted upload continues with the missing parts.
+
+    Uploads are paced to `UPLOAD_BANDWIDTH_KBPS`, or `UPLOAD_OFF_PEAK_BANDWIDTH_KBPS` during
+    `UPLOAD_OFF_PEAK_HOURS`, and paused while qr.py verifies a scan. Throughput and the bytes held
+    back are written to `UPLOAD_STATS_FILE` every `STATS_INTERVAL` seconds.
+
+    Clips waiting for upload are kept within `RETENTION_MAX_MB`, and `RETENTION_MIN_FREE_MB` are
+    kept free on the disk, by evicting clips according to `RETENTION_POLICY`, see RetentionManager.
+    """
+
+    RESCAN_INTERVAL = 60  # Seconds
+    POLL_INTERVAL = 5  # Seconds between scans if the directory can't be watched with inotify
+    RETRY_INTERVAL = 5  # Seconds a worker waits after a failed upload
+    STATS_INTERVAL = 30  # Seconds
+
     def __init__(self, settings):
         self.settings = settings
+        self.concurrency = max(1, int(getattr(settings, "UPLOAD_CONCURRENCY", 2)))
+        self.multipart_threshold = int(getattr(settings, "MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+        # S3 requires every part but the last to be at least 5 MiB
+        self.multipart_chunksize = max(int(getattr(settings, "MULTIPART_CHUNKSIZE", 8 * 1024 * 1024)), 5 * 1024 * 1024)
+        self.bucket_ready = False
+        self.queue = asyncio.PriorityQueue()
+        self.pending = set()
+        self.uploaded_files = 0
+        # Bandwidth caps are configured in kbit/s, 0 means unlimited
+        self.throttle = UploadThrottle(
+            rate=float(getattr(settings, "UPLOAD_BANDWIDTH_KBPS", 0)) * 1000 / 8,
+            off_peak_rate=float(getattr(settings, "UPLOAD_OFF_PEAK_BANDWIDTH_KBPS", 0)) * 1000 / 8,
+            off_peak_hours=parse_hours(getattr(settings, "UPLOAD_OFF_PEAK_HOURS", "")),
+            busy_dir=getattr(settings, "BUSY_SIGNAL_DIR", None),
+        )
+        high_water = int(float(getattr(settings, "RETENTION_MAX_MB", 2048)) * 1024 * 1024)
+        self.retention = RetentionManager(
+            settings.RECORDING_DIR,
+            high_water=high_water,
+            low_water=int(high_water * float(getattr(settings, "RETENTION_LOW_WATER_RATIO", 0.8))),
+            min_free=int(float(getattr(settings, "RETENTION_MIN_FREE_MB", 512)) * 1024 * 1024),
+            policy=getattr(settings, "RETENTION_POLICY", OLDEST_FIRST),
+        )
+        self.uploading = set()
+        self.stats_file = getattr(settings, "UPLOAD_STATS_FILE", None) or os.path.join(
+            settings.RECORDING_DIR, "upload_stats.json"
+        )
+
+    def create_client(self):
+        config = Config(
+            retries={"max_attempts": 1, "mode": "standard"},
+            connect_timeout=30,  # Seconds
+            read_timeout=300,  # Seconds
+            max_pool_connections=max(10, self.concurrency),
+        )
+        session = aioboto3.Session()
+        return session.client(
+            "s3",
+            aws_access_key_id=self.settings.S3_ACCESS_KEY,
+            aws_secret_access_key=self.settings.S3_SECRET_ACCESS_KEY,
+            endpoint_url=self.settings.S3_ENDPOINT_URL,
+            config=config,
+        )
 
     async def ensure_bucket_exists(self, s3_client):
-        """Ensure the S3 bucket exists. Create it if not."""
+        """Ensure the S3 bucket exists. Create it if not. The result is cached until an upload reports it missing."""
+        if self.bucket_ready:
+            return
         bucket_name = self.settings.GYM_UUID
         try:
             await s3_client.head_bucket(Bucket=bucket_name)
@@ -41,110 +114,224 @@ class VideoUploader:
             else:
                 logger.error(f"Error checking bucket {bucket_name}: {e}")
                 raise
+        self.bucket_ready = True
 
-    async def flip_video(self, input_file_path, output_file_path):
-        """Flip the video upside down and mirror it left to right."""
-        cap = cv2.VideoCapture(input_file_path)
-        if not cap.isOpened():
-            logger.error(f"Could not open video file: {input_file_path}")
+    def enqueue(self, path, mtime):
+        """Queue a clip unless it is queued or uploading already. Newer clips are taken from the queue first."""
+        if path in self.pending:
             return False
+        self.pending.add(path)
+        self.queue.put_nowait((-mtime, path))
+        return True
 
-        # Read video properties
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        fourcc = cv2.VideoWriter_fourcc(*"avc1")
+    def enqueue_recordings(self):
+        """Rebuild the retention index from the recording directory and queue every clip in it."""
+        self.retention.rescan(is_recording)
+        self.evict()
+        added = sum(self.enqueue(path, mtime) for path, (mtime, _, _) in self.retention.clips.items())
+        if added:
+            logger.info(f"Queued {added} video files for upload, {self.queue.qsize()} waiting.")
+        return added
 
-        out = cv2.VideoWriter(output_file_path, fourcc, fps, (width, height))
+    def enqueue_events(self, events):
+        """Queue the clips the recorder renamed or linked into the recording directory."""
+        for event in events:
+            if event.kind not in (CREATED, CLOSED, MOVED) or not is_recording(event.name):
+                continue
+            path = os.path.join(self.settings.RECORDING_DIR, event.name)
+            self.retention.add(path)
+            if path in self.retention.clips and self.enqueue(path, self.retention.clips[path][0]):
+                logger.info(f"Queued {event.name} for upload, {self.queue.qsize()} waiting.")
+        self.evict()
 
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            # First flip upside down (vertical flip)
-            flipped_frame = cv2.flip(frame, 0)
-            # Then mirror left to right (horizontal flip)
-            flipped_frame = cv2.flip(flipped_frame, 1)
-            out.write(flipped_frame)
-
-        cap.release()
-        out.release()
-        return True
+    def evict(self):
+        """Evict clips if the recording directory outgrew its budget. Clips being uploaded are kept."""
+        for path in self.retention.enforce(keep=self.uploading):
+            # Still queued, the worker skips it once it finds the file gone
+            logger.warning(f"Evicted {os.path.basename(path)} without uploading it.")
 
     async def upload_file_to_s3(self, s3_client, file_path):
-        """Upload a file to S3, optionally flipping and mirroring it first if configured."""
+        """Upload a file to S3 as it is. Clips are already recorded in the right orientation."""
         file_name = os.path.basename(file_path)
         bucket_name = self.settings.GYM_UUID
         s3_key = file_name
 
-        # If flipping is required
-        if getattr(self.settings, "FLIP_VIDEO", False) and "flipped" not in file_name:
-            # Create a temporary flipped file
-            flipped_file_path = file_path + ".flipped.mp4"
-            logger.info(f"Flipping and mirroring video {file_name} before upload...")
-            success = await self.flip_video(file_path, flipped_file_path)
-            if success:
-                # Replace the file_path with the flipped one for uploading
-                file_path_to_upload = flipped_file_path
-            else:
-                logger.error("Flipping video failed, uploading original.")
-                file_path_to_upload = file_path
-        else:
-            file_path_to_upload = file_path
+        logger.info(f"Uploading {file_name} as {s3_key} to bucket {bucket_name}...")
 
-        logger.info(f"Uploading {os.path.basename(file_path_to_upload)} as {s3_key} to bucket {bucket_name}...")
+        # Clips shared by several entrance logs carry the part belonging to this one as metadata
+        uuid = os.path.splitext(file_name)[0]
+        clip_range = read_range(self.settings.RECORDING_DIR, uuid)
+        metadata = {"clip-start": str(clip_range[0]), "clip-end": str(clip_range[1])} if clip_range else {}
 
         # Upload the file to S3
-        await s3_client.upload_file(file_path_to_upload, bucket_name, s3_key)
+        file_size = os.path.getsize(file_path)
+        if file_size > self.multipart_threshold:
+            await self.upload_multipart(s3_client, file_path, bucket_name, s3_key, metadata)
+        else:
+            with open(file_path, "rb") as f:
+                body = ThrottledBody(f.read(), self.throttle, asyncio.get_running_loop())
+            await s3_client.put_object(Bucket=bucket_name, Key=s3_key, Body=body, Metadata=metadata)
         logger.info(f"Successfully uploaded {file_name} to {bucket_name}/{s3_key}.")
 
         # Delete local files
         os.remove(file_path)
-        if file_path_to_upload != file_path:
-            os.remove(file_path_to_upload)
+        self.retention.discard(file_path)
+        if clip_range:
+            os.remove(range_path(self.settings.RECORDING_DIR, uuid))
+        if os.path.exists(denied_marker_path(self.settings.RECORDING_DIR, uuid)):
+            os.remove(denied_marker_path(self.settings.RECORDING_DIR, uuid))
         logger.info(f"Deleted local file(s) related to {file_name}")
 
-    async def upload(self, video_files):
-        """Main loop to check the directory and upload files."""
-        config = Config(
-            retries={"max_attempts": 1, "mode": "standard"},
-            connect_timeout=30,  # Seconds
-            read_timeout=300,  # Seconds
-        )
+    async def upload_multipart(self, s3_client, file_path, bucket_name, s3_key, metadata):
+        """
+        Upload a large clip part by part, resuming a previous attempt if its state file is still there.
 
-        session = aioboto3.Session()
-        async with session.client(
-            "s3",
-            aws_access_key_id=self.settings.S3_ACCESS_KEY,
-            aws_secret_access_key=self.settings.S3_SECRET_ACCESS_KEY,
-            endpoint_url=self.settings.S3_ENDPOINT_URL,
-            config=config,
-        ) as s3_client:
-            # Ensure the bucket exists on startup
-            await self.ensure_bucket_exists(s3_client)
-
-            logger.info(f"Found {len(video_files)} video files to upload...")
-            for file in video_files:
-                logger.info(f"Uploading {file}...")
-                await self.upload_file_to_s3(s3_client, file)
-                break  # better to not keep uploading because there might be a newer one with higher prio
-    async def upload_loop(self):
-        """Run the upload loop continuously."""
-        while True:
-                # List all files in the recording directory and sort them by modification time (newest first)
-            files = sorted(
-                [
-                    os.path.join(self.settings.RECORDING_DIR, f)
-                    for f in os.listdir(self.settings.RECORDING_DIR)
-                    if os.path.isfile(os.path.join(self.settings.RECORDING_DIR, f))
-                ],
-                key=lambda x: os.path.getmtime(x),
-                reverse=True
+        The state file is rewritten after every part, so at most one part is sent twice after a crash
+        or a lost connection. If S3 no longer knows the upload the state is dropped and the next
+        attempt starts over.
+        """
+        state_path = upload_state_path(file_path)
+        state = read_upload_state(state_path)
+        if state is None or state["key"] != s3_key or state["size"] != os.path.getsize(file_path):
+            response = await s3_client.create_multipart_upload(Bucket=bucket_name, Key=s3_key, Metadata=metadata)
+            state = {
+                "key": s3_key,
+                "upload_id": response["UploadId"],
+                "size": os.path.getsize(file_path),
+                "part_size": self.multipart_chunksize,
+                "parts": [],
+            }
+            write_upload_state(state_path, state)
+        else:
+            logger.info(f"Resuming upload of {os.path.basename(file_path)} with {len(state['parts'])} parts done.")
+
+        part_size = state["part_size"]
+        part_count = max(1, -(-state["size"] // part_size))
+        done = {part["PartNumber"] for part in state["parts"]}
+        try:
+            with open(file_path, "rb") as f:
+                for part_number in range(1, part_count + 1):
+                    if part_number in done:
+                        continue
+                    f.seek((part_number - 1) * part_size)
+                    body = ThrottledBody(f.read(part_size), self.throttle, asyncio.get_running_loop())
+                    response = await s3_client.upload_part(
+                        Bucket=bucket_name, Key=s3_key, UploadId=state["upload_id"], PartNumber=part_number, Body=body
+                    )
+                    state["parts"].append({"PartNumber": part_number, "ETag": response["ETag"]})
+                    write_upload_state(state_path, state)
+
+            parts = sorted(state["parts"], key=lambda part: part["PartNumber"])
+            await s3_client.complete_multipart_upload(
+                Bucket=bucket_name, Key=s3_key, UploadId=state["upload_id"], MultipartUpload={"Parts": parts}
             )
-            video_files = [f for f in files if f.endswith(".mp4") and not "temp" in f]
-            if video_files:
-                await self.upload(video_files)
-            await asyncio.sleep(5)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchUpload":
+                logger.warning(f"Multipart upload of {s3_key} expired, starting over next time.")
+                os.remove(state_path)
+            raise
+        os.remove(state_path)
+
+    async def upload_worker(self, s3_client):
+        while True:
+            _, file_path = await self.queue.get()
+            self.uploading.add(file_path)
+            try:
+                await self.ensure_bucket_exists(s3_client)
+                await self.upload_file_to_s3(s3_client, file_path)
+                self.uploaded_files += 1
+            except FileNotFoundError:
+                logger.info(f"{file_path} disappeared before it was uploaded.")
+            except Exception as e:
+                if isinstance(e, ClientError) and e.response["Error"]["Code"] == "NoSuchBucket":
+                    self.bucket_ready = False
+                logger.error(f"Failed to upload {file_path}: {e}")
+                sentry_sdk.capture_exception(e)
+                await asyncio.sleep(self.RETRY_INTERVAL)
+            finally:
+                # Failed clips are picked up again by the next scan
+                self.pending.discard(file_path)
+                self.uploading.discard(file_path)
+                self.queue.task_done()
+
+    def write_stats(self):
+        stats = {
+            **self.throttle.stats(),
+            **self.retention.headroom(),
+            "uploaded_files": self.uploaded_files,
+            "queued_files": self.queue.qsize(),
+        }
+        temp_path = f"{self.stats_file}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(stats, f)
+        os.replace(temp_path, self.stats_file)
+        return stats
+
+    async def stats_loop(self):
+        while True:
+            await asyncio.sleep(self.STATS_INTERVAL)
+            try:
+                stats = self.write_stats()
+            except OSError as e:
+                logger.error(f"Failed to write upload stats: {e}")
+                continue
+            if stats["deferred_bytes"] or stats["throughput_bps"]:
+                logger.info(f"Upload stats: {stats}")
+
+    async def watch_loop(self, watcher):
+        """Queue clips as the recorder finishes them, and rescan the whole directory now and then."""
+        loop = asyncio.get_running_loop()
+        next_rescan = loop.time()
+        while True:
+            events = await watcher.wait(max(next_rescan - loop.time(), 0))
+            if loop.time() >= next_rescan or any(event.kind == OVERFLOW for event in events):
+                self.enqueue_recordings()
+                next_rescan = loop.time() + self.RESCAN_INTERVAL
+            else:
+                self.enqueue_events(events)
+
+    async def upload_loop(self):
+        """
+        Run the upload loop continuously.
+
+        None of its tasks returns. If one of them dies its exception is raised here, rather than
+        leaving the uploader running without workers, and systemd restarts the service.
+        """
+        watcher = DirectoryWatcher(self.settings.RECORDING_DIR, poll_interval=self.POLL_INTERVAL)
+        watcher.open()
+        async with self.create_client() as s3_client:
+            tasks = [asyncio.create_task(self.upload_worker(s3_client)) for _ in range(self.concurrency)]
+            tasks.append(asyncio.create_task(self.stats_loop()))
+            tasks.append(asyncio.create_task(self.watch_loop(watcher)))
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    task.result()
+            finally:
+                watcher.close()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def is_recording(file_name):
+    """Finished clips, the recorder writes to temp_*.mp4 files while recording."""
+    return file_name.endswith(".mp4") and "temp" not in file_name
+
+
+def read_upload_state(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_upload_state(state_path, state):
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(temp_path, state_path)
 
 
 # Example Usage
@@ -174,10 +361,22 @@ if __name__ == "__main__":
         HOSTNAME = os.getenv("HOSTNAME")
         USERNAME = os.getenv("USERNAME")
         PASSWORD = os.getenv("PASSWORD")
-        FLIP_VIDEO = os.getenv("FLIP_VIDEO", "False").lower() == "true"
+        UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 2))
+        MULTIPART_THRESHOLD = int(os.getenv("MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+        MULTIPART_CHUNKSIZE = int(os.getenv("MULTIPART_CHUNKSIZE", 8 * 1024 * 1024))
+        UPLOAD_BANDWIDTH_KBPS = float(os.getenv("UPLOAD_BANDWIDTH_KBPS", 0))
+        UPLOAD_OFF_PEAK_BANDWIDTH_KBPS = float(os.getenv("UPLOAD_OFF_PEAK_BANDWIDTH_KBPS", 0))
+        UPLOAD_OFF_PEAK_HOURS = os.getenv("UPLOAD_OFF_PEAK_HOURS", "")  # e.g. "22-6"
+        UPLOAD_STATS_FILE = os.getenv("UPLOAD_STATS_FILE")
+        BUSY_SIGNAL_DIR = os.getenv("BUSY_SIGNAL_DIR")
+        RETENTION_MAX_MB = float(os.getenv("RETENTION_MAX_MB", 2048))
+        RETENTION_LOW_WATER_RATIO = float(os.getenv("RETENTION_LOW_WATER_RATIO", 0.8))
+        RETENTION_MIN_FREE_MB = float(os.getenv("RETENTION_MIN_FREE_MB", 512))
+        RETENTION_POLICY = os.getenv("RETENTION_POLICY", "oldest")  # or "keep-denied"
 
     settings = Settings()
     uploader = VideoUploader(settings)
+    profiler.install("upload_to_s3", log=logger)
 
     try:
         asyncio.run(uploader.upload_loop())
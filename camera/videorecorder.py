@@ -1,4 +1,5 @@
-import shutil
+import queue
+import json
 import time
 import asyncio
 import os
@@ -14,6 +15,18 @@ import sentry_sdk
 sys.path.append("/usr/lib/python3/dist-packages")
 import cv2
 
+# Make the modules shared with qr.py importable when running this file as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hardware import load_backend
+import profiler
+from trigger_channel import TriggerListener, socket_path as trigger_socket_path
+from dir_watch import CLOSED, MOVED, OVERFLOW, DirectoryWatcher
+from camera.frame_buffer import FrameRingBuffer
+from camera.capture import FrameCapture, FrameEncoder
+from camera.recording_session import RecordingSession
+from camera.encoders import select_encoder
+from camera.motion import QUALITY_PROFILES, MotionMeter, idle_tail_end, select_profile
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("VideoCamera")
 journal_handler = JournalHandler()
@@ -29,57 +42,121 @@ class VideoCamera:
         self.FRAME_WIDTH = settings.FRAME_WIDTH
         self.FRAME_HEIGHT = settings.FRAME_HEIGHT
         self.FPS = settings.FPS
+        self.FLIP_VIDEO = getattr(settings, "FLIP_VIDEO", False)
+        # "simulated" records synthetic frames, e.g. to profile the recorder off the Pi
+        self.hardware = load_backend(getattr(settings, "HARDWARE_BACKEND", None))
+        self.trigger_listener = TriggerListener(
+            getattr(settings, "TRIGGER_SOCKET", None) or trigger_socket_path(self.RECORDING_DIR)
+        )
 
         # Video recording parameters
-        self.VIDEO_CODEC = "avc1"  # Codec used for recording video
         self.VIDEO_FORMAT = "mp4"  # Final format of the recorded video files
+        # H.264 encoder backend, "auto" uses the Pi's hardware encoder when available, else cv2.VideoWriter
+        self.encoder_class = select_encoder(getattr(settings, "VIDEO_ENCODER", "auto"))
+        logger.info(f"Using the {self.encoder_class.name} video encoder.")
 
         self.RECORDING_DURATION = 6  # Duration to record after trigger (in seconds)
-        self.QR_DATA_CHECK_INTERVAL = 0.2  # Interval to check for QR data (in seconds)
+        # Triggers during a recording extend it, but a single clip never gets longer than this
+        self.MAX_RECORDING_DURATION = getattr(settings, "MAX_RECORDING_DURATION", 30)
+
+        # Optional motion-adaptive clips: end the clip once the scene is still, thin out still
+        # segments and pick the encoder bitrate from the activity seen before the trigger
+        self.MOTION_ADAPTIVE = getattr(settings, "MOTION_ADAPTIVE", False)
+        self.MIN_RECORDING_AFTER_TRIGGER = getattr(settings, "MIN_RECORDING_AFTER_TRIGGER", 2)
+        self.IDLE_TRIM_SECONDS = getattr(settings, "IDLE_TRIM_SECONDS", 1.5)
+        self.STATIC_FRAME_HOLD = getattr(settings, "STATIC_FRAME_HOLD", 3)
+        self.MOTION_CHECK_INTERVAL = 0.25  # Seconds
+        self.motion = MotionMeter(threshold=getattr(settings, "MOTION_THRESHOLD", 0.5)) if self.MOTION_ADAPTIVE else None
+        self.QR_DATA_CHECK_INTERVAL = 0.2  # Interval to check for QR data if inotify is unavailable (in seconds)
+        # record.txt written by the mqtt_receiver, socket triggers from qr.py go through trigger_listener
+        self.trigger_watcher = DirectoryWatcher(self.RECORDING_DIR, poll_interval=self.QR_DATA_CHECK_INTERVAL)
+        self.CAMERA_REOPEN_INTERVAL = 5  # Seconds to wait before reopening a failed camera
+
+        # Pre-roll: the camera stays open and recent frames are kept in memory as JPEGs. A clip
+        # starts PREROLL_SECONDS before the scan, triggers carrying their scan time may arrive up
+        # to MAX_TRIGGER_DELAY seconds late, so that much more is buffered
+        self.PREROLL_SECONDS = getattr(settings, "PREROLL_SECONDS", 2)
+        self.MAX_TRIGGER_DELAY = getattr(settings, "MAX_TRIGGER_DELAY", 1)
+        self.PREROLL_MAX_BYTES = getattr(settings, "PREROLL_MAX_BYTES", 8 * 1024 * 1024)
+        self.preroll = FrameRingBuffer(
+            max_frames=max(int((self.PREROLL_SECONDS + self.MAX_TRIGGER_DELAY) * self.FPS), 1),
+            max_bytes=self.PREROLL_MAX_BYTES,
+        )
+        self.file_scan_times = {}  # uuid -> scan time of the file triggers found by find_trigger
+        # Raw frames waiting for the encoder thread, frames beyond this are dropped
+        self.FRAME_QUEUE_SIZE = getattr(settings, "FRAME_QUEUE_SIZE", self.FPS)
+        self.capture = None
 
         # Recording variables
-        self.recording = False
-        self.recording_start_time = None
-        self.out = None
         self.video = None
-        self.recording_file = None  # Temporary file path for recording
-        self.current_qr_data = None  # Store QR data for filename
+        self.frame_size = None
+        self.camera_reopen_time = 0
+        self.session = None  # RecordingSession of the clip being recorded
+        self.recording_task = None
 
-        # Adjust FPS based on actual camera performance during recording
         self.init_camera()
 
     def init_camera(self):
-        self.video = cv2.VideoCapture(0)
+        """Open the camera. It stays open for the lifetime of the recorder to feed the pre-roll."""
+        self.video = self.hardware.camera(0)
         self.video.set(cv2.CAP_PROP_FRAME_WIDTH, self.FRAME_WIDTH)
         self.video.set(cv2.CAP_PROP_FRAME_HEIGHT, self.FRAME_HEIGHT)
 
-        self.fourcc = cv2.VideoWriter_fourcc(*self.VIDEO_CODEC)
-
-        timestamp = int(time.time())
-        self.recording_file = f"{self.RECORDING_DIR}/temp_{timestamp}_.{self.VIDEO_FORMAT}"
-
         # Check if camera is opened successfully
         if not self.video.isOpened():
             logger.error("Failed to open camera.")
             return
 
-        # Read the first frame to get frame dimensions
-        ret, frame = self.video.read()
+        self.frame_size = (
+            int(self.video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(self.video.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        )
 
+    def open_writer(self, **options):
+        timestamp = int(time.time())
+        recording_file = f"{self.RECORDING_DIR}/temp_{timestamp}_.{self.VIDEO_FORMAT}"
+        return recording_file, self.encoder_class(recording_file, self.FPS, self.frame_size, **options)
+
+    def read_frame(self):
+        """Read one frame from the camera, reopening it if it stopped delivering frames."""
+        if not self.video.isOpened():
+            if time.time() < self.camera_reopen_time:
+                return None
+            self.init_camera()
+        ret, frame = self.video.read()
         if not ret:
-            logger.error("Failed to read frame from camera.")
+            logger.error(f"Failed to read frame from camera. Reopening it in {self.CAMERA_REOPEN_INTERVAL}s.")
             self.video.release()
-            return
-
-        self.out = cv2.VideoWriter(
-            self.recording_file,
-            self.fourcc,
-            self.FPS,
-            (
-                int(self.video.get(cv2.CAP_PROP_FRAME_WIDTH)),
-                int(self.video.get(cv2.CAP_PROP_FRAME_HEIGHT)),
-            ),
+            self.camera_reopen_time = time.time() + self.CAMERA_REOPEN_INTERVAL
+            return None
+        if self.FLIP_VIDEO:
+            # Upside down and mirrored in one pass, so clips never have to be re-encoded before upload
+            frame = cv2.flip(frame, -1)
+        return frame
+
+    async def wait_for_triggers(self):
+        """
+        Wait until qr.py sends triggers over the socket or the mqtt_receiver writes record.txt.
+
+        Returns:
+            tuple[list, bool]: The ``(uuid, reply_address)`` of the socket triggers and whether
+            record.txt was written.
+        """
+        socket_wait = asyncio.ensure_future(self.trigger_listener.wait(None))
+        file_wait = asyncio.ensure_future(self.trigger_watcher.wait(None))
+        try:
+            await asyncio.wait({socket_wait, file_wait}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Cancelling a wait leaves its items queued for the next call
+            for task in (socket_wait, file_wait):
+                if not task.done():
+                    task.cancel()
+        triggers = socket_wait.result() if socket_wait.done() and not socket_wait.cancelled() else []
+        events = file_wait.result() if file_wait.done() and not file_wait.cancelled() else []
+        record_file_written = any(
+            event.kind == OVERFLOW or (event.kind in (CLOSED, MOVED) and event.name == "record.txt") for event in events
         )
+        return triggers, record_file_written
 
     async def find_trigger(self):
         """Check for the existence of the record.txt file to start processing."""
@@ -102,6 +179,9 @@ class VideoCamera:
         for filename in filenames:
             if filename.endswith(".txt"):
                 file_path = os.path.join(self.RECORDING_DIR, filename)
+                scan_time = await self.read_scan_time(file_path)
+                if scan_time is not None:
+                    self.file_scan_times[filename[:-4]] = scan_time
                 try:
                     await aiofiles.os.remove(file_path)  # Asynchronous delete
                 except FileNotFoundError:
@@ -109,22 +189,72 @@ class VideoCamera:
 
         return txt_files
 
+    @staticmethod
+    async def read_scan_time(file_path):
+        """Scan time the mqtt_receiver wrote into a trigger file, None for the empty files of qr.py."""
+        try:
+            async with aiofiles.open(file_path, mode="r") as f:
+                content = await f.read()
+            return float(json.loads(content)["timestamp"]) if content.strip() else None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def trigger_time(self, scan_time, now):
+        """
+        When a trigger happened in local time: its scan time if it carried a plausible one, else `now`.
+
+        Scan times are converted into local time by the mqtt_receiver's clock sync. One from the
+        future is an error of that estimate, one older than the pre-roll buffer is limited to it.
+        """
+        if scan_time is None or scan_time > now:
+            return now
+        return max(scan_time, now - self.PREROLL_SECONDS - self.MAX_TRIGGER_DELAY)
+
     def cleanup(self):
         """Release resources properly on exit."""
+        if self.capture and self.capture.is_alive():
+            self.capture.stop()
         if self.video and self.video.isOpened():
             self.video.release()
-        if self.out:
-            self.out.release()
+        self.hardware.close()
 
     async def run(self, global_qr_data=None, lock=None):
         """Asynchronous method to check for QR data and start recording."""
+        self.remove_stale_recordings()
+        self.trigger_listener.open()
+        self.trigger_watcher.open()
+        # Frames are captured and encoded on threads, this loop only coordinates the triggers
+        self.capture = FrameCapture(
+            self.read_frame, self.FPS, self.preroll, motion=self.motion,
+            static_hold=self.STATIC_FRAME_HOLD if self.motion else 1,
+        )
+        self.capture.start()
         try:
+            record_file_written = True  # record.txt may have been written before the watcher was opened
             while True:
-                filenames = await self.find_trigger()
-                if filenames:
-                    data = {"uuid": filenames[0], "additional_uuids": filenames[1:]}
-                    await self.start_recording(data)
-                await asyncio.sleep(self.QR_DATA_CHECK_INTERVAL)
+                triggers = []
+                if not record_file_written:
+                    triggers, record_file_written = await self.wait_for_triggers()
+                filenames = [uuid for uuid, _ in triggers]
+                if record_file_written:
+                    filenames += await self.find_trigger() or []
+                    record_file_written = False
+                if not filenames:
+                    continue
+                now = time.time()
+                scan_times = {**self.file_scan_times, **self.trigger_listener.scan_times}
+                trigger_times = {uuid: self.trigger_time(scan_times.get(uuid), now) for uuid in filenames}
+                self.file_scan_times.clear()
+                if self.session is None:
+                    self.session = self.start_recording(min(trigger_times.values()))
+                    if self.session is None:
+                        continue
+                else:
+                    logger.info(f"Extending the active recording for {filenames}.")
+                for uuid in filenames:
+                    self.session.add(uuid, trigger_times[uuid])
+                for uuid, address in triggers:
+                    self.trigger_listener.ack(uuid, address)
         except asyncio.CancelledError:
             logger.info("Run loop cancelled.")
             raise
@@ -132,68 +262,122 @@ class VideoCamera:
             logger.exception("Exception in VideoCamera.run")
         finally:
             # Clean up resources when done
+            if self.recording_task:
+                self.recording_task.cancel()
+            self.trigger_listener.close()
+            self.trigger_watcher.close()
             self.cleanup()
 
-    async def start_recording(self, qr_data):
-        """Start video recording."""
-        self.current_qr_data = qr_data  # Store QR data for later use
+    def start_recording(self, trigger_time=None):
+        """
+        Start a new clip beginning with the pre-roll, PREROLL_SECONDS before `trigger_time`.
+
+        Returns:
+            RecordingSession: The session triggers are added to, or None if the camera is unavailable.
+        """
+        if self.frame_size is None:
+            logger.error("Camera was never opened, can't record.")
+            return None
 
         start = time.time()
+        trigger_time = trigger_time or start
+        options = {}
+        if self.motion:
+            profile = select_profile(self.motion.level)
+            options = QUALITY_PROFILES[profile]
+            logger.info(f"Scene activity {self.motion.level:.1f}, recording with the {profile} profile.")
+        recording_file, writer = self.open_writer(**options)
+        preroll_frames = self.preroll.drain(since=trigger_time - self.PREROLL_SECONDS)
+        frame_queue = queue.Queue(maxsize=self.FRAME_QUEUE_SIZE)
+        encoder = FrameEncoder(writer, frame_queue, preroll_frames)
+        encoder.start()
+        self.capture.start_recording(frame_queue)
+
+        clip_start = preroll_frames[0][0] if preroll_frames else start
+        session = RecordingSession(clip_start, self.RECORDING_DURATION, self.MAX_RECORDING_DURATION)
+        self.recording_task = asyncio.create_task(self.record(session, recording_file, encoder, frame_queue))
+        self.recording_task.add_done_callback(self.recording_done)
+        logger.info(
+            f"Started recording {recording_file} with {len(preroll_frames)} pre-roll frames, "
+            f"the trigger was {start - trigger_time:.3f}s ago. "
+            f"Took {time.time() - start:.2f} seconds to init."
+        )
+        return session
 
-        self.recording = True
-        self.recording_start_time = time.time()
-        end_time = self.recording_start_time + self.RECORDING_DURATION
+    def recording_done(self, task):
+        """Log a failed recording and let the next trigger start a new one instead of extending it."""
+        if task.cancelled() or task.exception() is None:
+            if self.recording_task is task:
+                self.recording_task = None
+            return
+        logger.error("Recording failed", exc_info=task.exception())
+        if self.recording_task is task:
+            self.recording_task = None
+            self.session = None
+            self.capture.stop_recording()
+
+    async def record(self, session, recording_file, encoder, frame_queue):
+        """Keep recording until the last trigger of the session is covered, then save the clip."""
+        recording_start_time = time.time()
+        if self.motion:
+            while (remaining := self.clip_end_time(session) - time.time()) > 0:
+                await asyncio.sleep(min(remaining, self.MOTION_CHECK_INTERVAL))
+            trimmed = session.end_time - time.time()
+            if trimmed > 0:
+                session.trim(time.time())
+                logger.info(f"Scene is still, ending the clip {trimmed:.1f}s early.")
+        while (remaining := session.end_time - time.time()) > 0:
+            await asyncio.sleep(remaining)
+
+        # From here on new triggers start a new session
+        self.session = None
+        self.capture.stop_recording()
+        captured_frames, dropped_frames = self.capture.captured_frames, self.capture.dropped_frames
+        if self.capture.held_frames:
+            logger.info(f"Repeated {self.capture.held_frames} frames of still segments.")
+
+        await asyncio.to_thread(self.finish_encoding, encoder, frame_queue)
+
+        elapsed = time.time() - recording_start_time
+        achieved_fps = captured_frames / elapsed if elapsed else 0
+        logger.info(
+            f"Recorded {captured_frames} frames in {elapsed:.2f}s "
+            f"({achieved_fps:.1f} fps of configured {self.FPS}), "
+            f"dropped {dropped_frames}, wrote {encoder.written_frames} incl. pre-roll."
+        )
+        if dropped_frames:
+            logger.warning(f"Encoder fell behind and dropped {dropped_frames} frames.")
 
-        # Record frames for RECORDING_DURATION seconds
-        frame_interval = 1.0 / self.FPS
+        await self.stop_recording(session, recording_file)
 
-        logger.info(
-            f"Started recording: {qr_data.get('uuid')}.{self.VIDEO_FORMAT}. Took {time.time() - start:.2f} seconds to init."
+    def clip_end_time(self, session):
+        """When the clip may end, earlier than the session's end once the scene went still."""
+        idle_end = idle_tail_end(
+            session.last_trigger_time, self.motion.last_motion_time,
+            self.MIN_RECORDING_AFTER_TRIGGER, self.IDLE_TRIM_SECONDS,
         )
-        while time.time() < end_time:
-            frame_start_time = time.time()
-
-            ret, frame = self.video.read()
-            if not ret:
-                logger.error("Failed to read frame from camera.")
-                break
-            self.out.write(frame)
-            # Sleep to maintain FPS
-            elapsed = time.time() - frame_start_time
-            sleep_time = frame_interval - elapsed
-            if sleep_time > 0:
-                await asyncio.sleep(sleep_time)
-        await self.stop_recording()
-        self.init_camera()
+        return min(session.end_time, idle_end)
 
-    async def stop_recording(self):
-        """Stop video recording."""
-        if self.recording:
-            self.out.release()
-            self.video.release()
-            self.out = None
-            self.video = None
-            self.recording = False
-
-            if self.current_qr_data:
-                uuid = self.current_qr_data.get("uuid", "unknown")
-                new_filename = f"{self.RECORDING_DIR}/{uuid}.{self.VIDEO_FORMAT}"
-                os.rename(self.recording_file, new_filename)
-                self.recording_file = new_filename
-                logger.info(f"Recording saved as {new_filename}")
-                if self.current_qr_data.get("additional_uuids"):
-                    for additional_uuid in self.current_qr_data.get("additional_uuids"):
-                        new_filename = f"{self.RECORDING_DIR}/{additional_uuid}.{self.VIDEO_FORMAT}"
-                        shutil.copy(self.recording_file, new_filename)
-                        logger.info(f"Recording saved as {new_filename}")
-                tmp_mp4_files = [f for f in os.listdir(self.RECORDING_DIR) if f.endswith(".mp4") and "temp" in f]
-                for tmp_file in tmp_mp4_files:
-                    os.remove(os.path.join(self.RECORDING_DIR, tmp_file))
-            else:
-                logger.warning("No QR data available to rename the recording file.")
+    def finish_encoding(self, encoder, frame_queue):
+        """Let the encoder drain its queue and release the writer."""
+        try:
+            frame_queue.put(None, timeout=self.RECORDING_DURATION)
+        except queue.Full:
+            logger.error("Encoder is stuck, abandoning the remaining frames.")
+        encoder.join(timeout=self.RECORDING_DURATION)
 
-        else:
-            logger.info("No recording to stop.")
+    async def stop_recording(self, session, recording_file):
+        """Save the finished clip under every uuid of the session. The camera itself stays open."""
+        paths = session.save(recording_file, self.RECORDING_DIR, self.VIDEO_FORMAT)
+        for uuid, path in zip(session.uuids, paths):
+            start, end = session.ranges[uuid]
+            logger.info(f"Recording saved as {path}, covering {start:.1f}s to {end:.1f}s of the clip.")
+
+    def remove_stale_recordings(self):
+        """Remove temp files of recordings that were interrupted by a previous crash or restart."""
+        tmp_mp4_files = [f for f in os.listdir(self.RECORDING_DIR) if f.endswith(".mp4") and "temp" in f]
+        for tmp_file in tmp_mp4_files:
+            os.remove(os.path.join(self.RECORDING_DIR, tmp_file))
 
 
 def read_and_delete_multi_process_qr_data(global_qr_data, lock):
@@ -291,5 +475,18 @@ if __name__ == "__main__":
         FRAME_WIDTH = int(os.getenv("FRAME_WIDTH"))
         FRAME_HEIGHT = int(os.getenv("FRAME_HEIGHT"))
         FPS = int(os.getenv("FPS"))
-
+        PREROLL_SECONDS = float(os.getenv("PREROLL_SECONDS", 2))
+        MAX_TRIGGER_DELAY = float(os.getenv("MAX_TRIGGER_DELAY", 1))
+        PREROLL_MAX_BYTES = int(os.getenv("PREROLL_MAX_BYTES", 8 * 1024 * 1024))
+        MAX_RECORDING_DURATION = float(os.getenv("MAX_RECORDING_DURATION", 30))
+        VIDEO_ENCODER = os.getenv("VIDEO_ENCODER", "auto")
+        HARDWARE_BACKEND = os.getenv("HARDWARE_BACKEND", "real")
+        FLIP_VIDEO = os.getenv("FLIP_VIDEO", "False").lower() == "true"
+        MOTION_ADAPTIVE = os.getenv("MOTION_ADAPTIVE", "False").lower() == "true"
+        MOTION_THRESHOLD = float(os.getenv("MOTION_THRESHOLD", 0.5))
+        MIN_RECORDING_AFTER_TRIGGER = float(os.getenv("MIN_RECORDING_AFTER_TRIGGER", 2))
+        IDLE_TRIM_SECONDS = float(os.getenv("IDLE_TRIM_SECONDS", 1.5))
+        STATIC_FRAME_HOLD = int(os.getenv("STATIC_FRAME_HOLD", 3))
+
+    profiler.install("videorecorder", log=logger)
     run_camera(CameraSettings())
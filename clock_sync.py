@@ -0,0 +1,208 @@
+"""
+Clock offset estimation between the devices exchanging triggers over MQTT.
+
+Trigger timestamps are taken on the scanner's device while the recorder selects frames by its
+own clock. The receiver on the camera device therefore asks every trigger source for its time,
+NTP style, and converts scan times into its own clock before handing triggers to the recorder.
+
+A request carries the client's send time t0. The source notes when it received it (t1) and
+when it replied (t2), the client notes when the reply arrived (t3). Then
+
+    offset = ((t1 - t0) + (t2 - t3)) / 2    # source clock minus client clock
+    delay = (t3 - t0) - (t2 - t1)           # network round trip
+
+Of the last samples, the one with the smallest delay gives the offset, as its error is bounded
+by half its delay. The spread of the offsets is reported as jitter.
+"""
+import collections
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+CLOCK_TOPIC = "turnstile/clock"
+REQUEST_TOPIC = f"{CLOCK_TOPIC}/request"
+
+logger = logging.getLogger("clock_sync")
+
+Sample = collections.namedtuple("Sample", ["offset", "delay"])
+
+
+def reply_topic(node_id):
+    return f"{CLOCK_TOPIC}/reply/{node_id}"
+
+
+def default_node_id():
+    """Name of this device on the broker: MQTT_NODE_ID, else the hostname."""
+    return os.getenv("MQTT_NODE_ID") or socket.gethostname()
+
+
+def wall_time(monotonic_time):
+    """
+    Wall-clock time of a `time.monotonic()` reading.
+
+    Taking the moment of a scan from the monotonic clock and converting it when the trigger is
+    sent keeps it right even if NTP steps the wall clock in between.
+    """
+    return time.time() - (time.monotonic() - monotonic_time)
+
+
+class OffsetEstimator:
+    """
+    Offset of one remote clock from the local one, from the last `window` samples.
+
+    Args:
+        window (int): Samples kept.
+        max_delay (float): Samples with a longer round trip in seconds are discarded.
+    """
+
+    def __init__(self, window=16, max_delay=0.5):
+        self.samples = collections.deque(maxlen=window)
+        self.max_delay = max_delay
+        self.rejected = 0
+
+    def add(self, t0, t1, t2, t3):
+        """Add the timestamps of one exchange, returns the Sample or None if it was rejected."""
+        delay = (t3 - t0) - (t2 - t1)
+        if delay < 0 or delay > self.max_delay:
+            self.rejected += 1
+            return None
+        sample = Sample(((t1 - t0) + (t2 - t3)) / 2, delay)
+        self.samples.append(sample)
+        return sample
+
+    @property
+    def best(self):
+        return min(self.samples, key=lambda sample: sample.delay) if self.samples else None
+
+    @property
+    def offset(self):
+        """Remote minus local clock in seconds, None without samples."""
+        best = self.best
+        return best.offset if best else None
+
+    @property
+    def jitter(self):
+        """Root mean square deviation of the sampled offsets from `offset`."""
+        if len(self.samples) < 2:
+            return None
+        offset = self.offset
+        return math.sqrt(sum((sample.offset - offset) ** 2 for sample in self.samples) / (len(self.samples) - 1))
+
+    def to_local(self, remote_time):
+        """Convert a remote timestamp into local time, unchanged while there is no estimate."""
+        offset = self.offset
+        return remote_time if offset is None else remote_time - offset
+
+    def stats(self):
+        best = self.best
+        jitter = self.jitter
+        return {
+            "offset_ms": round(best.offset * 1000, 3) if best else None,
+            "delay_ms": round(best.delay * 1000, 3) if best else None,
+            "jitter_ms": round(jitter * 1000, 3) if jitter is not None else None,
+            "samples": len(self.samples),
+            "rejected": self.rejected,
+        }
+
+
+class ClockSyncClient:
+    """
+    Receiver side: sends requests to every source and keeps an OffsetEstimator per source node.
+
+    Sources are identified by their node id, carried in the clock replies and binary triggers,
+    as several devices may publish to the same topic (e.g. the legacy default). Triggers without
+    a node, like the legacy JSON ones, fall back to the node answering for their topic, as long
+    as only one does. Safe to use from paho's network thread and another thread sending the requests.
+
+    Args:
+        node_id (str): Unique name of this node, replies come back on `reply_topic(node_id)`.
+        window (int): Samples per source, see OffsetEstimator.
+        max_delay (float): Round trips in seconds beyond which samples are discarded.
+    """
+
+    def __init__(self, node_id, window=16, max_delay=0.5, clock=time.time):
+        self.node_id = node_id
+        self.clock = clock
+        self.window = window
+        self.max_delay = max_delay
+        self.estimators = {}  # source node -> OffsetEstimator
+        self.topic_nodes = collections.defaultdict(set)  # source topic -> nodes publishing to it
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def request(self):
+        """Payload of the next request, publish it to REQUEST_TOPIC right away."""
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        return json.dumps({"node": self.node_id, "seq": sequence, "t0": self.clock()}).encode()
+
+    def handle_reply(self, payload, received=None):
+        """Process a reply, `received` is when it arrived. Returns the source node and its Sample."""
+        t3 = received if received is not None else self.clock()
+        try:
+            reply = json.loads(payload)
+            node, source, t0, t1, t2 = reply["node"], reply["source"], reply["t0"], reply["t1"], reply["t2"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Ignoring invalid clock reply: {payload[:100]!r}")
+            return None, None
+        with self._lock:
+            self.topic_nodes[source].add(node)
+            estimator = self.estimators.get(node)
+            if estimator is None:
+                estimator = self.estimators[node] = OffsetEstimator(self.window, self.max_delay)
+            return node, estimator.add(t0, t1, t2, t3)
+
+    def to_local(self, remote_time, node=None, topic=None):
+        """
+        Convert a timestamp of source `node` into local time.
+
+        Without a node, the single node answering for `topic` is assumed. The timestamp stays
+        unchanged while the offset is unknown or the topic is shared by several nodes.
+        """
+        with self._lock:
+            if node is None:
+                nodes = self.topic_nodes.get(topic, ())
+                if len(nodes) != 1:
+                    return remote_time
+                (node,) = nodes
+            estimator = self.estimators.get(node)
+            return estimator.to_local(remote_time) if estimator else remote_time
+
+    def stats(self):
+        with self._lock:
+            return {node: estimator.stats() for node, estimator in self.estimators.items()}
+
+
+class ClockSyncResponder:
+    """
+    Source side: answers the requests of every receiver.
+
+    Args:
+        source (str): Topic this node publishes its triggers to.
+        send (callable): ``send(topic, payload)`` publishing right away without queueing, e.g.
+            `MqttPublisher.publish_now`. A reply that waited in a queue would distort the sample.
+        node_id (str): Node id the triggers of this node carry, `default_node_id()` by default.
+    """
+
+    def __init__(self, source, send, node_id=None, clock=time.time):
+        self.source = source
+        self.send = send
+        self.node_id = node_id or default_node_id()
+        self.clock = clock
+        self.replies = 0
+
+    def handle_request(self, topic, payload, received):
+        try:
+            request = json.loads(payload)
+            node_id, sequence, t0 = request["node"], request["seq"], request["t0"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Ignoring invalid clock request: {payload[:100]!r}")
+            return
+        reply = {"node": self.node_id, "source": self.source, "seq": sequence, "t0": t0, "t1": received, "t2": self.clock()}
+        if self.send(reply_topic(node_id), json.dumps(reply).encode()):
+            self.replies += 1
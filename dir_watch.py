@@ -0,0 +1,162 @@
+"""
+Event-driven watching of a directory for the services that exchange files through RECORDING_DIR.
+
+On Linux the kernel's inotify API reports new files as they appear, so waiting for one costs no
+wakeups at all. Where inotify isn't available (other platforms, exhausted watch limits) the
+directory is polled instead and the same events are derived from snapshots of it.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+from collections import namedtuple
+
+CREATED = "created"
+CLOSED = "closed"  # a file opened for writing was closed, i.e. its content is complete
+MOVED = "moved"  # a file was renamed into the directory
+OVERFLOW = "overflow"  # events were lost, consumers have to rescan the directory
+
+DirEvent = namedtuple("DirEvent", ["kind", "name"])
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+READ_SIZE = 64 * 1024
+
+logger = logging.getLogger("dir_watch")
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, "inotify_init1") or not hasattr(libc, "inotify_add_watch"):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+class DirectoryWatcher:
+    """
+    Reports files that are created, finished or moved into `path`. Must be opened from within a running event loop.
+
+    Files that already exist when the watcher is opened are not reported, consumers scan the
+    directory once after opening it.
+
+    Args:
+        path (str): Directory to watch.
+        poll_interval (float): Seconds between directory snapshots when inotify is unavailable.
+        use_inotify (bool): Set to False to force the polling fallback.
+    """
+
+    def __init__(self, path, poll_interval=1.0, use_inotify=True):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and _libc is not None
+        self._fd = None
+        self._poll_task = None
+        self._queue = None
+
+    @property
+    def backend(self):
+        return "inotify" if self._fd is not None else "polling"
+
+    def open(self):
+        self._queue = asyncio.Queue()
+        if self.use_inotify:
+            try:
+                self._fd = self._add_inotify_watch()
+                asyncio.get_running_loop().add_reader(self._fd, self._on_readable)
+            except OSError as e:
+                logger.warning(f"inotify unavailable for {self.path} ({e}), polling every {self.poll_interval}s.")
+                self._fd = None
+        if self._fd is None:
+            self._poll_task = asyncio.ensure_future(self._poll())
+        logger.info(f"Watching {self.path} using {self.backend}.")
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self._fd)
+            except RuntimeError:
+                pass  # loop already closed
+            os.close(self._fd)
+            self._fd = None
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+
+    async def wait(self, timeout=None):
+        """
+        Wait up to `timeout` seconds, or indefinitely if it is None, for events.
+
+        Returns:
+            list[DirEvent]: Every event received so far, empty if none arrived in time.
+        """
+        try:
+            first = await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        events = [first]
+        while not self._queue.empty():
+            events.append(self._queue.get_nowait())
+        return events
+
+    def _add_inotify_watch(self):
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        if _libc.inotify_add_watch(fd, os.fsencode(self.path), IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, os.strerror(errno))
+        return fd
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset: offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self._queue.put_nowait(DirEvent(OVERFLOW, None))
+            elif mask & IN_CREATE:
+                self._queue.put_nowait(DirEvent(CREATED, name))
+            elif mask & IN_CLOSE_WRITE:
+                self._queue.put_nowait(DirEvent(CLOSED, name))
+            elif mask & IN_MOVED_TO:
+                self._queue.put_nowait(DirEvent(MOVED, name))
+
+    def _list(self):
+        try:
+            return set(os.listdir(self.path))
+        except FileNotFoundError:
+            return set()
+
+    async def _poll(self):
+        # Only names are compared to keep polling cheap. That can't tell a finished file from one
+        # still being written, so new files are reported as created and closed at once.
+        previous = self._list()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            current = self._list()
+            for name in current - previous:
+                self._queue.put_nowait(DirEvent(CREATED, name))
+                self._queue.put_nowait(DirEvent(CLOSED, name))
+            previous = current
@@ -6,42 +6,30 @@ import time
 import requests
 from dotenv import load_dotenv
 
+from utils import TokenManager
+
 load_dotenv(override=True)
 
 HOSTNAME = os.getenv("HOSTNAME")
 USERNAME = os.getenv("USERNAME")
 PASSWORD = os.getenv("PASSWORD")
-jwt_token = None  # Initializing the jwt_token variable
 
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("download_customer_db")
 
 
-def login():
-    global jwt_token
-    if jwt_token:
-        return jwt_token
-
-    url = f"{HOSTNAME}/api/token/"
-    payload = json.dumps({"email": USERNAME, "password": PASSWORD})
-    headers = {"Content-Type": "application/json"}
+def post_token_request(url, headers, payload):
+    return make_request("POST", url, headers, json.dumps(payload))
 
-    response = make_request("POST", url, headers, payload)  # Specify the method as "POST"
-    if response is None or response.status_code != 200:
-        log_unsuccessful_request(response)
-        return None
 
-    jwt_token = response.json().get("access", None)
-    return jwt_token
+token_manager = TokenManager(HOSTNAME, USERNAME, PASSWORD, logger, post_request=post_token_request)
 
 
 def get_customers():
-    global jwt_token
-
+    jwt_token = token_manager.get_token()
     if jwt_token is None:
-        jwt_token = login()
-        if jwt_token is None:
-            logging.error("Could not get JWT token.")
-            return None
+        logging.error("Could not get JWT token.")
+        return None
 
     url = f"{HOSTNAME}/customers/"
     headers = {
@@ -50,6 +38,14 @@ def get_customers():
     }
 
     response = make_request("GET", url, headers=headers)
+    if response is not None and response.status_code in (401, 403):
+        logging.warning(f"Token rejected with status {response.status_code}. Refreshing and retrying...")
+        jwt_token = token_manager.refresh()
+        if jwt_token is None:
+            logging.error("Could not renew the rejected JWT token.")
+            return None
+        headers["Authorization"] = f"Bearer {jwt_token}"
+        response = make_request("GET", url, headers=headers)
     if response is None or response.status_code != 200:
         log_unsuccessful_request(response)
         return None
@@ -93,6 +89,7 @@ def log_unsuccessful_request(response):
 
 if __name__ == "__main__":
     customers = get_customers()
+    token_manager.stop()
     if customers is not None:
         # get the directory of the current script
         dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -0,0 +1,38 @@
+"""
+Access to the devices of a turnstile: GPIO, the I2C LCD, the QR scanners and the camera.
+
+Services get their devices from a backend instead of importing RPi.GPIO, rpi_lcd, evdev,
+serial or cv2 themselves. The "real" backend hands out the actual devices and imports their
+libraries only when a device is requested. The "simulated" backend runs anywhere and records
+the timing of every device, so the services can be profiled and load tested off the Pi.
+
+HARDWARE_BACKEND selects the backend, "real" by default. The simulated backend reads
+HARDWARE_SCANNER_SCRIPT (JSON lines ``{"at": seconds, "data": "raw scanner line"}`` played
+back by every scanner once it is opened) and writes its timing report to HARDWARE_TRACE on close.
+"""
+import os
+
+from hardware.real import RealBackend
+from hardware.simulated import SimulatedBackend
+
+REAL = "real"
+SIMULATED = "simulated"
+BACKENDS = (REAL, SIMULATED)
+
+
+def load_backend(name=None):
+    """
+    Create the backend `name`, or the one HARDWARE_BACKEND selects.
+
+    Raises:
+        ValueError: For an unknown backend.
+    """
+    name = (name or os.getenv("HARDWARE_BACKEND") or REAL).lower()
+    if name == REAL:
+        return RealBackend()
+    if name == SIMULATED:
+        return SimulatedBackend(
+            scanner_script=os.getenv("HARDWARE_SCANNER_SCRIPT"),
+            trace_path=os.getenv("HARDWARE_TRACE"),
+        )
+    raise ValueError(f"Unknown hardware backend {name!r}, expected one of {list(BACKENDS)}")
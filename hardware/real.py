@@ -0,0 +1,64 @@
+import sys
+
+
+class RealBackend:
+    """The devices of the Pi. Every library is imported on the first request of its device."""
+
+    name = "real"
+    # evdev.ecodes.EV_KEY and evdev.KeyEvent.key_up, known without importing evdev
+    EV_KEY = 1
+    KEY_UP = 0
+
+    def gpio(self):
+        import RPi.GPIO as GPIO
+
+        return GPIO
+
+    def lcd(self, address):
+        from rpi_lcd import LCD
+
+        return LCD(address)
+
+    def serial_scanner(self, path, timeout=0.2, baudrate=9600):
+        import serial
+
+        return serial.Serial(path, baudrate=baudrate, timeout=timeout)
+
+    def keyboard_scanner(self, path):
+        from evdev import InputDevice
+
+        return InputDevice(path)
+
+    def categorize(self, event):
+        from evdev import categorize
+
+        return categorize(event)
+
+    def find_serial_scanners(self):
+        from serial_reader import find_serial_devices
+
+        return find_serial_devices()
+
+    def find_keyboard_scanners(self):
+        from find_device import find_qr_devices
+
+        return find_qr_devices()
+
+    def detect_lcd_address(self, bus):
+        """Address of an LCD other than the default 0x27 on `bus`. Raises ImportError without smbus2."""
+        from i2cdetect import detect_i2c_device_not_27
+
+        return detect_i2c_device_not_27(bus)
+
+    def camera(self, index=0):
+        # The global Python library path holds the cv2 built for the Pi
+        sys.path.append("/usr/lib/python3/dist-packages")
+        import cv2
+
+        return cv2.VideoCapture(index)
+
+    def report(self):
+        return {"backend": self.name}
+
+    def close(self):
+        pass
@@ -0,0 +1,460 @@
+import asyncio
+import collections
+import json
+import threading
+import time
+
+from keymap import KEYMAP
+
+EV_KEY = 1
+KEY_UP, KEY_DOWN = 0, 1
+KEYCODES = {character: keycode for keycode, character in KEYMAP.items() if character}
+SERIAL_SCANNER_PATH = "/dev/simulated-serial0"
+KEYBOARD_SCANNER_PATH = "/dev/input/simulated0"
+
+InputEvent = collections.namedtuple("InputEvent", ["type", "code", "value", "time"])
+KeyEvent = collections.namedtuple("KeyEvent", ["keycode", "keystate", "event"])
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else None
+
+
+def _milliseconds(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+class SimulatedGPIO:
+    """Stands in for the RPi.GPIO module and keeps a trace of every output write."""
+
+    BCM, BOARD = 11, 10
+    OUT, IN = 0, 1
+    LOW, HIGH = 0, 1
+    PUD_OFF, PUD_DOWN, PUD_UP = 20, 21, 22
+
+    def __init__(self, history_size=10000):
+        self.mode = None
+        self.directions = {}  # pin -> OUT or IN
+        self.levels = {}
+        self.trace = collections.deque(maxlen=history_size)  # (time.perf_counter(), pin, level)
+        self._lock = threading.Lock()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        self.directions[pin] = direction
+        if initial is not None:
+            self.output(pin, initial)
+
+    def output(self, pin, level):
+        if self.directions.get(pin) != self.OUT:
+            # Like RPi.GPIO, so a missing setup shows up off the Pi as well
+            raise RuntimeError(f"The GPIO channel {pin} has not been set up as an OUTPUT")
+        with self._lock:
+            self.levels[pin] = level
+            self.trace.append((time.perf_counter(), pin, level))
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def set_input(self, pin, level):
+        """Drive an input pin from the outside, e.g. a door contact."""
+        self.levels[pin] = level
+
+    def cleanup(self, pin=None):
+        for cleaned in [pin] if pin is not None else list(self.directions):
+            self.directions.pop(cleaned, None)
+            self.levels.pop(cleaned, None)
+
+    def report(self):
+        with self._lock:
+            trace = list(self.trace)
+        pins, high_since = {}, {}
+        for written, pin, level in trace:
+            stats = pins.setdefault(pin, {"writes": 0, "high_writes": 0, "high_seconds": 0.0})
+            stats["writes"] += 1
+            if pin in high_since:
+                stats["high_seconds"] += written - high_since.pop(pin)
+            if level == self.HIGH:
+                stats["high_writes"] += 1
+                high_since[pin] = written
+        now = time.perf_counter()
+        for pin, since in high_since.items():
+            pins[pin]["high_seconds"] += now - since
+        for stats in pins.values():
+            stats["high_seconds"] = round(stats["high_seconds"], 4)
+        return pins
+
+
+class SimulatedLCD:
+    """
+    HD44780 character LCD on a PCF8574 I2C backpack, driven like rpi_lcd.LCD, with a framebuffer.
+
+    The cost model follows rpi_lcd: every byte goes out as two 4-bit nibbles of three I2C writes
+    each (data, enable high, enable low), followed by 0.6 ms of sleeps per nibble. An I2C write of
+    start, address, data and stop takes about 20 bit times. `text` sends a command and a full
+    line of characters, `clear` a command the controller needs another 1.52 ms to execute.
+
+    Args:
+        realtime (bool): Block the caller for the modelled time like the real display does.
+    """
+
+    I2C_WRITES_PER_BYTE = 6
+    BITS_PER_I2C_WRITE = 20
+    STROBE_SECONDS_PER_BYTE = 0.0012
+    CLEAR_SECONDS = 0.00152
+
+    def __init__(self, address=0x27, width=16, rows=2, i2c_hz=100_000, realtime=True, history_size=1000):
+        self.address = address
+        self.width = width
+        self.i2c_hz = i2c_hz
+        self.realtime = realtime
+        self.rows = [" " * width] * rows
+        self.frames = collections.deque(maxlen=history_size)  # (time.perf_counter(), rows) after every change
+        self.i2c_writes = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()  # one I2C transfer at a time, like the bus
+
+    @property
+    def byte_seconds(self):
+        return self.I2C_WRITES_PER_BYTE * self.BITS_PER_I2C_WRITE / self.i2c_hz + self.STROBE_SECONDS_PER_BYTE
+
+    def text(self, text, line, align="left"):
+        if not 1 <= line <= len(self.rows):
+            raise ValueError(f"Line {line} doesn't exist on a display with {len(self.rows)} rows")
+        justify = {"left": str.ljust, "right": str.rjust, "center": str.center}[align]
+        with self._lock:
+            self._transfer(1 + self.width)
+            self.rows[line - 1] = justify(text[: self.width], self.width)
+            self.frames.append((time.perf_counter(), tuple(self.rows)))
+
+    def clear(self):
+        with self._lock:
+            self._transfer(1, extra_seconds=self.CLEAR_SECONDS)
+            self.rows = [" " * self.width] * len(self.rows)
+            self.frames.append((time.perf_counter(), tuple(self.rows)))
+
+    def _transfer(self, byte_count, extra_seconds=0.0):
+        seconds = byte_count * self.byte_seconds + extra_seconds
+        self.i2c_writes += byte_count * self.I2C_WRITES_PER_BYTE
+        self.busy_seconds += seconds
+        if self.realtime:
+            time.sleep(seconds)
+
+    def report(self):
+        return {
+            "rows": list(self.rows),
+            "frames": len(self.frames),
+            "i2c_writes": self.i2c_writes,
+            "busy_seconds": round(self.busy_seconds, 4),
+        }
+
+
+class SimulatedScanner:
+    """
+    A QR scanner fed by `feed` or by a script, readable as a serial port or as a keyboard.
+
+    Args:
+        script (list[tuple[float, str]]): ``(seconds after the first open, raw line)`` to play back.
+    """
+
+    def __init__(self, path, script=None):
+        self.path = path
+        self.script = script or []
+        self.deliveries = collections.deque(maxlen=10000)  # (arrived, delivered, line), time.perf_counter()
+        self._lines = collections.deque()  # (arrived, line)
+        self._condition = threading.Condition()
+        self._wakeups = set()  # callables notifying asynchronous readers
+        self._playback = None
+
+    def open(self):
+        with self._condition:
+            if self.script and self._playback is None:
+                self._playback = threading.Thread(target=self._play, args=(time.perf_counter(),), daemon=True)
+                self._playback.start()
+
+    def feed(self, line):
+        """A code is scanned now."""
+        with self._condition:
+            self._lines.append((time.perf_counter(), line))
+            self._condition.notify_all()
+            wakeups = list(self._wakeups)
+        for wakeup in wakeups:
+            wakeup()
+
+    def take(self, timeout=0):
+        """The oldest unread line as ``(arrived, line)``, waiting up to `timeout` seconds, else None."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._lines, timeout):
+                return None
+            return self._lines.popleft()
+
+    def pending_bytes(self):
+        with self._condition:
+            return sum(len(line) + 2 for _, line in self._lines)
+
+    def discard(self):
+        with self._condition:
+            self._lines.clear()
+
+    def delivered(self, arrived, line):
+        self.deliveries.append((arrived, time.perf_counter(), line))
+
+    def add_wakeup(self, wakeup):
+        with self._condition:
+            self._wakeups.add(wakeup)
+
+    def remove_wakeup(self, wakeup):
+        with self._condition:
+            self._wakeups.discard(wakeup)
+
+    def _play(self, start):
+        for offset, line in self.script:
+            time.sleep(max(start + offset - time.perf_counter(), 0))
+            self.feed(line)
+
+    def report(self):
+        lags = [delivered - arrived for arrived, delivered, _ in self.deliveries]
+        return {
+            "scans": len(lags),
+            "input_lag_p50_ms": _milliseconds(_percentile(lags, 0.5)),
+            "input_lag_max_ms": _milliseconds(max(lags, default=None)),
+        }
+
+
+class SimulatedSerial:
+    """The part of serial.Serial the readers use, on a SimulatedScanner sending CR LF terminated lines."""
+
+    def __init__(self, scanner, timeout=0.2):
+        self.scanner = scanner
+        self.timeout = timeout
+        self.is_open = True
+        scanner.open()
+
+    @property
+    def in_waiting(self):
+        return self.scanner.pending_bytes()
+
+    def readline(self):
+        taken = self.scanner.take(self.timeout)
+        if taken is None:
+            return b""
+        arrived, line = taken
+        self.scanner.delivered(arrived, line)
+        return (line + "\r\n").encode()
+
+    def reset_input_buffer(self):
+        self.scanner.discard()
+
+    flushInput = reset_input_buffer
+
+    def close(self):
+        self.is_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SimulatedKeyboard:
+    """The part of evdev.InputDevice the readers use, typing every line of a SimulatedScanner."""
+
+    def __init__(self, scanner):
+        self.scanner = scanner
+        self.path = scanner.path
+        scanner.open()
+
+    async def async_read_loop(self):
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+
+        def wake():
+            loop.call_soon_threadsafe(wakeup.set)
+
+        self.scanner.add_wakeup(wake)
+        try:
+            while True:
+                taken = self.scanner.take()
+                if taken is None:
+                    await wakeup.wait()
+                    wakeup.clear()
+                    continue
+                arrived, line = taken
+                # Characters a keyboard scanner can't type are lost, like on the real device
+                keycodes = [KEYCODES[character] for character in line if character in KEYCODES] + ["KEY_ENTER"]
+                for keycode in keycodes:
+                    yield InputEvent(EV_KEY, keycode, KEY_DOWN, arrived)
+                    if keycode == "KEY_ENTER":
+                        self.scanner.delivered(arrived, line)
+                    yield InputEvent(EV_KEY, keycode, KEY_UP, arrived)
+        finally:
+            self.scanner.remove_wakeup(wake)
+
+    def close(self):
+        pass
+
+
+class SimulatedCamera:
+    """
+    Synthetic frames delivered at the camera's frame rate, see camera.synthetic.SyntheticFrameSource.
+
+    A camera keeps capturing while nobody reads, so a late `read` returns right away and the
+    frames missed in between count as dropped.
+    """
+
+    def __init__(self, width=640, height=480, fps=30, realtime=True, **synthetic_options):
+        from camera.synthetic import SyntheticFrameSource, cv2
+
+        self._cv2 = cv2
+        self._source_class = SyntheticFrameSource
+        self._options = synthetic_options
+        self.fps = fps
+        self.realtime = realtime
+        self.source = SyntheticFrameSource(width, height, **synthetic_options)
+        self.frame_times = collections.deque(maxlen=10000)  # time.perf_counter() of every frame read
+        self.dropped = 0
+        self._next_frame = None
+
+    def isOpened(self):
+        return self.source.isOpened()
+
+    def set(self, prop, value):
+        if prop == self._cv2.CAP_PROP_FPS:
+            self.fps = value
+            return True
+        if prop in (self._cv2.CAP_PROP_FRAME_WIDTH, self._cv2.CAP_PROP_FRAME_HEIGHT):
+            width, height = self.source.width, self.source.height
+            if prop == self._cv2.CAP_PROP_FRAME_WIDTH:
+                width = int(value)
+            else:
+                height = int(value)
+            self.source = self._source_class(width, height, **self._options)
+            return True
+        return False
+
+    def get(self, prop):
+        if prop == self._cv2.CAP_PROP_FPS:
+            return self.fps
+        return self.source.get(prop)
+
+    def read(self):
+        if self.realtime:
+            now = time.perf_counter()
+            period = 1 / self.fps
+            if self._next_frame is None:
+                self._next_frame = now
+            elif now > self._next_frame + period:
+                missed = int((now - self._next_frame) / period)
+                self.dropped += missed
+                self._next_frame += missed * period
+            time.sleep(max(self._next_frame - now, 0))
+            self._next_frame += period
+        ret, frame = self.source.read()
+        if ret:
+            self.frame_times.append(time.perf_counter())
+        return ret, frame
+
+    def release(self):
+        self.source.release()
+
+    def report(self):
+        times = list(self.frame_times)
+        span = times[-1] - times[0] if len(times) > 1 else None
+        return {
+            "frames": len(times),
+            "dropped": self.dropped,
+            "fps": round((len(times) - 1) / span, 2) if span else None,
+        }
+
+
+def load_script(path):
+    """Scanner script of JSON lines ``{"at": seconds, "data": "raw scanner line"}``."""
+    script = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                script.append((float(entry["at"]), entry["data"]))
+    return sorted(script)
+
+
+class SimulatedBackend:
+    """
+    Devices that run anywhere and record their timing, see `report`.
+
+    Args:
+        scanner_script (str): Script every scanner plays back once opened, see `load_script`.
+        trace_path (str): Where `close` writes the report as JSON.
+        realtime (bool): Let the LCD and the camera take as long as the real ones.
+    """
+
+    name = "simulated"
+    EV_KEY = EV_KEY
+    KEY_UP = KEY_UP
+
+    def __init__(self, scanner_script=None, trace_path=None, realtime=True):
+        self.script = load_script(scanner_script) if scanner_script else None
+        self.trace_path = trace_path
+        self.realtime = realtime
+        self._gpio = SimulatedGPIO()
+        self.lcds = {}  # address -> SimulatedLCD
+        self.scanners = {}  # path -> SimulatedScanner
+        self.cameras = []
+
+    def gpio(self):
+        return self._gpio
+
+    def lcd(self, address):
+        # The same display every time, e.g. lcd_controller re-creates its LCD after dark mode
+        if address not in self.lcds:
+            self.lcds[address] = SimulatedLCD(address, realtime=self.realtime)
+        return self.lcds[address]
+
+    def scanner(self, path):
+        if path not in self.scanners:
+            self.scanners[path] = SimulatedScanner(path, self.script)
+        return self.scanners[path]
+
+    def serial_scanner(self, path, timeout=0.2, baudrate=9600):
+        return SimulatedSerial(self.scanner(path), timeout)
+
+    def keyboard_scanner(self, path):
+        return SimulatedKeyboard(self.scanner(path))
+
+    def categorize(self, event):
+        return KeyEvent(event.code, event.value, event)
+
+    def find_serial_scanners(self):
+        return [self.scanner(SERIAL_SCANNER_PATH)]
+
+    def find_keyboard_scanners(self):
+        return [self.scanner(KEYBOARD_SCANNER_PATH)]
+
+    def detect_lcd_address(self, bus):
+        return "0x26"
+
+    def camera(self, index=0):
+        camera = SimulatedCamera(realtime=self.realtime)
+        self.cameras.append(camera)
+        return camera
+
+    def report(self):
+        return {
+            "backend": self.name,
+            "gpio": self._gpio.report(),
+            "lcd": {hex(address) if isinstance(address, int) else str(address): lcd.report() for address, lcd in self.lcds.items()},
+            "scanners": {path: scanner.report() for path, scanner in self.scanners.items()},
+            "cameras": [camera.report() for camera in self.cameras],
+        }
+
+    def close(self):
+        if self.trace_path:
+            with open(self.trace_path, "w") as f:
+                json.dump(self.report(), f, indent=2)
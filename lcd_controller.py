@@ -1,11 +1,11 @@
 import logging
 import threading
 import time
-import RPi.GPIO as GPIO
 
-from rpi_lcd import LCD
 from unidecode import unidecode
 
+from hardware import load_backend
+
 
 class LCDController:
     def __init__(
@@ -16,23 +16,26 @@ class LCDController:
         lcd_address=None,
         dark_mode=False,
         relay_pin=None,
-        relay_trigger="HIGH"
+        relay_trigger="HIGH",
+        hardware=None,
     ):
         self.use_lcd = use_lcd
         self.max_char_count = max_char_count
         self.scroll_delay = scroll_delay
         self.lcd_address = lcd_address
+        self.hardware = hardware or load_backend()
+        self.gpio = self.hardware.gpio()
         if use_lcd:
-            self.lcd = LCD(lcd_address)
+            self.lcd = self.hardware.lcd(lcd_address)
         self.dark_mode = dark_mode
-        self.on_trigger = GPIO.HIGH if relay_trigger == "HIGH" else GPIO.LOW
-        self.off_trigger = GPIO.LOW if relay_trigger == "HIGH" else GPIO.HIGH
+        self.on_trigger = self.gpio.HIGH if relay_trigger == "HIGH" else self.gpio.LOW
+        self.off_trigger = self.gpio.LOW if relay_trigger == "HIGH" else self.gpio.HIGH
         if dark_mode and relay_pin:
             self.relay_pin = relay_pin
-            GPIO.setup(relay_pin, GPIO.OUT)
-            GPIO.output(relay_pin, self.on_trigger)
+            self.gpio.setup(relay_pin, self.gpio.OUT)
+            self.gpio.output(relay_pin, self.on_trigger)
             time.sleep(0.5)
-            GPIO.output(relay_pin, self.off_trigger)
+            self.gpio.output(relay_pin, self.off_trigger)
 
     def clear(self):
         if self.use_lcd:
@@ -54,7 +57,7 @@ class LCDController:
             return
 
         if self.dark_mode and self.relay_pin:
-            GPIO.output(self.relay_pin, self.on_trigger)
+            self.gpio.output(self.relay_pin, self.on_trigger)
 
         if not self.use_lcd:
             logging.info(line1)
@@ -73,8 +76,8 @@ class LCDController:
                 time.sleep(timeout - self.scroll_delay)
                 self.lcd.clear()
                 if self.dark_mode and self.relay_pin:
-                    GPIO.output(self.relay_pin, self.off_trigger)
-                    self.lcd = LCD(self.lcd_address)
+                    self.gpio.output(self.relay_pin, self.off_trigger)
+                    self.lcd = self.hardware.lcd(self.lcd_address)
 
 
 def display_on_multiple_lcds(line1: str, line2: str, controllers: list[LCDController], timeout=2) -> None:
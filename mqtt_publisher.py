@@ -0,0 +1,365 @@
+"""
+Long-lived MQTT publisher for the triggers the sender forwards to the camera.
+
+A single paho client stays connected for the life of the process and reconnects in the
+background. Every message goes through an outbox first: it is kept in memory, and optionally in
+an append-only file, until the broker acknowledges it (QoS 1). Triggers produced while the
+broker is unreachable wait there and are sent as soon as the connection is back, so a broker
+restart no longer loses triggers or restarts the service.
+"""
+import asyncio
+import base64
+import bisect
+import collections
+import itertools
+import json
+import logging
+import os
+import time
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger("mqtt_publisher")
+
+# Upper bounds in seconds of the publish latency histogram, the last bucket takes the rest
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf"))
+
+
+class LatencyHistogram:
+    """Counts latencies into fixed buckets, cheap enough to record every publish."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.total += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the `q` quantile, None before the first observation."""
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound if bound != float("inf") else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.total,
+            "mean": round(self.sum / self.total, 4) if self.total else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": round(self.max, 4),
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): count for bound, count in zip(self.buckets, self.counts)},
+        }
+
+
+OutboxMessage = collections.namedtuple("OutboxMessage", ["id", "topic", "payload", "created"])
+
+
+class Outbox:
+    """
+    Bounded FIFO of messages waiting for their acknowledgement.
+
+    With a `path` every change is appended to that file as a JSON line and the file is replayed
+    on start, so unacknowledged messages survive a restart of the service. The file is rewritten
+    from the remaining messages once it holds mostly removed ones. When more than `max_messages`
+    are waiting the oldest ones are dropped.
+    """
+
+    def __init__(self, path=None, max_messages=1000):
+        self.path = path
+        self.max_messages = max_messages
+        self.messages = collections.OrderedDict()  # id -> OutboxMessage
+        self.dropped = 0
+        self._ids = itertools.count(1)
+        self._log_lines = 0
+        self._file = None
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn write of the last line
+                    if record.get("op") == "add":
+                        message = OutboxMessage(record["id"], record["topic"], base64.b64decode(record["payload"]), record["created"])
+                        self.messages[message.id] = message
+                    else:
+                        self.messages.pop(record.get("id"), None)
+        except FileNotFoundError:
+            pass
+        self._ids = itertools.count(max(self.messages, default=0) + 1)
+        while len(self.messages) > self.max_messages:
+            self.messages.popitem(last=False)
+            self.dropped += 1
+        self._compact()
+
+    def add(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        message = OutboxMessage(next(self._ids), topic, payload, time.time())
+        self.messages[message.id] = message
+        self._append({
+            "op": "add", "id": message.id, "topic": topic,
+            "payload": base64.b64encode(payload).decode(), "created": message.created,
+        })
+        dropped = []
+        while len(self.messages) > self.max_messages:
+            _, oldest = self.messages.popitem(last=False)
+            self._append({"op": "remove", "id": oldest.id})
+            dropped.append(oldest)
+            self.dropped += 1
+        return message, dropped
+
+    def remove(self, message_id):
+        if self.messages.pop(message_id, None) is None:
+            return
+        self._append({"op": "remove", "id": message_id})
+        if self._log_lines > 2 * len(self.messages) + 100:
+            self._compact()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(list(self.messages.values()))
+
+    def _append(self, record):
+        if not self.path:
+            return
+        if self._file is None:
+            self._file = open(self.path, "a")
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        self._log_lines += 1
+
+    def _compact(self):
+        if not self.path:
+            return
+        self.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for message in self.messages.values():
+                f.write(json.dumps({
+                    "op": "add", "id": message.id, "topic": message.topic,
+                    "payload": base64.b64encode(message.payload).decode(), "created": message.created,
+                }) + "\n")
+        os.replace(tmp_path, self.path)
+        self._log_lines = len(self.messages)
+
+
+class MqttPublisher:
+    """
+    Publishes with QoS 1 over one persistent connection. Must be started from within a running event loop.
+
+    `publish` never blocks: the message is queued in the outbox and handed to the client while
+    connected. paho resends messages that were in flight when the connection dropped, the
+    outbox sends the rest after reconnecting. Acknowledged messages leave the outbox and their
+    latency, from `publish` to the broker's PUBACK, is recorded in `latency`.
+
+    Args:
+        host (str): Broker address.
+        port (int): Broker port.
+        outbox_path (str, optional): File keeping unacknowledged messages across restarts.
+        max_outbox (int): Messages kept while the broker is unreachable, older ones are dropped.
+        message_ttl (float, optional): Seconds after which a message that wasn't sent yet is dropped.
+        max_inflight (int): Messages handed to the client before their acknowledgement.
+        keepalive (int): MQTT keepalive in seconds.
+    """
+
+    def __init__(self, host, port=1883, outbox_path=None, max_outbox=1000, message_ttl=None, max_inflight=20,
+                 keepalive=60, username=None, password=None, client_id=""):
+        self.host = host
+        self.port = port
+        self.message_ttl = message_ttl
+        self.max_inflight = max_inflight
+        self.keepalive = keepalive
+        self.outbox = Outbox(outbox_path, max_outbox)
+        self.latency = LatencyHistogram()
+        self.connected = False
+        self.expired = 0
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+        if username and password:
+            self.client.username_pw_set(username, password)
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.on_message = self._on_message
+        self._loop = None
+        self._in_flight = {}  # paho mid -> OutboxMessage
+        self._sent_ids = set()
+        self._waiters = {}  # message id -> Future
+        self._connected_event = None
+        self._stopping = False
+        self._subscriptions = {}  # topic filter -> callback(topic, payload, received)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._connected_event = asyncio.Event()
+        self.outbox.load()
+        if len(self.outbox):
+            logger.info(f"{len(self.outbox)} messages from the outbox wait to be sent.")
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+
+    async def stop(self, timeout=2.0):
+        """Give waiting messages up to `timeout` seconds to be acknowledged, then disconnect."""
+        waiters = [waiter for waiter in self._waiters.values() if not waiter.done()]
+        if waiters and self.connected:
+            await asyncio.wait(waiters, timeout=timeout)
+        self._stopping = True
+        self.client.disconnect()
+        await asyncio.to_thread(self.client.loop_stop)
+        self.outbox.close()
+
+    async def wait_connected(self, timeout=None):
+        await asyncio.wait_for(self._connected_event.wait(), timeout)
+
+    def publish(self, topic, payload):
+        """
+        Queue `payload` for `topic`.
+
+        Returns:
+            asyncio.Future: Resolves to the latency in seconds once the broker acknowledged the
+            message. Callers that only need the delivery guarantee don't have to await it.
+        """
+        message, dropped = self.outbox.add(topic, payload)
+        for old in dropped:
+            logger.warning(f"Outbox full, dropped the message to {old.topic} from {time.time() - old.created:.1f}s ago.")
+            self._resolve(old.id, error=OverflowError("dropped from a full outbox"))
+        waiter = self._loop.create_future()
+        self._waiters[message.id] = waiter
+        self._send_pending()
+        return waiter
+
+    def publish_now(self, topic, payload):
+        """
+        Publish with QoS 0 if connected, bypassing the outbox. For messages that are worthless
+        once delayed, e.g. clock sync replies. Returns whether the message was handed to the client.
+        """
+        if not self.connected:
+            return False
+        return self.client.publish(topic, payload, qos=0).rc == mqtt.MQTT_ERR_SUCCESS
+
+    def subscribe(self, topic_filter, callback):
+        """
+        Call ``callback(topic, payload, received)`` on the event loop for every message matching
+        `topic_filter`, `received` being the time it arrived. Survives reconnects.
+        """
+        self._subscriptions[topic_filter] = callback
+        if self.connected:
+            self.client.subscribe(topic_filter, qos=0)
+
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "outbox": len(self.outbox),
+            "in_flight": len(self._in_flight),
+            "dropped": self.outbox.dropped,
+            "expired": self.expired,
+            "latency": self.latency.snapshot(),
+        }
+
+    def _send_pending(self):
+        if not self.connected:
+            return
+        now = time.time()
+        for message in self.outbox:
+            if len(self._in_flight) >= self.max_inflight:
+                break
+            if message.id in self._sent_ids:
+                continue
+            if self.message_ttl is not None and now - message.created > self.message_ttl:
+                logger.warning(f"Dropped the message to {message.topic}, it waited {now - message.created:.1f}s for the broker.")
+                self.expired += 1
+                self.outbox.remove(message.id)
+                self._resolve(message.id, error=TimeoutError("expired in the outbox"))
+                continue
+            info = self.client.publish(message.topic, message.payload, qos=1)
+            if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                logger.error(f"Publishing to {message.topic} failed: {mqtt.error_string(info.rc)}")
+                break
+            # With MQTT_ERR_NO_CONN the connection dropped in between, paho keeps the message and
+            # sends it after reconnecting, just like the ones that were already in flight
+            self._in_flight[info.mid] = message
+            self._sent_ids.add(message.id)
+
+    def _resolve(self, message_id, latency=None, error=None):
+        waiter = self._waiters.pop(message_id, None)
+        if waiter is None or waiter.done():
+            return
+        if error is not None:
+            waiter.set_exception(error)
+            waiter.exception()  # retrieved, nobody has to await it
+        else:
+            waiter.set_result(latency)
+
+    # paho callbacks run on its network thread and are handed to the event loop
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logger.error(f"MQTT broker {self.host}:{self.port} refused the connection: {reason_code}")
+            return
+        self._loop.call_soon_threadsafe(self._connected)
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self._loop.call_soon_threadsafe(self._disconnected, reason_code)
+
+    def _on_message(self, client, userdata, message):
+        # Timestamped here, before the hop to the event loop
+        received = time.time()
+        for topic_filter, callback in list(self._subscriptions.items()):
+            if mqtt.topic_matches_sub(topic_filter, message.topic):
+                self._loop.call_soon_threadsafe(callback, message.topic, message.payload, received)
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        self._loop.call_soon_threadsafe(self._published, mid)
+
+    def _connected(self):
+        if self._subscriptions:
+            # Subscriptions don't outlive the session. Renewed on the loop, where `subscribe`
+            # runs, so a filter added while connecting isn't missed by both
+            self.client.subscribe([(topic_filter, 0) for topic_filter in self._subscriptions])
+        self.connected = True
+        self._connected_event.set()
+        logger.info(f"Connected to MQTT broker at {self.host}:{self.port}, {len(self.outbox)} messages waiting.")
+        self._send_pending()
+
+    def _disconnected(self, reason_code):
+        if self.connected and not self._stopping:
+            logger.warning(f"Disconnected from MQTT broker at {self.host}:{self.port} ({reason_code}), reconnecting.")
+        self.connected = False
+        self._connected_event.clear()
+
+    def _published(self, mid):
+        message = self._in_flight.pop(mid, None)
+        if message is None:
+            return
+        self._sent_ids.discard(message.id)
+        self.outbox.remove(message.id)
+        latency = time.time() - message.created
+        self.latency.observe(latency)
+        self._resolve(message.id, latency=latency)
+        self._send_pending()
@@ -1,14 +1,19 @@
 import json
 import os
 import logging
-from uuid import UUID
+import time
 
 import paho.mqtt.client as mqtt
 from systemd.journal import JournalHandler
 from dotenv import load_dotenv
 import sentry_sdk
 
-# Load environment variables and ensure RECORDING_DIR is set
+import trigger_payload
+from clock_sync import REQUEST_TOPIC, ClockSyncClient, default_node_id, reply_topic
+from mqtt_routing import RoutingTable
+from trigger_channel import SOCKET_NAME, TriggerSender
+
+# Load environment variables and ensure MQTT_ROUTES or RECORDING_DIR is set
 load_dotenv()
 
 sentry_sdk.init(
@@ -17,9 +22,24 @@ sentry_sdk.init(
     traces_sample_rate=1.0,
 )
 
-RECORDING_DIR = os.getenv("RECORDING_DIR")
-if not RECORDING_DIR:
-    raise ValueError("RECORDING_DIR environment variable not set.")
+# Topic filters this node subscribes to and the recorder each of them goes to, see mqtt_routing
+ROUTING_TABLE = RoutingTable.from_env()
+
+# "file" writes {uuid}.txt and record.txt for the recorder to pick up, "socket" hands triggers to
+# the recorder over the trigger channel and falls back to the files while it isn't listening
+RECEIVER_DELIVERY = os.getenv("RECEIVER_DELIVERY", "file").lower()
+trigger_senders = {}  # recording_dir -> TriggerSender
+if RECEIVER_DELIVERY == "socket":
+    for route in ROUTING_TABLE.routes:
+        trigger_senders.setdefault(
+            route.recording_dir, TriggerSender(route.trigger_socket or os.path.join(route.recording_dir, SOCKET_NAME))
+        )
+
+# Scan times are converted into this node's clock with offsets estimated against every source,
+# CLOCK_SYNC_INTERVAL seconds between requests, 0 disables it
+CLOCK_SYNC_INTERVAL = float(os.getenv("CLOCK_SYNC_INTERVAL", 10))
+CLOCK_REPORT_INTERVAL = 300  # Seconds between clock offset reports in the journal
+clock = ClockSyncClient(default_node_id())
 
 # Configure logger
 logging.basicConfig(level=logging.INFO)
@@ -29,36 +49,61 @@ logger.addHandler(journal_handler)
 
 def on_connect(client, userdata, flags, rc):
     logger.info("Connected with result code " + str(rc))
-    # Subscribe to the MQTT topic where messages are published
-    client.subscribe("home/raspberry")
+    # Only the topics routed to this node, the broker drops the rest
+    topic_filters = ROUTING_TABLE.subscriptions()
+    client.subscribe([(topic_filter, 1) for topic_filter in topic_filters])
+    logger.info("Subscribed to %s", ", ".join(topic_filters))
+    if CLOCK_SYNC_INTERVAL:
+        client.subscribe(reply_topic(clock.node_id), 0)
 
 def on_message(client, userdata, msg):
+    received = time.time()
+    if msg.topic == reply_topic(clock.node_id):
+        clock.handle_reply(msg.payload, received)
+        return
     try:
-        decoded = msg.payload.decode().strip()
-        payload = json.loads(decoded)
-        # Expect payload in the format: [uuid, timestamp]
-        if isinstance(payload, list) and len(payload) == 2:
-            uuid_val = payload[0]
-            try:
-                # Validate that the first element is a proper UUID
-                UUID(uuid_val)
-            except ValueError:
-                logger.info("Invalid UUID received: %s", uuid_val)
-                return
-            timestamp_val = payload[1]
-            # Write the timestamp to a file named {uuid}.txt in the RECORDING_DIR
-            file_path = os.path.join(RECORDING_DIR, f"{uuid_val}.txt")
-            with open(file_path, "w") as f:
-                json.dump({"timestamp": timestamp_val}, f)
-            # Touch record.txt in the same directory
-            record_path = os.path.join(RECORDING_DIR, "record.txt")
-            with open(record_path, "w") as f:
-                f.write("")
-            logger.info("Received data for UUID: %s with timestamp: %s", uuid_val, timestamp_val)
-        else:
-            logger.warning("Payload not in expected format: %s", decoded)
-    except Exception as e:
-        logger.exception("Failed to process received data: %s", e)
+        # Binary batches and legacy JSON lists are told apart by their first byte
+        triggers = trigger_payload.decode(msg.payload)
+    except ValueError as e:
+        logger.warning("Payload not in expected format: %r (%s)", msg.payload[:100], e)
+        return
+    routes = ROUTING_TABLE.match(msg.topic)
+    if not routes:
+        logger.warning("No route for topic %s, dropping %d triggers", msg.topic, len(triggers))
+        return
+    # Scan times in this node's clock, unchanged until the first offset estimate of the sender
+    triggers = [
+        trigger._replace(timestamp=clock.to_local(trigger.timestamp, trigger.node, msg.topic)) for trigger in triggers
+    ]
+    for trigger in triggers:
+        if trigger.timestamp % 1:
+            # Publishers with sub-second scan times
+            logger.info("Trigger %s arrived %.1fms after the scan", trigger.uuid, (received - trigger.timestamp) * 1000)
+    for route in routes:
+        try:
+            record = False
+            for trigger in triggers:
+                record = deliver(trigger, route.recording_dir) or record
+            if record:
+                # Touch record.txt in the same directory, once per message
+                record_path = os.path.join(route.recording_dir, "record.txt")
+                with open(record_path, "w") as f:
+                    f.write("")
+        except Exception as e:
+            logger.exception("Failed to process received data: %s", e)
+
+def deliver(trigger, recording_dir):
+    """Hand one trigger to the recorder of `recording_dir`, returns True if record.txt still has to be written."""
+    trigger_sender = trigger_senders.get(recording_dir)
+    if trigger_sender is not None and trigger_sender.send_nowait(trigger.uuid, trigger.timestamp):
+        logger.info("Delivered trigger for UUID: %s over the trigger socket of %s", trigger.uuid, recording_dir)
+        return False
+    # Write the timestamp to a file named {uuid}.txt in the RECORDING_DIR
+    file_path = os.path.join(recording_dir, f"{trigger.uuid}.txt")
+    with open(file_path, "w") as f:
+        json.dump({"timestamp": trigger.timestamp}, f)
+    logger.info("Received data for UUID: %s with timestamp: %s", trigger.uuid, trigger.timestamp)
+    return True
 
 def main():
     client = mqtt.Client()
@@ -76,8 +121,27 @@ def main():
     mqtt_port = int(os.getenv("MQTT_PORT", 1883))
     client.connect(mqtt_broker, mqtt_port, 60)
 
-    # Start the network loop; this call blocks and handles reconnects automatically
-    client.loop_forever()
+    # Start the network loop; it runs on its own thread and handles reconnects automatically
+    client.loop_start()
+    try:
+        sync_clocks(client)
+    finally:
+        client.loop_stop()
+
+def sync_clocks(client):
+    """Send clock requests to every source and report the offsets, blocks forever."""
+    if not CLOCK_SYNC_INTERVAL:
+        while True:
+            time.sleep(3600)
+    next_report = time.monotonic() + CLOCK_REPORT_INTERVAL
+    while True:
+        if client.is_connected():
+            client.publish(REQUEST_TOPIC, clock.request(), qos=0)
+        time.sleep(CLOCK_SYNC_INTERVAL)
+        if time.monotonic() >= next_report:
+            next_report += CLOCK_REPORT_INTERVAL
+            for node, stats in clock.stats().items():
+                logger.info("Clock offset of %s: %s ms, jitter %s ms, delay %s ms", node, stats["offset_ms"], stats["jitter_ms"], stats["delay_ms"])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,102 @@
+"""
+Topic hierarchy and routing of the camera triggers sent over MQTT.
+
+Triggers are published to ``turnstile/{site}/{entrance}/{direction}``. A receiver subscribes only
+to the topic filters of its routing table, so the broker drops everything not meant for it, and
+each route hands the trigger to its own recorder, i.e. RECORDING_DIR and trigger socket. One
+receiver process can therefore serve several turnstiles and cameras.
+
+MQTT_ROUTES holds the table as JSON, mapping topic filters to a recording directory or to an
+object with ``recording_dir`` and optionally ``trigger_socket``::
+
+    {"turnstile/gym1/main/+": "/home/manager/recordings",
+     "turnstile/gym1/side/A": {"recording_dir": "/home/manager/side", "trigger_socket": "/run/side.sock"}}
+
+Without MQTT_ROUTES everything stays as before: the single topic MQTT_TOPIC (``home/raspberry``)
+goes to RECORDING_DIR.
+"""
+import json
+import os
+from collections import namedtuple
+
+from paho.mqtt.client import topic_matches_sub
+
+TOPIC_PREFIX = "turnstile"
+LEGACY_TOPIC = "home/raspberry"
+UNKNOWN_LEVEL = "_"  # stands in for a missing entrance or direction
+
+Route = namedtuple("Route", ["topic_filter", "recording_dir", "trigger_socket"], defaults=[None])
+
+
+def trigger_topic(site, entrance, direction):
+    levels = [site, entrance or UNKNOWN_LEVEL, direction or UNKNOWN_LEVEL]
+    for level in levels:
+        if not level or any(char in level for char in "/+#"):
+            raise ValueError(f"Invalid topic level {level!r}")
+    return "/".join([TOPIC_PREFIX, *levels])
+
+
+def publish_topic(direction=None):
+    """
+    Topic the triggers of this device go to: MQTT_TOPIC if set, otherwise the hierarchy topic of
+    MQTT_SITE, MQTT_ENTRANCE (defaulting to ENTRANCE_UUID) and `direction`, otherwise the legacy topic.
+    """
+    topic = os.getenv("MQTT_TOPIC")
+    if topic:
+        return topic
+    site = os.getenv("MQTT_SITE")
+    if not site:
+        return LEGACY_TOPIC
+    return trigger_topic(site, os.getenv("MQTT_ENTRANCE") or os.getenv("ENTRANCE_UUID"), direction)
+
+
+def parse_routes(spec):
+    """Parse the JSON routing table of MQTT_ROUTES into a list of `Route`."""
+    try:
+        table = json.loads(spec)
+    except ValueError as e:
+        raise ValueError(f"MQTT_ROUTES is not valid JSON: {e}")
+    if not isinstance(table, dict) or not table:
+        raise ValueError("MQTT_ROUTES must map topic filters to recording directories")
+    routes = []
+    for topic_filter, target in table.items():
+        if isinstance(target, str):
+            target = {"recording_dir": target}
+        if not isinstance(target, dict) or not target.get("recording_dir"):
+            raise ValueError(f"The route of {topic_filter!r} has no recording_dir")
+        routes.append(Route(topic_filter, target["recording_dir"], target.get("trigger_socket")))
+    return routes
+
+
+class RoutingTable:
+    """Maps the topic of a received trigger to the recorders it is meant for."""
+
+    def __init__(self, routes):
+        self.routes = list(routes)
+
+    @classmethod
+    def from_env(cls):
+        spec = os.getenv("MQTT_ROUTES")
+        if spec:
+            return cls(parse_routes(spec))
+        recording_dir = os.getenv("RECORDING_DIR")
+        if not recording_dir:
+            raise ValueError("Either MQTT_ROUTES or RECORDING_DIR has to be set.")
+        return cls([Route(os.getenv("MQTT_TOPIC") or LEGACY_TOPIC, recording_dir, os.getenv("TRIGGER_SOCKET"))])
+
+    def subscriptions(self):
+        """Distinct topic filters to subscribe to."""
+        return list(dict.fromkeys(route.topic_filter for route in self.routes))
+
+    def match(self, topic):
+        """
+        Routes `topic` is meant for, each recorder once even if several filters match.
+
+        Returns:
+            list[Route]: Empty if the topic matches no route.
+        """
+        matched = {}
+        for route in self.routes:
+            if route.recording_dir not in matched and topic_matches_sub(route.topic_filter, topic):
+                matched[route.recording_dir] = route
+        return list(matched.values())
@@ -3,12 +3,17 @@ import os
 import asyncio
 import json
 import time
+from uuid import UUID
 
-import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
-from tenacity import retry, stop_after_delay, wait_fixed, RetryError
 
 from utils import SentryLogger
+from dir_watch import CLOSED, MOVED, DirectoryWatcher
+from mqtt_publisher import MqttPublisher
+from mqtt_routing import publish_topic
+from clock_sync import REQUEST_TOPIC, ClockSyncResponder, default_node_id
+import profiler
+import trigger_payload
 from systemd.journal import JournalHandler
 import sentry_sdk
 
@@ -22,9 +27,9 @@ sentry_sdk.init(
 )
 
 # === Constants ===
-SCAN_INTERVAL_MS = 30          # Interval between scan cycles
-PING_INTERVAL_SECONDS = 20     # Unused with MQTT, kept here for reference
-MAX_TRANSMISSION_TIME = 1.0    # Max allowed time (in seconds) for a send operation
+SCAN_INTERVAL_MS = 30          # Interval between scan cycles if inotify is unavailable
+SLOW_PUBLISH_SECONDS = 1.0     # Publishes acknowledged later than this are logged
+STATS_INTERVAL_SECONDS = 300   # Interval between publish latency reports in the journal
 
 # Set up our special logger
 logging.setLoggerClass(SentryLogger)
@@ -33,90 +38,106 @@ logger.setLevel(logging.INFO)
 journal_handler = JournalHandler()
 logger.addHandler(journal_handler)
 
-# Global MQTT client and lock
-client = None
-client_lock = asyncio.Lock()
-
-@retry(stop=stop_after_delay(2), wait=wait_fixed(0.1))
-async def send_with_reconnect(topic: str, payload: str):
-    """
-    Attempts to publish the payload to the specified MQTT topic.
-    On failure, it will try to reconnect the client and then re-raise the error.
-    """
-    global client
-    async with client_lock:
-        try:
-            # Publish asynchronously by offloading to a thread
-            info = await asyncio.to_thread(client.publish, topic, payload)
-            # Wait for the publish to complete
-            await asyncio.to_thread(info.wait_for_publish)
-            if info.rc != mqtt.MQTT_ERR_SUCCESS:
-                raise Exception(f"Publish returned error code: {info.rc}")
-            logger.info(f"Sent payload: {payload} to topic: {topic}")
-        except Exception as send_err:
-            logger.error(f"Publish failed: {send_err}. Attempting reconnect...")
-            try:
-                await asyncio.to_thread(client.disconnect)
-                await asyncio.to_thread(client.loop_stop)
-            except Exception as disconnect_err:
-                logger.error(f"Error disconnecting client: {disconnect_err}")
-            mqtt_broker = os.getenv("MQTT_BROKER")
-            if not mqtt_broker:
-                logger.error("Error: MQTT_BROKER environment variable is not set.")
-                return
-            port = int(os.getenv("MQTT_PORT", 1883))
-            # Create a new client instance and reconnect
-            client = mqtt.Client()
-            try:
-                await asyncio.to_thread(client.connect, mqtt_broker, port, 60)
-                client.loop_start()  # Start the network loop in a background thread
-                logger.info(f"Reconnected to MQTT broker at {mqtt_broker}:{port}")
-            except Exception as conn_err:
-                logger.error(f"Failed to connect via MQTT: {conn_err}")
-            raise send_err
+# Global MQTT publisher, started in main
+publisher = None
 
 async def scan_and_send(recording_dir: str):
     """
-    Scans the specified directory for files matching the pattern and sends the JSON payload
-    over MQTT using the send_with_reconnect function. If transmission takes too long, an exception
-    is raised to force a restart.
+    Watches the specified directory for files matching the pattern and hands the triggers to the
+    MQTT publisher, which delivers them once the broker is reachable. Files that arrive together
+    are sent as one batch in the binary format.
     """
-    # Use MQTT topic from environment variable; default to "home/raspberry"
-    mqtt_topic = os.getenv("MQTT_TOPIC", "home/raspberry")
+    direction = os.getenv("ENTRANCE_DIRECTION")
+    # MQTT_TOPIC, the site/entrance/direction topic of MQTT_SITE or "home/raspberry"
+    mqtt_topic = publish_topic(direction)
+    # Stays "json" until every receiver understands the binary format
+    payload_format = os.getenv("MQTT_PAYLOAD_FORMAT", trigger_payload.JSON).lower()
+    if payload_format not in trigger_payload.FORMATS:
+        raise ValueError(f"MQTT_PAYLOAD_FORMAT must be one of {list(trigger_payload.FORMATS)}, got {payload_format!r}")
+    # Receivers estimate our clock offset to convert the scan times into their own clock, binary
+    # triggers carry our node id so they find it even if other senders share the topic
+    node_id = default_node_id()
+    clock_responder = ClockSyncResponder(mqtt_topic, publisher.publish_now, node_id)
+    publisher.subscribe(REQUEST_TOPIC, clock_responder.handle_request)
+    watcher = DirectoryWatcher(recording_dir, poll_interval=SCAN_INTERVAL_MS / 1000)
+    watcher.open()
+    try:
+        # Files written before the watcher was opened, afterwards only the ones qr.py finished writing
+        filenames = os.listdir(recording_dir)
+        while True:
+            triggers, paths = [], []
+            for filename in filenames:
+                if filename.endswith('.txt') and filename != "record.txt":
+                    trigger = read_trigger(recording_dir, filename, direction, node_id)
+                    if trigger is not None:
+                        triggers.append(trigger)
+                        paths.append(os.path.join(recording_dir, filename))
+            if triggers:
+                send_triggers(triggers, mqtt_topic, payload_format)
+                for path in paths:
+                    os.remove(path)
+            events = await watcher.wait()
+            filenames = list(dict.fromkeys(event.name for event in events if event.kind in (CLOSED, MOVED)))
+    finally:
+        watcher.close()
+
+def read_trigger(recording_dir: str, filename: str, direction=None, node_id=None):
+    """The trigger qr.py left as `filename`, None if it is gone, stale or invalid."""
+    logger.info(f"Found file: {filename}")
+    file_path = os.path.join(recording_dir, filename)
+    entrance_log_uuid = filename[:-4]
+    try:
+        UUID(entrance_log_uuid)
+    except ValueError:
+        logger.warning(f"Ignoring {filename}, it is not named after an entrance-log uuid.")
+        return None
+    try:
+        file_mtime = os.path.getmtime(file_path)
+    except FileNotFoundError:
+        return None  # already sent
+    now = time.time()
+
+    if now - file_mtime > 3:
+        logger.warning(f"File {filename} is older than 3 seconds (age: {now - file_mtime:.1f}s), deleting.")
+        os.remove(file_path)
+        return None
+
+    # Sub-second precision lets the receiving side log the latency from the scan
+    return trigger_payload.Trigger(entrance_log_uuid, round(file_mtime, 6), direction, node_id)
+
+def send_triggers(triggers, mqtt_topic: str, payload_format: str):
+    # The JSON format holds a single trigger per message
+    batch_size = trigger_payload.MAX_BATCH if payload_format == trigger_payload.BINARY else 1
+    for start in range(0, len(triggers), batch_size):
+        batch = triggers[start: start + batch_size]
+        payload = [trigger.uuid for trigger in batch]
+        # The outbox holds the triggers from here on, even across a restart of this service
+        acknowledged = publisher.publish(mqtt_topic, trigger_payload.encode(batch, payload_format))
+        acknowledged.add_done_callback(lambda future, payload=payload: log_delivery(payload, future))
+
+def log_delivery(payload, future):
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        logger.error(f"Payload {payload} was not delivered: {future.exception()}")
+        return
+    latency = future.result()
+    if latency > SLOW_PUBLISH_SECONDS:
+        logger.warning(f"Payload {payload} took {latency:.3f}s to be acknowledged.")
+    else:
+        logger.info(f"Sent payload: {payload} in {latency * 1000:.1f}ms")
+
+async def report_stats():
+    reported = None
     while True:
-        for filename in os.listdir(recording_dir):
-            if filename.endswith('.txt') and filename != "record.txt":
-                logger.info(f"Found file: {filename}")
-                file_path = os.path.join(recording_dir, filename)
-                entrance_log_uuid = filename[:-4]
-                file_mtime = int(os.path.getmtime(file_path))
-                now = int(time.time())
-
-                if now - file_mtime > 3:
-                    logger.warning(f"File {filename} is older than 3 seconds (age: {now - file_mtime}s), deleting.")
-                    os.remove(file_path)
-                    continue
-
-                payload = [entrance_log_uuid, file_mtime]
-                json_payload = json.dumps(payload)
-
-                try:
-                    start_time = time.time()
-                    await send_with_reconnect(mqtt_topic, json_payload)
-                    elapsed = time.time() - start_time
-                    if elapsed > MAX_TRANSMISSION_TIME:
-                        logger.error(f"Transmission took too long: {elapsed:.3f}s, exiting to force restart.")
-                        raise Exception("Transmission timeout")
-                except RetryError as retry_err:
-                    logger.error(f"Failed to send payload within 2 seconds: {retry_err}. Deleting file.")
-                    os.remove(file_path)
-                    raise retry_err
-                else:
-                    os.remove(file_path)
-        await asyncio.sleep(SCAN_INTERVAL_MS / 1000)
+        await asyncio.sleep(STATS_INTERVAL_SECONDS)
+        stats = publisher.stats()
+        if stats != reported:
+            logger.info(f"MQTT publisher stats: {json.dumps(stats)}")
+            reported = stats
 
 async def main():
-    global client
+    global publisher
     recording_dir = os.getenv("RECORDING_DIR")
     if not recording_dir:
         logger.error("Error: RECORDING_DIR environment variable is not set.")
@@ -127,25 +148,31 @@ async def main():
         logger.error("Error: MQTT_BROKER environment variable is not set.")
         return
     port = int(os.getenv("MQTT_PORT", 1883))
+    # Kept outside RECORDING_DIR so writing it doesn't wake the directory watchers
+    default_outbox = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mqtt_outbox.jsonl")
+    message_ttl = float(os.getenv("MQTT_MESSAGE_TTL", 30))
+
+    publisher = MqttPublisher(
+        mqtt_broker,
+        port,
+        outbox_path=os.getenv("MQTT_OUTBOX_PATH", default_outbox),
+        max_outbox=int(os.getenv("MQTT_MAX_OUTBOX", 1000)),
+        message_ttl=message_ttl or None,
+        username=os.getenv("MQTT_USERNAME"),
+        password=os.getenv("MQTT_PASSWORD"),
+    )
+    await publisher.start()
+    stats_task = asyncio.create_task(report_stats())
 
     try:
-        client = mqtt.Client()
-        client.connect(mqtt_broker, port, 60)
-        client.loop_start()  # Start MQTT network loop in a background thread
-        logger.info(f"Connected to MQTT broker at {mqtt_broker}:{port}")
-    except Exception as conn_err:
-        logger.error(f"Failed to connect via MQTT: {conn_err}")
-        raise conn_err
-
-    try:
-        # Since MQTT manages keep-alives internally, we no longer need to send pings manually.
         await scan_and_send(recording_dir)
     except asyncio.CancelledError as e:
         logger.error(f"Task cancelled: {e}")
     finally:
-        client.loop_stop()
-        client.disconnect()
-        logger.info("MQTT client disconnected.")
+        stats_task.cancel()
+        await publisher.stop()
+        logger.info(f"MQTT publisher stopped: {json.dumps(publisher.stats())}")
 
 if __name__ == "__main__":
+    profiler.install("mqtt_sender", log=logger)
     asyncio.run(main())
@@ -0,0 +1,217 @@
+"""
+On-demand sampling profiler of the long-running services, for flame graphs from field devices.
+
+Opt-in with PROFILER_ENABLED=true. `install(name)` then arms SIGUSR2, every signal samples the
+stacks of all threads for PROFILE_SECONDS and writes them in the collapsed format that
+flamegraph.pl, inferno and speedscope read:
+
+    kill -USR2 $(pgrep -f qr.py)
+    flamegraph.pl profiles/qr-A-1234-20261019T101500.folded > qr-A.svg
+
+Stacks start with the thread name, followed by the asyncio task that was running on the
+thread's event loop when the sample was taken. Samples are wall-clock: a thread waiting on a
+socket or a lock shows up where it waits, which is what a slow door needs.
+
+Sampling runs in its own thread and only during a capture. It times every sample and
+stretches the interval whenever sampling would take more than PROFILE_MAX_OVERHEAD of a core.
+The achieved interval and overhead are logged and written to a .json summary next to the stacks.
+"""
+import asyncio
+import collections
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+SIGNAL = signal.SIGUSR2
+DEFAULT_SECONDS = 30
+DEFAULT_INTERVAL = 0.01  # Seconds between samples
+DEFAULT_MAX_OVERHEAD = 0.02  # Fraction of a core
+MAX_DEPTH = 128  # Frames per stack, the outermost are dropped beyond
+
+logger = logging.getLogger("profiler")
+
+
+def default_directory():
+    return os.getenv("PROFILE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+
+
+def running_tasks():
+    """Thread id -> name of the asyncio task running on that thread's event loop right now."""
+    # The C implementation keeps the running task of each loop in this dict, reading it from
+    # another thread is a single dict copy under the GIL
+    current = getattr(asyncio.tasks, "_current_tasks", {})
+    tasks = {}
+    for loop, task in list(current.items()):
+        thread_id = getattr(loop, "_thread_id", None)
+        if thread_id is not None and task is not None:
+            tasks[thread_id] = task_label(task)
+    return tasks
+
+
+def task_label(task):
+    """The task name, or the coroutine for the numbered default names so samples of reruns add up."""
+    name = task.get_name()
+    if name.startswith("Task-"):
+        name = getattr(task.get_coro(), "__qualname__", name)
+    return f"task:{name}"
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread of the process, see the module docstring.
+
+    Args:
+        name (str): Name of the service, the files of its captures start with it.
+        directory (str, optional): Where the captures go. Defaults to `default_directory()`.
+        interval (float, optional): Seconds between samples.
+        max_overhead (float, optional): Fraction of a core sampling may take, the interval is
+            stretched to stay below it.
+        log (logging.Logger, optional): Where the captures are reported, e.g. the service's logger.
+    """
+
+    def __init__(self, name, directory=None, interval=DEFAULT_INTERVAL, max_overhead=DEFAULT_MAX_OVERHEAD, log=None):
+        self.name = name
+        self.logger = log or logger
+        self.directory = directory or default_directory()
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self._labels = {}  # code object -> frame label, most samples hit the same functions
+        self._requested = threading.Event()
+        self._thread = None
+
+    def capture(self, seconds):
+        """
+        Sample for `seconds` in the calling thread.
+
+        Returns:
+            tuple[collections.Counter, dict]: Sample counts of the collapsed stacks, and the summary
+            of the capture with the number of samples, the achieved interval and the overhead.
+        """
+        stacks = collections.Counter()
+        own_thread = threading.get_ident()
+        interval = self.interval
+        mean_cost = 0.0
+        busy = 0.0
+        samples = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        next_sample = started
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            if next_sample > now:
+                time.sleep(min(next_sample, deadline) - now)
+                continue
+            self._sample(stacks, own_thread)
+            cost = time.perf_counter() - now
+            busy += cost
+            samples += 1
+            mean_cost = cost if samples == 1 else 0.9 * mean_cost + 0.1 * cost
+            interval = max(self.interval, mean_cost / self.max_overhead)
+            # Samples that are late are not made up for, they would only add to the overhead
+            next_sample = max(next_sample + interval, time.perf_counter())
+        elapsed = time.perf_counter() - started
+        summary = {
+            "name": self.name,
+            "pid": os.getpid(),
+            "seconds": round(elapsed, 3),
+            "samples": samples,
+            "stacks": len(stacks),
+            "interval_ms": round(self.interval * 1000, 3),
+            "mean_interval_ms": round(elapsed / samples * 1000, 3) if samples else None,
+            "sample_cost_ms": round(busy / samples * 1000, 4) if samples else None,
+            "overhead": round(busy / elapsed, 5) if elapsed else 0.0,
+            "max_overhead": self.max_overhead,
+        }
+        return stacks, summary
+
+    def profile(self, seconds=DEFAULT_SECONDS):
+        """Capture for `seconds` and write the stacks and the summary. Returns the summary."""
+        stacks, summary = self.capture(seconds)
+        os.makedirs(self.directory, exist_ok=True)
+        stem = os.path.join(self.directory, f"{self.name}-{os.getpid()}-{time.strftime('%Y%m%dT%H%M%S')}")
+        summary["path"] = stem + ".folded"
+        with open(summary["path"], "w") as f:
+            for stack, count in sorted(stacks.items()):
+                f.write(f"{stack} {count}\n")
+        with open(stem + ".json", "w") as f:
+            json.dump(summary, f, indent=2)
+        self.logger.info(
+            f"Profile of {summary['seconds']}s written to {summary['path']}: {summary['samples']} samples every "
+            f"{summary['mean_interval_ms']}ms, sampling took {summary['overhead'] * 100:.2f}% of a core"
+        )
+        return summary
+
+    def start(self, seconds=DEFAULT_SECONDS):
+        """Start the thread running a capture of `seconds` on every `request()`."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._serve, args=(seconds,), name="profiler", daemon=True)
+            self._thread.start()
+
+    def request(self):
+        """
+        Ask for a capture, ignored while one is running. Only sets an event, so it is safe to
+        call from a signal handler.
+        """
+        self._requested.set()
+
+    def _serve(self, seconds):
+        while True:
+            self._requested.wait()
+            try:
+                self.profile(seconds)
+            except Exception as e:
+                self.logger.error(f"Profiling {self.name} failed: {e}")
+            # Requests that came in during the capture are meant for this capture
+            self._requested.clear()
+
+    def _sample(self, stacks, own_thread):
+        labels = self._labels
+        tasks = running_tasks()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = frame_label(code)
+                stack.append(label)
+                frame = frame.f_back
+            if thread_id in tasks:
+                stack.append(tasks[thread_id])
+            stack.append(names.get(thread_id, f"thread-{thread_id}"))
+            stacks[";".join(reversed(stack))] += 1
+
+
+def install(name, log=None):
+    """
+    Arm SIGUSR2 to profile the process if PROFILER_ENABLED is set. Call it from the main thread,
+    `log` is the logger the captures are reported to.
+
+    Returns:
+        SamplingProfiler: None while profiling is disabled.
+    """
+    if os.getenv("PROFILER_ENABLED", "False").lower() != "true":
+        return None
+    profiler = SamplingProfiler(
+        name,
+        interval=float(os.getenv("PROFILE_INTERVAL", DEFAULT_INTERVAL)),
+        max_overhead=float(os.getenv("PROFILE_MAX_OVERHEAD", DEFAULT_MAX_OVERHEAD)),
+        log=log,
+    )
+    profiler.start(float(os.getenv("PROFILE_SECONDS", DEFAULT_SECONDS)))
+    signal.signal(SIGNAL, lambda signum, frame: profiler.request())
+    profiler.logger.info(f"Profiler armed, send SIGUSR2 to pid {os.getpid()} for a profile in {profiler.directory}")
+    return profiler
@@ -1,5 +1,16 @@
-import json
+"""
+Door controller of an entrance direction: reads the QR/card scanner, verifies the customer against
+the offline cache or the backend, opens the door relay and greets on the LCD.
+
+    python qr.py
+
+Importing this module has no side effects. `TurnstileSettings.from_env` parses the configuration
+once, including the scanner and LCD discovery of DIRECTION A and B, and `TurnstileService` owns the
+devices of one direction between `start()` and `stop()`. Several services can share a process and
+a hardware backend.
+"""
 import asyncio
+import json
 import logging
 import os
 import pathlib
@@ -7,412 +18,801 @@ import re
 import threading
 import time
 import uuid
-
-import evdev
-from evdev import InputDevice, categorize, KeyEvent
-import requests
-from dotenv import load_dotenv
-import RPi.GPIO as GPIO
-import serial
+from dataclasses import dataclass
+from typing import Optional
 
 from configurator import apply_config
-from find_device import find_qr_devices
-try:
-    from i2cdetect import detect_i2c_device_not_27
-except ImportError as e:
-    logging.warning(f"i2cdetect module not available: {e}")
-    detect_i2c_device_not_27 = None
-
+from hardware import load_backend
 from keymap import KEYMAP
-
-try:
-    from lcd_controller import LCDController
-except ImportError as e:
-    logging.warning(f"LCD controller module not available: {e}")
-    LCDController = None
-from systemd.journal import JournalHandler
-import sentry_sdk
-
-from serial_reader import find_serial_devices
-from utils import SentryLogger
-
-sentry_sdk.init(
-    dsn=os.getenv("SENTRY_DSN"),
-    environment=os.getenv("SENTRY_ENV"),
-    traces_sample_rate=1.0,
-)
-
-load_dotenv()
+from audit_log import AuditLog, DENIED, GRANTED, default_directory as default_audit_directory
+from busy_signal import BusySignal
+from camera.recording_session import write_denied_marker
+from clock_sync import REQUEST_TOPIC as CLOCK_REQUEST_TOPIC, ClockSyncResponder, default_node_id, wall_time
+import profiler
+import trigger_payload
+from relay_driver import RelayDriver
+from trigger_channel import TriggerSender, socket_path as trigger_socket_path
 
 
 class NoDeviceFoundError(Exception):
     pass
 
 
-DIRECTION = os.getenv("DIRECTION")
-if DIRECTION == "A":
-    os.environ["ENTRANCE_UUID"] = os.getenv("ENTRANCE_UUID_A")
-    try:
-        if detect_i2c_device_not_27:
-            i2c_address_a = detect_i2c_device_not_27(1)
-            if i2c_address_a:
-                os.environ["LCD_I2C_ADDRESS"] = i2c_address_a
-        else:
-            os.environ["USE_LCD"] = "0"
-            logging.warning("i2c detection not available")
-    except Exception as e:
-        logging.warning(f"Failed to detect i2c device: {e}")
-    os.environ["RELAY_PIN_DOOR"] = os.getenv("RELAY_PIN_A", "24")
-    os.environ["RELAY_PIN_DISPLAY"] = os.getenv("RELAY_PIN_DISPLAY_A", "21")
-    os.environ["IS_SERIAL_DEVICE"] = "True"
-    devices = find_serial_devices()
-    if devices:
-        os.environ["QR_USB_DEVICE_PATH"] = devices[0].path
-    else:
-        raise NoDeviceFoundError("No serial device found.")
-elif DIRECTION == "B":
-    os.environ["ENTRANCE_UUID"] = os.getenv("ENTRANCE_UUID_B")
-    os.environ["LCD_I2C_ADDRESS"] = "0x27"
-    os.environ["RELAY_PIN_DOOR"] = os.getenv("RELAY_PIN_B", "10")
-    os.environ["RELAY_PIN_DISPLAY"] = os.getenv("RELAY_PIN_DISPLAY_B", "20")
-    os.environ["IS_SERIAL_DEVICE"] = "False"
-    devices = find_qr_devices()
-    if devices:
-        os.environ["QR_USB_DEVICE_PATH"] = devices[0].path
-    else:
-        raise NoDeviceFoundError("No keyboard-QR device found.")
-
-
-ENTRANCE_DIRECTION = os.getenv("ENTRANCE_DIRECTION")
-ENABLE_STREAM_HANDLER = os.getenv("ENABLE_STREAM_HANDLER", "False").lower() == "true"
-DARK_MODE = os.getenv("DARK_MODE", "False").lower() == "true"
 MAGIC_TIMESTAMP = 1725628212
 current_dir = pathlib.Path(__file__).parent
-HEARTBEAT_FILE_PATH = current_dir / f"heartbeat-{DIRECTION}.json"
 HEARTBEAT_INTERVAL = 15
+# Default of Settings.as_hex, the encoding of the card numbers the readers send
+AS_HEX = False
+
+
+def qr_logger():
+    """
+    The logger of the module, looked up on use. main() sets the SentryLogger class first, a
+    logger created at import would stay a plain Logger and never report to sentry.
+    """
+    return logging.getLogger("qr_logger")
 
 
 class DirectionFilter(logging.Filter):
+    def __init__(self, direction):
+        super().__init__()
+        self.direction = direction
+
     def filter(self, record):
-        record.msg = f"{DIRECTION} - {record.msg}"
+        record.msg = f"{self.direction} - {record.msg}"
         return True
 
 
-logging.setLoggerClass(SentryLogger)
-logger = logging.getLogger("qr_logger")
-logger.setLevel(logging.INFO)
-journal_handler = JournalHandler()
-journal_handler.addFilter(DirectionFilter())
-logger.addHandler(journal_handler)
-
-if ENABLE_STREAM_HANDLER:
-    # Stream handler (for stdout)
-    stream_handler = logging.StreamHandler()
-    stream_handler.setLevel(logging.INFO)
-    logger.addHandler(stream_handler)
-
-# Example log message
-logger.info(f"Starting QR script. My direction is {DIRECTION}")
-
-jwt_token = None
-
-ENTRANCE_UUID = os.getenv("ENTRANCE_UUID")
-HOSTNAME = os.getenv("HOSTNAME")
-USERNAME = os.getenv("USERNAME")
-PASSWORD = os.getenv("PASSWORD")
-USE_LCD = int(os.getenv("USE_LCD", 1))
-RELAY_PIN_DOOR = int(os.getenv("RELAY_PIN_DOOR", 10))
-RELAY_PIN_DISPLAY = int(os.getenv("RELAY_PIN_DISPLAY")) if os.getenv("RELAY_PIN_DISPLAY") else None
-RELAY_TOGGLE_DURATION = float(os.getenv("RELAY_TOGGLE_DURATION", 1))
-RELAY_TRIGGER = os.getenv("RELAY_TRIGGER", "HIGH")
-RELAY_ON = GPIO.HIGH if RELAY_TRIGGER == "HIGH" else GPIO.LOW
-RELAY_OFF = GPIO.LOW if RELAY_TRIGGER == "HIGH" else GPIO.HIGH
-OPEN_N_TIMES = int(os.getenv("OPEN_N_TIMES", 1))
-IS_SERIAL_DEVICE = os.getenv("IS_SERIAL_DEVICE").lower() == "true"
-OUTPUT_ENDIAN = os.getenv("OUTPUT_ENDIAN", "big")
-AS_HEX = os.getenv("AS_HEX").lower() == "true"
-HAS_CAMERA = os.getenv("HAS_CAMERA").lower() == "true"
-USE_CAMERA = HAS_CAMERA and ENTRANCE_DIRECTION == DIRECTION
-if USE_CAMERA:
-    RECORDING_DIR = os.getenv("RECORDING_DIR")
-    CAMERA_SLEEP_DURATION = float(os.getenv("CAMERA_SLEEP_DURATION", 0.4))
-
-if USE_LCD:
-    try:
-        LCD_I2C_ADDRESS = int(os.getenv("LCD_I2C_ADDRESS", 0x27), 16)
-    except Exception as e:
-        logger.warning(
-            f"Error parsing LCD I2C address: {e}. "
-            f"Continuing without. The Address is: {os.getenv('LCD_I2C_ADDRESS', 0x27)}")
-        USE_LCD = False
-
-QR_USB_DEVICE_PATH = os.getenv("QR_USB_DEVICE_PATH")
+def direction_logger(direction):
+    """Child of the qr_logger whose lines start with the direction."""
+    direction_log = logging.getLogger(f"qr_logger.{direction or 'default'}")
+    if not direction_log.filters:
+        direction_log.addFilter(DirectionFilter(direction))
+    return direction_log
 
-logger.info("using relay pin %s for the door. My direction is %s", RELAY_PIN_DOOR, DIRECTION)
 
-# Initialize Relay
-relay_pin = RELAY_PIN_DOOR
-RELAY_PIN_QR_READER = 22  # Hopefully we never again have to use a relay to restart the qr reader
-GPIO.setmode(GPIO.BCM)  # Use Broadcom pin numbering
-GPIO.setup(relay_pin, GPIO.OUT)  # Set pin as an output pin
+def auth_headers(jwt_token):
+    """Headers of a backend request. Without a token they go out unauthorized rather than with "Bearer None"."""
+    headers = {"Content-Type": "application/json"}
+    if jwt_token is not None:
+        headers["Authorization"] = f"Bearer {jwt_token}"
+    return headers
+
+
+def _flag(environ, name, default="False"):
+    return environ.get(name, default).lower() == "true"
+
+
+@dataclass
+class TurnstileSettings:
+    """Configuration of the service of one direction, see `from_env` for the variables."""
+
+    hostname: Optional[str] = None
+    username: Optional[str] = None
+    password: Optional[str] = None
+    direction: Optional[str] = None
+    entrance_direction: Optional[str] = None
+    entrance_uuid: Optional[str] = None
+    scanner_path: Optional[str] = None
+    is_serial_device: bool = False
+    as_hex: bool = AS_HEX
+    use_lcd: bool = True
+    lcd_i2c_address: int = 0x27
+    dark_mode: bool = False
+    relay_pin_door: int = 10
+    relay_pin_display: Optional[int] = None
+    relay_toggle_duration: float = 1.0
+    relay_trigger: str = "HIGH"
+    open_n_times: int = 1
+    has_camera: bool = False
+    recording_dir: Optional[str] = None
+    camera_sleep_duration: float = 0.4
+    # "file" triggers a local recorder over the socket or leaves files for mqtt_sender, "mqtt"
+    # publishes straight to the broker for a camera on another device
+    trigger_transport: str = "file"
+    mqtt_broker: str = "127.0.0.1"
+    mqtt_port: int = 1883
+    mqtt_message_ttl: Optional[float] = 30.0
+    mqtt_username: Optional[str] = None
+    mqtt_password: Optional[str] = None
+    # Stays "json" until every receiver understands the binary format
+    mqtt_payload_format: str = trigger_payload.JSON
+    heartbeat_path: Optional[str] = None
+    heartbeat_interval: float = HEARTBEAT_INTERVAL
+    audit_log_dir: Optional[str] = None
+
+    def __post_init__(self):
+        if self.heartbeat_path is None:
+            self.heartbeat_path = str(current_dir / f"heartbeat-{self.direction}.json")
+
+    @property
+    def use_camera(self):
+        return self.has_camera and self.entrance_direction == self.direction
+
+    @classmethod
+    def from_env(cls, hardware=None, environ=None):
+        """
+        Parse the settings from the environment, `os.environ` by default.
+
+        DIRECTION A and B override the entrance, relay pins and LCD address with their own
+        variables and use the first serial or keyboard scanner `hardware` finds.
+
+        Raises:
+            NoDeviceFoundError: If DIRECTION A or B has no scanner.
+        """
+        environ = os.environ if environ is None else environ
+        hardware = hardware or load_backend()
+        direction = environ.get("DIRECTION")
+        use_lcd = bool(int(environ.get("USE_LCD", 1)))
+        lcd_address = environ.get("LCD_I2C_ADDRESS", "0x27")
+        entrance_uuid = environ.get("ENTRANCE_UUID")
+        relay_pin_door = environ.get("RELAY_PIN_DOOR", "10")
+        relay_pin_display = environ.get("RELAY_PIN_DISPLAY")
+        is_serial_device = _flag(environ, "IS_SERIAL_DEVICE")
+        scanner_path = environ.get("QR_USB_DEVICE_PATH")
+
+        if direction == "A":
+            entrance_uuid = environ.get("ENTRANCE_UUID_A")
+            try:
+                detected_address = hardware.detect_lcd_address(1)
+                if detected_address:
+                    lcd_address = detected_address
+            except ImportError as e:
+                use_lcd = False
+                qr_logger().warning(f"i2c detection not available: {e}")
+            except Exception as e:
+                qr_logger().warning(f"Failed to detect i2c device: {e}")
+            relay_pin_door = environ.get("RELAY_PIN_A", "24")
+            relay_pin_display = environ.get("RELAY_PIN_DISPLAY_A", "21")
+            is_serial_device = True
+            devices = hardware.find_serial_scanners()
+            if not devices:
+                raise NoDeviceFoundError("No serial device found.")
+            scanner_path = devices[0].path
+        elif direction == "B":
+            entrance_uuid = environ.get("ENTRANCE_UUID_B")
+            lcd_address = "0x27"
+            relay_pin_door = environ.get("RELAY_PIN_B", "10")
+            relay_pin_display = environ.get("RELAY_PIN_DISPLAY_B", "20")
+            is_serial_device = False
+            devices = hardware.find_keyboard_scanners()
+            if not devices:
+                raise NoDeviceFoundError("No keyboard-QR device found.")
+            scanner_path = devices[0].path
 
-if USE_LCD and LCDController:
-    # Initialize LCD
-    try:
-        lcd = LCDController(
-            use_lcd=USE_LCD,
-            lcd_address=LCD_I2C_ADDRESS,
-            dark_mode=DARK_MODE,
-            relay_pin=RELAY_PIN_DISPLAY,
-            relay_trigger=RELAY_TRIGGER,
-        )
-        lcd.display("Inicializando...", "")
-        logger.info("LCD initialized successfully for direction %s.", DIRECTION)
-    except Exception as e:
-        logger.exception(
-            f"Error initializing LCD direction {DIRECTION} on "
-            f"address {LCD_I2C_ADDRESS}. Continuing without LCD: {e}"
+        try:
+            lcd_i2c_address = int(lcd_address, 16)
+        except (TypeError, ValueError) as e:
+            if use_lcd:
+                qr_logger().warning(f"Error parsing LCD I2C address: {e}. Continuing without. The Address is: {lcd_address}")
+            use_lcd, lcd_i2c_address = False, None
+
+        return cls(
+            hostname=environ.get("HOSTNAME"),
+            username=environ.get("USERNAME"),
+            password=environ.get("PASSWORD"),
+            direction=direction,
+            entrance_direction=environ.get("ENTRANCE_DIRECTION"),
+            entrance_uuid=entrance_uuid,
+            scanner_path=scanner_path,
+            is_serial_device=is_serial_device,
+            as_hex=_flag(environ, "AS_HEX"),
+            use_lcd=use_lcd,
+            lcd_i2c_address=lcd_i2c_address,
+            dark_mode=_flag(environ, "DARK_MODE"),
+            relay_pin_door=int(relay_pin_door),
+            relay_pin_display=int(relay_pin_display) if relay_pin_display else None,
+            relay_toggle_duration=float(environ.get("RELAY_TOGGLE_DURATION", 1)),
+            relay_trigger=environ.get("RELAY_TRIGGER", "HIGH"),
+            open_n_times=int(environ.get("OPEN_N_TIMES", 1)),
+            has_camera=_flag(environ, "HAS_CAMERA"),
+            recording_dir=environ.get("RECORDING_DIR"),
+            camera_sleep_duration=float(environ.get("CAMERA_SLEEP_DURATION", 0.4)),
+            trigger_transport=environ.get("TRIGGER_TRANSPORT", "file").lower(),
+            mqtt_broker=environ.get("MQTT_BROKER", "127.0.0.1"),
+            mqtt_port=int(environ.get("MQTT_PORT", 1883)),
+            # In memory only, triggers older than the TTL are useless to the camera anyway
+            mqtt_message_ttl=float(environ.get("MQTT_MESSAGE_TTL", 30)) or None,
+            mqtt_username=environ.get("MQTT_USERNAME"),
+            mqtt_password=environ.get("MQTT_PASSWORD"),
+            mqtt_payload_format=environ.get("MQTT_PAYLOAD_FORMAT", trigger_payload.JSON).lower(),
+            heartbeat_path=environ.get("HEARTBEAT_FILE_PATH"),
+            audit_log_dir=environ.get("AUDIT_LOG_DIR"),
         )
-        USE_LCD = False
-elif USE_LCD and not LCDController:
-    logger.warning("LCD requested but LCDController not available. Continuing without LCD.")
-    USE_LCD = False
 
 
-def display_on_lcd(line1, line2, timeout=None):
-    if not USE_LCD:
-        logger.info(line1)
-        logger.info(line2)
-    else:
-        lcd.display(line1, line2, timeout)
-
+class TurnstileService:
+    """
+    Door controller of one direction.
+
+    Construction only wires the dependencies together. `start()` sets up the relay and the LCD,
+    connects the scanner, logs in and runs the reader loop and the heartbeat in the background
+    until `stop()`. Dependencies that are passed in belong to the caller, who starts them, and stay
+    open on `stop()`, so several directions can share a publisher or a token manager.
+
+    Args:
+        settings (TurnstileSettings): Configuration of the direction.
+        hardware (optional): Device backend, `hardware.load_backend()` by default.
+        token_manager (utils.TokenManager, optional): Defaults to one logging in with the credentials of the settings.
+        audit_log (AuditLog, optional): Defaults to the log of the direction below `settings.audit_log_dir`.
+        http (optional): Sends the backend requests, e.g. a `requests.Session`. Defaults to the `requests` module.
+        lcd (LCDController, optional): Defaults to one on `settings.lcd_i2c_address` if `settings.use_lcd` is set.
+        mqtt_trigger (MqttPublisher, optional): Publisher of the camera triggers with the "mqtt" trigger transport.
+        customers (dict, optional): Offline customer cache. Defaults to customers.json, see `load_customers_cache`.
+    """
+
+    def __init__(self, settings, hardware=None, token_manager=None, audit_log=None, http=None, lcd=None,
+                 mqtt_trigger=None, customers=None):
+        # requests and sentry_sdk are the slowest imports by far, only services pay for them
+        import requests
+        from utils import TokenManager
+
+        self.settings = settings
+        self.logger = direction_logger(settings.direction)
+        self._owns_hardware = hardware is None
+        self.hardware = hardware or load_backend()
+        self.gpio = self.hardware.gpio()
+        self.relay_on = self.gpio.HIGH if settings.relay_trigger == "HIGH" else self.gpio.LOW
+        self.relay_off = self.gpio.LOW if settings.relay_trigger == "HIGH" else self.gpio.HIGH
+        self.http = http or requests
+        self.request_errors = requests.exceptions.RequestException
+        self._owns_token_manager = token_manager is None
+        self.token_manager = token_manager or TokenManager(
+            settings.hostname, settings.username, settings.password, self.logger, post_request=self.post_request
+        )
+        self._owns_audit_log = audit_log is None
+        # Every direction keeps its own hash chain
+        self.audit_log = audit_log or AuditLog(
+            os.path.join(settings.audit_log_dir or default_audit_directory(), settings.direction or "default")
+        )
+        # Tells the video uploader to leave the uplink to us while a scan is being verified
+        self.uplink_busy = BusySignal(f"qr-{settings.direction}")
+        self._owns_lcd = lcd is None
+        self.lcd = lcd
+        self._owns_mqtt_trigger = mqtt_trigger is None
+        self.mqtt_trigger = mqtt_trigger
+        self.mqtt_topic = None
+        self.node_id = None
+        self.camera_trigger = None
+        self.recorded_locally = set()  # entrance-log uuids the recorder on this device acknowledged
+        self.customers = customers
+        self.door_relay = None
+        self._tasks = []
+
+    async def start(self):
+        """Open the devices and log in, then run the reader loop and the heartbeat as tasks."""
+        device = await asyncio.to_thread(self.open_devices)
+        if self.customers is None:
+            load_customers_cache()  # parsed before the first tap
+        await self.start_trigger_transport()
+        if self.settings.is_serial_device:
+            reader_loop = self.serial_device_event_loop()
+        else:
+            reader_loop = self.keyboard_event_loop(device)
+        self._tasks = [asyncio.create_task(reader_loop), asyncio.create_task(self.heartbeat())]
 
-def init_qr_device():
-    global dev
-    # Initialize the InputDevice
-    timeout_end_time = time.time() + 300  # 5 minutes from now
-    while time.time() < timeout_end_time:
+    async def run(self):
+        """Start the service and run it until `stop()` or until a task fails."""
+        await self.start()
         try:
-            dev = (
-                serial.Serial(QR_USB_DEVICE_PATH, baudrate=9600, timeout=0.1)
-                if IS_SERIAL_DEVICE
-                else InputDevice(QR_USB_DEVICE_PATH)
+            done, _ = await asyncio.wait(self._tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            await self.stop()
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+
+    async def stop(self):
+        """Cancel the tasks and release the devices. Safe to call more than once."""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.mqtt_topic is not None:
+            if self._owns_mqtt_trigger:
+                await self.mqtt_trigger.stop()
+            self.mqtt_topic = None
+        if self.lcd is not None and self._owns_lcd:
+            self.lcd.clear()
+        if self._owns_token_manager:
+            self.token_manager.stop()
+        if self.door_relay is not None:
+            self.door_relay.stop()
+            self.door_relay = None
+            # Back to input mode, only the pins of this direction
+            self.gpio.cleanup(self.settings.relay_pin_door)
+        if self.camera_trigger is not None:
+            self.camera_trigger.close()
+            self.camera_trigger = None
+        if self._owns_audit_log:
+            self.audit_log.close()
+        if self._owns_hardware:
+            self.hardware.close()
+
+    def open_devices(self):
+        """Set up the relay and the LCD, connect the scanner and log in. Blocks, `start()` runs it in a thread."""
+        settings = self.settings
+        self.logger.info("using relay pin %s for the door. My direction is %s", settings.relay_pin_door, settings.direction)
+        self.gpio.setmode(self.gpio.BCM)  # Use Broadcom pin numbering
+        self.gpio.setup(settings.relay_pin_door, self.gpio.OUT)  # Set pin as an output pin
+        self.door_relay = RelayDriver(settings.relay_pin_door, self.gpio, self.relay_on, self.relay_off)
+        if self.lcd is None and settings.use_lcd:
+            self.lcd = self.open_lcd()
+        if settings.use_camera:
+            self.camera_trigger = TriggerSender(trigger_socket_path(settings.recording_dir))
+        device = self.init_qr_device()
+        self.login()
+        return device
+
+    def open_lcd(self):
+        try:
+            from lcd_controller import LCDController
+        except ImportError as e:
+            self.logger.warning(f"LCD requested but LCDController not available: {e}. Continuing without LCD.")
+            return None
+        settings = self.settings
+        try:
+            lcd = LCDController(
+                use_lcd=True,
+                lcd_address=settings.lcd_i2c_address,
+                dark_mode=settings.dark_mode,
+                relay_pin=settings.relay_pin_display,
+                relay_trigger=settings.relay_trigger,
+                hardware=self.hardware,
             )
-            logger.info("Successfully connected to the QR code scanner.")
-            display_on_lcd("Conectado al", "escaneador QR")
-
-            if IS_SERIAL_DEVICE:
-                # we were just testing the serial connection
-                dev.close()
-            return dev
-        except FileNotFoundError:
-            logger.warning("Failed to connect to the QR code scanner. Retrying in 15 seconds...")
-            display_on_lcd("Fallo al conectar", "Cambia USB en 15s")
-            time.sleep(15)  # Wait for 15 seconds before retrying
-    # If we get to this point and `dev` is not defined, we've exhausted our retries
-    if "dev" not in locals():
-        logger.error("Failed to connect to the QR code scanner after multiple attempts.")
-        display_on_lcd("No se pudo conectar", "Verifica USB")
-    return dev
-
+            lcd.display("Inicializando...", "")
+            self.logger.info("LCD initialized successfully for direction %s.", settings.direction)
+            return lcd
+        except Exception as e:
+            self.logger.exception(
+                f"Error initializing LCD direction {settings.direction} on "
+                f"address {settings.lcd_i2c_address}. Continuing without LCD: {e}"
+            )
+            return None
 
-# List to hold decoded QR data
-shared_list = []
+    def display_on_lcd(self, line1, line2, timeout=None):
+        if self.lcd is None:
+            self.logger.info(line1)
+            self.logger.info(line2)
+        else:
+            self.lcd.display(line1, line2, timeout)
+
+    def init_qr_device(self):
+        settings = self.settings
+        # Initialize the InputDevice
+        timeout_end_time = time.time() + 300  # 5 minutes from now
+        while time.time() < timeout_end_time:
+            try:
+                dev = (
+                    self.hardware.serial_scanner(settings.scanner_path, timeout=0.1)
+                    if settings.is_serial_device
+                    else self.hardware.keyboard_scanner(settings.scanner_path)
+                )
+                self.logger.info("Successfully connected to the QR code scanner.")
+                self.display_on_lcd("Conectado al", "escaneador QR")
+
+                if settings.is_serial_device:
+                    # we were just testing the serial connection
+                    dev.close()
+                return dev
+            except FileNotFoundError:
+                self.logger.warning("Failed to connect to the QR code scanner. Retrying in 15 seconds...")
+                self.display_on_lcd("Fallo al conectar", "Cambia USB en 15s")
+                time.sleep(15)  # Wait for 15 seconds before retrying
+        # We've exhausted our retries
+        self.logger.error("Failed to connect to the QR code scanner after multiple attempts.")
+        self.display_on_lcd("No se pudo conectar", "Verifica USB")
+        return None
 
+    def log_unsuccessful_request(self, response):
+        endpoint = response.url  # Get the URL from the response object
+        log_message = "\n".join(response.text.split("\n")[-4:])
+        self.logger.info(f"Unsuccessful request to endpoint {endpoint}. Response: {log_message}")
+
+    def toggle_relay(self, duration=None, open_n_times=None):
+        """Open the door for `duration` seconds. Returns immediately, the relay driver closes it again."""
+        self.logger.info(f"Toggling relay PIN {self.settings.relay_pin_door}")
+        self.door_relay.open(
+            duration if duration is not None else self.settings.relay_toggle_duration,
+            pulses=open_n_times if open_n_times is not None else self.settings.open_n_times,
+        )
 
-def log_unsuccessful_request(response):
-    endpoint = response.url  # Get the URL from the response object
-    log_message = "\n".join(response.text.split("\n")[-4:])
-    logger.info(f"Unsuccessful request to endpoint {endpoint}. Response: {log_message}")
+    def unpack_barcode(self, barcode_data):
+        try:
+            login_data = json.loads(barcode_data)
+            return login_data["customer_uuid"], login_data["timestamp"]
+        except Exception as e:
+            self.display_on_lcd("codigo", "QR invalido", timeout=2)  # Displays "Invalid QR Code" in Spanish
+            self.logger.error(f"Error unpacking barcode: {e}")
+            self.display_on_lcd("Escanea", "codigo QR")
+            return None, None
 
+    def handle_server_response(self, status_code, first_name=None, payload=None):
+        if status_code == "UserExists":
+            return self.open_door_and_greet(first_name, payload)
 
-def toggle_relay(duration=RELAY_TOGGLE_DURATION, open_n_times=OPEN_N_TIMES):
-    logger.info(f"Toggling relay PIN {relay_pin}")
-    open_duration = duration / open_n_times
-    for _ in range(open_n_times):
-        GPIO.output(relay_pin, RELAY_ON)
-        time.sleep(open_duration)
-    for i in range(10):
-        GPIO.output(relay_pin, RELAY_OFF)
+        elif status_code == "MembershipInactive":
+            self.display_on_lcd("Membresía", "inactiva", timeout=2)
 
+        elif status_code == "UserDoesNotExist":
+            self.display_on_lcd("Usuario", "no existe", timeout=2)
 
-def unpack_barcode(barcode_data):
-    try:
-        login_data = json.loads(barcode_data)
-        return login_data["customer_uuid"], login_data["timestamp"]
-    except Exception as e:
-        display_on_lcd("codigo", "QR invalido", timeout=2)  # Displays "Invalid QR Code" in Spanish
-        logger.error(f"Error unpacking barcode: {e}")
-        display_on_lcd("Escanea", "codigo QR")
-        return None, None
+        else:
+            self.display_on_lcd("Error", "Intenta de nuevo", timeout=2)
 
+        self.record_event(DENIED, payload, reason=status_code or "ServerError")
+        self.display_on_lcd("Escanea", "codigo QR")
+        return False
 
-def handle_server_response(status_code, first_name=None):
-    if status_code == "UserExists":
-        return open_door_and_greet(first_name)
+    def open_door_and_greet(self, first_name, payload=None):
+        if self.settings.entrance_direction == self.settings.direction:
+            greet_word = "Hola"
+        else:
+            greet_word = "Adios"
+        self.logger.info(f"{greet_word}, {first_name}!")
+        self.logger.info(f"Opening door...with pin {self.settings.relay_pin_door}")
 
-    elif status_code == "MembershipInactive":
-        display_on_lcd("Membresía", "inactiva", timeout=2)
+        def display_greeting():
+            self.display_on_lcd(f"{greet_word}", first_name, timeout=3)
+            self.display_on_lcd("Escanea", "codigo QR")
 
-    elif status_code == "UserDoesNotExist":
-        display_on_lcd("Usuario", "no existe", timeout=2)
+        self.toggle_relay()
+        self.record_event(GRANTED, payload, name=first_name)
 
-    else:
-        display_on_lcd("Error", "Intenta de nuevo", timeout=2)
+        # Start a new thread for the display greeting to avoid blocking
+        display_thread = threading.Thread(target=display_greeting, daemon=True)
+        display_thread.start()
 
-    display_on_lcd("Escanea", "codigo QR")
-    return False
+        return True
 
+    def record_event(self, event, payload, name=None, reason=None):
+        """Add a door event to the audit log, `payload` is the entrance log of the scan if there is one."""
+        payload = payload or {}
+        self.audit_log.append(
+            event,
+            direction=self.settings.direction,
+            customer_uuid=payload.get("customer_uuid"),
+            entrance_log_uuid=payload.get("uuid"),
+            name=name,
+            reason=reason,
+        )
 
-def open_door_and_greet(first_name):
-    if ENTRANCE_DIRECTION == DIRECTION:
-        greet_word = "Hola"
-    else:
-        greet_word = "Adios"
-    logger.info(f"{greet_word}, {first_name}!")
-    logger.info(f"Opening door...with pin {RELAY_PIN_DOOR}")
+    def post_request(self, url, headers, payload, retries=10, sleep_duration=10):
+        for i in range(retries):
+            try:
+                response = self.http.post(url, headers=headers, json=payload)
+                return response
+            except self.request_errors as e:
+                self.logger.warning(f"Eerror: {e}. Retrying...")
+                self.display_on_lcd("No internet", "Reintentando...")
+                time.sleep(sleep_duration)  # sleep for 10 seconds before retrying
+        self.logger.error("Exhausted all retries. Check your internet connection.")
+        self.display_on_lcd("Sin internet", "Verifica conexión", timeout=20)
+        return None
 
-    def display_greeting():
-        display_on_lcd(f"{greet_word}", first_name, timeout=3)
-        display_on_lcd("Escanea", "codigo QR")
+    def send_entrance_log(self, url, headers, payload, retries=3, sleep_duration=5):
+        token_refreshed = False
+        for i in range(retries):
+            try:
+                response = self.http.put(url, headers=headers, json=payload)
+                if response.status_code in (401, 403) and not token_refreshed:
+                    self.logger.warning(f"Token rejected when sending entrance log: {response.text}. Refreshing and retrying...")
+                    headers = auth_headers(self.refresh_token())
+                    token_refreshed = True
+                    response = self.http.put(url, headers=headers, json=payload)
+                if response.status_code == 200:
+                    self.logger.info(f"Entrance log sent successfully: {payload}")
+                elif response.status_code == 403:
+                    self.logger.error(f"Permission denied when sending entrance log: {response.text}. headers sent: {headers}")
+                else:
+                    self.logger.error(f"Failed to send entrance log: {response.text}. headers sent: {headers}")
+                return response
+            except self.request_errors as e:
+                self.logger.warning(f"Internet connection error when sending entrance-log: {e}. Retrying...")
+                time.sleep(sleep_duration)  # sleep for 10 seconds before retrying
+        return None
 
-    # Start a new thread to toggle the relay
-    relay_thread = threading.Thread(target=toggle_relay, daemon=True)
-    relay_thread.start()
+    def login(self):
+        jwt_token = self.token_manager.get_token()
+        if jwt_token is None:
+            self.display_on_lcd("Login", "Failed", timeout=2)
+        return jwt_token
 
-    # Start a new thread for the display greeting to avoid blocking
-    display_thread = threading.Thread(target=display_greeting, daemon=True)
-    display_thread.start()
+    def refresh_token(self):
+        jwt_token = self.token_manager.refresh()
+        if jwt_token is None:
+            self.display_on_lcd("Login", "Failed", timeout=2)
+        return jwt_token
 
-    return True
+    async def verify_customer(self, customer_uuid, timestamp):
+        scan_monotonic = time.monotonic()
+        with self.uplink_busy:
+            return await self._verify_customer(customer_uuid, timestamp, scan_monotonic)
 
+    async def _verify_customer(self, customer_uuid, timestamp, scan_monotonic):
+        settings = self.settings
+        payload = {
+            "customer_uuid": customer_uuid,
+            "entrance_uuid": settings.entrance_uuid,
+            "direction": settings.direction,
+            "timestamp": timestamp,
+        }
 
-def load_customers_cache():
-    script_path = pathlib.Path(__file__).parent
-    cache_file_path = script_path / "customers.json"
-    if cache_file_path.exists():
-        with cache_file_path.open() as cache_file:
-            return json.load(cache_file)
-    return {}
+        entrance_log_uuid = generate_uuid_from_string(str(payload))
+        payload["uuid"] = entrance_log_uuid
 
+        if settings.use_camera and await self.trigger_camera(entrance_log_uuid, scan_monotonic):
+            self.recorded_locally.add(entrance_log_uuid)
 
-def post_request(url, headers, payload, retries=10, sleep_duration=10):
-    for i in range(retries):
-        try:
-            response = requests.post(url, headers=headers, json=payload)
-            return response
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Eerror: {e}. Retrying...")
-            display_on_lcd("No internet", "Reintentando...")
-            time.sleep(sleep_duration)  # sleep for 10 seconds before retrying
-    logger.error("Exhausted all retries. Check your internet connection.")
-    display_on_lcd("Sin internet", "Verifica conexión", timeout=20)
-    return None
-
-
-def send_entrance_log(url, headers, payload, retries=3, sleep_duration=5):
-    for i in range(retries):
         try:
-            response = requests.put(url, headers=headers, json=payload)
-            if response.status_code == 200:
-                logger.info(f"Entrance log sent successfully: {payload}")
-            elif response.status_code == 403:
-                logger.error(f"Permission denied when sending entrance log: {response.text}. headers sent: {headers}")
-                refresh_token()
-            else:
-                logger.error(f"Failed to send entrance log: {response.text}. headers sent: {headers}")
-            return response
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Internet connection error when sending entrance-log: {e}. Retrying...")
-            time.sleep(sleep_duration)  # sleep for 10 seconds before retrying
-    return None
-
-
-def generate_uuid_from_string(input_string):
-    # Use a predefined namespace (e.g., UUID namespace for DNS)
-    namespace = uuid.NAMESPACE_DNS
-
-    # Generate a UUID using UUID5, which is based on the SHA-1 hash of a namespace and a name (your string)
-    generated_uuid = uuid.uuid5(namespace, input_string)
-
-    return str(generated_uuid)
-
-
-def login():
-    global jwt_token
-    if jwt_token:
-        return jwt_token
-
-    url = f"{HOSTNAME}/api/token/"
-    payload = {"email": USERNAME, "password": PASSWORD}
-    headers = {"Content-Type": "application/json"}
-
-    response = post_request(url, headers, payload)
+            # The backend requests block and retry with sleeps, in a thread they don't hold up the
+            # scanners and heartbeats of the other directions on the loop
+            return await asyncio.to_thread(self.check_entrance, payload, customer_uuid, timestamp)
+        finally:
+            self.recorded_locally.discard(entrance_log_uuid)
+
+    def check_entrance(self, payload, customer_uuid, timestamp):
+        """Verify the scan against the cache or the backend and open the door or deny. Blocks."""
+        settings = self.settings
+        entrance_log_uuid = payload["uuid"]
+        url = f"{settings.hostname}/verify_customer/"
+
+        headers = auth_headers(self.login())
+
+        if not is_valid_timestamp(timestamp):
+            self.display_on_lcd("Error", "QR vencido", timeout=2)
+            self.mark_denied(entrance_log_uuid)
+            payload["response_code"] = "TimestampExpired"
+            self.record_event(DENIED, payload, reason="TimestampExpired")
+            self.send_entrance_log(url, headers, payload)
+            self.display_on_lcd("Escanea", "codigo QR")
+            return
 
-    if response is None or response.status_code != 200:
-        log_unsuccessful_request(response)
-        display_on_lcd("Login", "Failed", timeout=2)
-        return None
+        if timestamp == MAGIC_TIMESTAMP:  # update the magic timestamp after check to create a proper entrance-log
+            payload["timestamp"] = int(time.time())
 
-    jwt_token = response.json().get("access", None)
-    return jwt_token
+        response = self.get_valid_response(url, headers, payload, customer_uuid)
 
+        if response is None:
+            return
 
-async def verify_customer(customer_uuid, timestamp):
-    global jwt_token
+        if response.status_code in (401, 403):  # Token expired or invalid
+            headers = auth_headers(self.refresh_token())
+            response = self.get_valid_response(url, headers, payload, customer_uuid)
+            if response is None:
+                return
+
+        json_response = response.json()
+        status_code = json_response.get("status_code")
+        first_name = json_response.get("first_name")
+
+        granted = self.handle_server_response(status_code, first_name, payload)
+        if not granted:
+            self.mark_denied(entrance_log_uuid)
+        return granted
+
+    def mark_denied(self, entrance_log_uuid):
+        """
+        Clips of denied entries are kept longest when the recording directory runs full. Only
+        the recorder on this device has its clips there, remote and forwarded ones get no marker.
+        """
+        if entrance_log_uuid not in self.recorded_locally:
+            return
+        try:
+            write_denied_marker(self.settings.recording_dir, entrance_log_uuid)
+        except OSError as e:
+            self.logger.warning(f"Could not mark {entrance_log_uuid} as denied: {e}")
 
-    payload = {
-        "customer_uuid": customer_uuid,
-        "entrance_uuid": ENTRANCE_UUID,
-        "direction": DIRECTION,
-        "timestamp": timestamp,
-    }
+    async def start_trigger_transport(self):
+        settings = self.settings
+        if not settings.use_camera or settings.trigger_transport != "mqtt":
+            return
+        # paho is only needed by services publishing their triggers
+        from mqtt_publisher import MqttPublisher
+        from mqtt_routing import publish_topic
+
+        self.mqtt_topic = publish_topic(settings.direction)
+        self.node_id = default_node_id()
+        if self._owns_mqtt_trigger:
+            # In memory only, triggers older than the TTL are useless to the camera anyway
+            self.mqtt_trigger = MqttPublisher(
+                settings.mqtt_broker,
+                settings.mqtt_port,
+                message_ttl=settings.mqtt_message_ttl,
+                username=settings.mqtt_username,
+                password=settings.mqtt_password,
+            )
+            await self.mqtt_trigger.start()
+        # Receivers estimate our clock offset to convert the scan times into their own clock, binary
+        # triggers carry our node id so they find it even if other senders share the topic
+        clock_responder = ClockSyncResponder(self.mqtt_topic, self.mqtt_trigger.publish_now, self.node_id)
+        self.mqtt_trigger.subscribe(CLOCK_REQUEST_TOPIC, clock_responder.handle_request)
+
+    async def trigger_camera(self, entrance_log_uuid, scan_monotonic):
+        """Trigger the recorder, returns whether the recorder on this device acknowledged it."""
+        settings = self.settings
+        scan_time = wall_time(scan_monotonic)
+        if self.mqtt_topic is not None:
+            # Doesn't wait for the broker, the remote recorder covers the delay with its pre-roll
+            trigger = trigger_payload.Trigger(entrance_log_uuid, round(scan_time, 6), settings.direction, self.node_id)
+            acknowledged = self.mqtt_trigger.publish(
+                self.mqtt_topic, trigger_payload.encode([trigger], settings.mqtt_payload_format)
+            )
+            acknowledged.add_done_callback(lambda future: self.log_trigger_delivery(entrance_log_uuid, future))
+            return False
 
-    entrance_log_uuid = generate_uuid_from_string(str(payload))
-    payload["uuid"] = entrance_log_uuid
+        # A local recorder acknowledges as soon as it is recording, camera_sleep_duration is only the upper bound
+        if await self.camera_trigger.send(entrance_log_uuid, ack_timeout=settings.camera_sleep_duration, scan_time=scan_time):
+            return True
 
-    if USE_CAMERA:
-        filename1 = f"{RECORDING_DIR}/{entrance_log_uuid}.txt"
-        filename2 = f"{RECORDING_DIR}/record.txt"
-        for filename in [filename1, filename2]:
-            with open(filename, "w") as f:
-                f.write("")
-        logger.info(f"sleeping for {CAMERA_SLEEP_DURATION} seconds.")
-        await asyncio.sleep(CAMERA_SLEEP_DURATION)
+        # Nobody listens on the socket, e.g. mqtt_sender forwards the files to a camera on another device
+        filename1 = f"{settings.recording_dir}/{entrance_log_uuid}.txt"
+        filename2 = f"{settings.recording_dir}/record.txt"
+        try:
+            for filename in [filename1, filename2]:
+                with open(filename, "w") as f:
+                    f.write("")
+        except OSError as e:
+            # e.g. a full disk, the scan itself must still go through
+            self.logger.error(f"Failed to trigger the camera for {entrance_log_uuid}: {e}")
+            return False
+        self.logger.info(f"sleeping for {settings.camera_sleep_duration} seconds.")
+        await asyncio.sleep(settings.camera_sleep_duration)
+        return False
 
-    url = f"{HOSTNAME}/verify_customer/"
+    def log_trigger_delivery(self, entrance_log_uuid, future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.logger.error(f"Camera trigger {entrance_log_uuid} was not delivered: {future.exception()}")
+        else:
+            self.logger.info(f"Broker acknowledged camera trigger {entrance_log_uuid} after {future.result() * 1000:.1f}ms")
+
+    def get_valid_response(self, url, headers, payload, customer_uuid):
+        status_code, customer = _find_customer_in_cache(customer_uuid, self.customers)
+        if status_code == "UserExists":
+            self.open_door_and_greet(customer["first_name"], payload)
+            payload["response_code"] = status_code
+            self.send_entrance_log(url, headers, payload, retries=15)
+            return None
+        elif status_code == "OutsideSchedule":
+            self.mark_denied(payload["uuid"])
+            payload["response_code"] = status_code
+            self.record_event(DENIED, payload, reason=status_code)
+            self.send_entrance_log(url, headers, payload, retries=15)
+            self.display_on_lcd("Fuera del", "horario", timeout=2)
+            return None
+        else:
+            response = self.post_request(url, headers, payload, retries=5)
+            if response is not None:
+                self.logger.info(f"Response: {response.json()}")
+
+        if response is None or response.status_code not in (200, 401, 403):
+            self.logger.error(f"Invalid response: {response} {getattr(response, 'headers', None)}")
+            self.handle_server_response(None, payload=payload)
+            if response is not None:
+                self.log_unsuccessful_request(response)
+            return None
+        return response
+
+    async def heartbeat(self):
+        settings = self.settings
+        heartbeat_file = pathlib.Path(settings.heartbeat_path)
+        while True:
+            try:
+                timestamp = int(time.time())
+                heartbeat_data = {"timestamp": timestamp, "direction": settings.direction}
+
+                # Write to the file
+                with heartbeat_file.open("w") as f:
+                    json.dump(heartbeat_data, f)
+
+            except Exception as e:
+                self.logger.error(f"Failed to write heartbeat: {e}")
+
+            await asyncio.sleep(settings.heartbeat_interval)
+
+    def apply_scanned_config(self, data):
+        self.display_on_lcd("aplicando", "configuracion", timeout=2)
+        response = apply_config(data)
+        self.logger.info(f"Config response: {response}")
+        if self.lcd is not None:
+            self.display_on_lcd("ajuste", "aplicado", timeout=2)
+
+    async def keyboard_event_loop(self, device):
+        hardware = self.hardware
+        output_string = ""
+        self.display_on_lcd("Escanea", "codigo QR...")
+
+        async for event in device.async_read_loop():
+            if event.type == hardware.EV_KEY:
+                categorized_event = hardware.categorize(event)
+                if categorized_event.keystate == hardware.KEY_UP:
+                    keycode = categorized_event.keycode
+                    character = KEYMAP.get(keycode, "")
+
+                    if character:
+                        output_string += character
+
+                    if keycode == "KEY_ENTER":
+                        self.logger.info(f"Received raw data: {output_string}")
+
+                        try:
+                            data = _process_ascii_data(output_string, self.settings.as_hex)
+                        except Exception as e:
+                            self.logger.error(f"Error interpreting ascii data: {e}.. data: {output_string}")
+                            output_string = ""
+                            continue
+                        self.logger.info(f"Interpreted data: {data}")
+                        if "config" in data:
+                            self.apply_scanned_config(data)
+                            output_string = ""
+                            continue
+
+                        try:
+                            qr_dict = _load_json_data(data)
+                            customer = qr_dict.get("customer-uuid", qr_dict.get("customer_uuid"))
+                            await self.verify_customer(customer, qr_dict["timestamp"])
+                        except (json.JSONDecodeError, TypeError, AttributeError, KeyError):
+                            await self.verify_customer(data, int(time.time()))
+                        finally:
+                            output_string = ""
+
+    async def serial_device_event_loop(self):
+        self.display_on_lcd("Escanea", "codigo QR...")
+
+        with self.hardware.serial_scanner(self.settings.scanner_path, timeout=0.2) as ser:
+            while True:
+                # Read data from the serial port
+                if ser.in_waiting > 0:
+                    try:
+                        data = _interpret_serial_data(ser, self.settings.as_hex)
+                    except Exception as e:
+                        self.logger.error(f"Error interpreting serial data: {e}.. data: {ser.readline()}")
+                        continue
+                    self.logger.info(f"Interpreted data: {data}")
+                    if "config" in data:
+                        self.apply_scanned_config(data)
+                        continue
+                    try:
+                        qr_dict = _load_json_data(data)
+                        customer = qr_dict.get("customer-uuid", qr_dict.get("customer_uuid"))
+                        await self.verify_customer(customer, qr_dict["timestamp"])
+                    except (json.JSONDecodeError, TypeError, AttributeError, KeyError):
+                        await self.verify_customer(data, int(time.time()))
+                        cleanup_serial_queue(ser)
+                await asyncio.sleep(0.2)
 
-    headers = {
-        "Authorization": f"Bearer {jwt_token}",
-        "Content-Type": "application/json",
-    }
 
-    if not is_valid_timestamp(timestamp):
-        display_on_lcd("Error", "QR vencido", timeout=2)
-        payload["response_code"] = "TimestampExpired"
-        send_entrance_log(url, headers, payload)
-        display_on_lcd("Escanea", "codigo QR")
-        return
+# Parsed customers.json, only re-read when download_customer_db.py rewrites the file
+_customers_cache = {"mtime": None, "customers": {}}
+# (raw reader string, as_hex) -> credential uuid, see _process_ascii_data
+_credential_index = {}
+MAX_CREDENTIAL_INDEX_SIZE = 10000
 
-    if timestamp == MAGIC_TIMESTAMP:  # update the magic timestamp after check to create a proper entrance-log
-        payload["timestamp"] = int(time.time())
 
-    response = get_valid_response(url, headers, payload, customer_uuid)
+def load_customers_cache():
+    script_path = pathlib.Path(__file__).parent
+    cache_file_path = script_path / "customers.json"
+    try:
+        mtime = cache_file_path.stat().st_mtime
+    except FileNotFoundError:
+        return {}
+    if mtime != _customers_cache["mtime"]:
+        with cache_file_path.open() as cache_file:
+            customers = json.load(cache_file)
+        _customers_cache.update(mtime=mtime, customers=customers)
+    return _customers_cache["customers"]
 
-    if response is None:
-        return
 
-    if response.status_code in (401, 403):  # Token expired or invalid
-        headers["Authorization"] = refresh_token()
-        response = get_valid_response(url, headers, payload, customer_uuid)
-        if response is None:
-            return
+def generate_uuid_from_string(input_string):
+    # Use a predefined namespace (e.g., UUID namespace for DNS)
+    namespace = uuid.NAMESPACE_DNS
 
-    json_response = response.json()
-    status_code = json_response.get("status_code")
-    first_name = json_response.get("first_name")
+    # Generate a UUID using UUID5, which is based on the SHA-1 hash of a namespace and a name (your string)
+    generated_uuid = uuid.uuid5(namespace, input_string)
 
-    return handle_server_response(status_code, first_name)
+    return str(generated_uuid)
 
 
 def is_valid_timestamp(timestamp: int):
@@ -426,37 +826,13 @@ def is_valid_timestamp(timestamp: int):
     return True
 
 
-def get_valid_response(url, headers, payload, customer_uuid):
-    status_code, customer = _find_customer_in_cache(customer_uuid)
-    if status_code == "UserExists":
-        open_door_and_greet(customer["first_name"])
-        payload["response_code"] = status_code
-        send_entrance_log(url, headers, payload, retries=15)
-        return None
-    elif status_code == "OutsideSchedule":
-        payload["response_code"] = status_code
-        send_entrance_log(url, headers, payload, retries=15)
-        display_on_lcd("Fuera del", "horario", timeout=2)
-        return None
-    else:
-        response = post_request(url, headers, payload, retries=5)
-        logger.info(f"Response: {response.json()}")
-
-    if response is None or response.status_code not in (200, 401, 403):
-        logger.error(f"Invalid response: {response} {response.headers}")
-        handle_server_response(None)
-        if response:
-            log_unsuccessful_request(response)
-        return None
-    return response
-
-
-def _find_customer_in_cache(customer_uuid):
-    customers = load_customers_cache()
+def _find_customer_in_cache(customer_uuid, customers=None):
+    if customers is None:
+        customers = load_customers_cache()
     customer = customers.get(customer_uuid, None)
     if customer:
         if customer["active_membership"] or customer["is_staff"]:
-            logger.info(f"Found customer {customer_uuid} in cache.")
+            qr_logger().info(f"Found customer {customer_uuid} in cache.")
             if customer.get("entrance_schedules"):
                 if not is_in_schedule(customer):
                     return "OutsideSchedule", None
@@ -488,120 +864,16 @@ def is_in_schedule(customer):
     return False
 
 
-def refresh_token():
-    global jwt_token
-    jwt_token = login()
-    return f"Bearer {jwt_token}"
-
-
-def handle_keyboard_interrupt(vs):
-    logger.warning("Keyboard interrupt received. Stopping video stream and exiting...")
-    lcd.clear()
-    GPIO.cleanup()  # This will reset all GPIO ports you have used in this program back to input mode.
-    exit()
-
-
-async def heartbeat():
-    while True:
-        try:
-            timestamp = int(time.time())
-            heartbeat_data = {"timestamp": timestamp, "direction": DIRECTION}
-
-            # Write to the file
-            heartbeat_file = pathlib.Path(HEARTBEAT_FILE_PATH)
-            with heartbeat_file.open("w") as f:
-                json.dump(heartbeat_data, f)
-
-        except Exception as e:
-            logger.error(f"Failed to write heartbeat: {e}")
-
-        await asyncio.sleep(HEARTBEAT_INTERVAL)
-
-
-async def keyboard_event_loop(device):
-    global shared_list
-    output_string = ""
-    display_on_lcd("Escanea", "codigo QR...")
-
-    async for event in device.async_read_loop():
-        if event.type == evdev.ecodes.EV_KEY:
-            categorized_event = categorize(event)
-            if categorized_event.keystate == KeyEvent.key_up:
-                keycode = categorized_event.keycode
-                character = KEYMAP.get(keycode, "")
-
-                if character:
-                    output_string += character
-
-                if keycode == "KEY_ENTER":
-                    logger.info(f"Received raw data: {output_string}")
-
-                    try:
-                        data = _process_ascii_data(output_string, AS_HEX)
-                    except Exception as e:
-                        logger.error(f"Error interpreting ascii data: {e}.. data: {output_string}")
-                        output_string = ""
-                        continue
-                    logger.info(f"Interpreted data: {data}")
-                    if "config" in data:
-                        display_on_lcd("aplicando", "configuracion", timeout=2)
-                        response = apply_config(data)
-                        logger.info(f"Config response: {response}")
-                        if USE_LCD:
-                            display_on_lcd("ajuste", "aplicado", timeout=2)
-                        output_string = ""
-                        continue
-
-                    try:
-                        qr_dict = _load_json_data(data)
-                        customer = qr_dict.get("customer-uuid", qr_dict.get("customer_uuid"))
-                        await verify_customer(customer, qr_dict["timestamp"])
-                    except (json.JSONDecodeError, TypeError, AttributeError, KeyError):
-                        await verify_customer(data, int(time.time()))
-                    finally:
-                        output_string = ""
-
-
-async def serial_device_event_loop():
-    global shared_list
-    display_on_lcd("Escanea", "codigo QR...")
-
-    with serial.Serial(QR_USB_DEVICE_PATH, baudrate=9600, timeout=0.2) as ser:
-        while True:
-            # Read data from the serial port
-            if ser.in_waiting > 0:
-                try:
-                    data = _interpret_serial_data(ser, AS_HEX)
-                except Exception as e:
-                    logger.error(f"Error interpreting serial data: {e}.. data: {ser.readline()}")
-                    continue
-                logger.info(f"Interpreted data: {data}")
-                if "config" in data:
-                    display_on_lcd("aplicando", "configuracion", timeout=2)
-                    response = apply_config(data)
-                    logger.info(f"Config response: {response}")
-                    if USE_LCD:
-                        display_on_lcd("ajuste", "aplicado", timeout=2)
-                    continue
-                try:
-                    qr_dict = _load_json_data(data)
-                    customer = qr_dict.get("customer-uuid", qr_dict.get("customer_uuid"))
-                    await verify_customer(customer, qr_dict["timestamp"])
-                except (json.JSONDecodeError, TypeError, AttributeError, KeyError):
-                    await verify_customer(data, int(time.time()))
-                    cleanup_serial_queue(ser)
-            await asyncio.sleep(0.2)
-
-
 def cleanup_serial_queue(ser):
     try:
         ser.reset_input_buffer()
     except AttributeError:
-        logger.warning("Serial device does not support reset_input_buffer. Flushing input instead.")
+        qr_logger().warning("Serial device does not support reset_input_buffer. Flushing input instead.")
         try:
             ser.flushInput()
         except Exception as e:
-            logger.warning(f"Failed to flush input buffer: {e}. Continuing without flushing.")
+            qr_logger().warning(f"Failed to flush input buffer: {e}. Continuing without flushing.")
+
 
 def _load_json_data(raw_data):
     try:
@@ -620,7 +892,7 @@ def _interpret_serial_data(ser, as_hex: bool):
     if not ascii_data:
         return None
 
-    logger.info(f"Received: {ascii_data}")
+    qr_logger().info(f"Received: {ascii_data}")
     return _process_ascii_data(ascii_data, as_hex)
 
 
@@ -629,6 +901,16 @@ def _process_ascii_data(ascii_data: str, as_hex: bool):
     if is_json:
         return ascii_data
 
+    credential = _credential_index.get((ascii_data, as_hex))
+    if credential is None:
+        # First tap of this card, remember its credential for the next one
+        credential = _compute_credential(ascii_data, as_hex)
+        if len(_credential_index) < MAX_CREDENTIAL_INDEX_SIZE:
+            _credential_index[(ascii_data, as_hex)] = credential
+    return credential
+
+
+def _compute_credential(ascii_data: str, as_hex: bool) -> str:
     if as_hex:
         hex = _decimal_to_hex(ascii_data)
     else:
@@ -658,28 +940,44 @@ def _hash_uuid(input_string) -> str:
     return str(uuid.uuid5(uuid.NAMESPACE_DNS, input_string))
 
 
-async def main_loop():
-    global shared_list
-
-    login()
-
-    while True:
-        if shared_list:
-            qr_data = shared_list.pop(0)
-            logger.info(f"Received QR data: {qr_data}")
-            customer = qr_data.get("customer-uuid", qr_data.get("customer_uuid"))
-            verify_customer(customer, qr_data["timestamp"])
-        await asyncio.sleep(0.1)  # 1-second delay to avoid busy-waiting
+def main():
+    import sentry_sdk
+    from dotenv import load_dotenv
+    from systemd.journal import JournalHandler
+
+    from utils import SentryLogger
+
+    sentry_sdk.init(
+        dsn=os.getenv("SENTRY_DSN"),
+        environment=os.getenv("SENTRY_ENV"),
+        traces_sample_rate=1.0,
+    )
+    load_dotenv()
+
+    # Service loggers are created from here on, they report errors to sentry
+    logging.setLoggerClass(SentryLogger)
+    logger = qr_logger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(JournalHandler())
+    if os.getenv("ENABLE_STREAM_HANDLER", "False").lower() == "true":
+        # Stream handler (for stdout)
+        stream_handler = logging.StreamHandler()
+        stream_handler.setLevel(logging.INFO)
+        logger.addHandler(stream_handler)
+
+    # HARDWARE_BACKEND=simulated runs everything without the Pi's devices
+    hardware = load_backend()
+    settings = TurnstileSettings.from_env(hardware)
+    service = TurnstileService(settings, hardware=hardware)
+    service.logger.info(f"Starting QR script. My direction is {settings.direction}")
+    profiler.install(f"qr-{settings.direction or 'default'}", log=service.logger)
+    try:
+        asyncio.run(service.run())
+    except KeyboardInterrupt:
+        service.logger.warning("Received exit signal.")
+    finally:
+        hardware.close()
 
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    dev = init_qr_device()
-    refresh_token()
-    try:
-        if IS_SERIAL_DEVICE:
-            loop.run_until_complete(asyncio.gather(serial_device_event_loop(), heartbeat()))
-        else:
-            loop.run_until_complete(asyncio.gather(keyboard_event_loop(dev), main_loop(), heartbeat()))
-    except KeyboardInterrupt:
-        logger.warning("Received exit signal.")
+    main()
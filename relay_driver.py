@@ -0,0 +1,95 @@
+import collections
+import threading
+import time
+
+
+class RelayDriver:
+    """
+    Drives a single relay pin from one long-lived worker thread.
+
+    Calling `open` never blocks: it only moves the deadline of the current open window. Requests
+    that arrive while the relay is already open extend that window instead of starting a second
+    actuation, so rapid consecutive scans can't fight over the pin.
+
+    Args:
+        pin (int): BCM pin number of the relay.
+        gpio: Module or object exposing ``output(pin, level)``, e.g. ``RPi.GPIO``.
+        on_level: Level that closes the relay.
+        off_level: Level that opens the relay.
+        history_size (int, optional): Number of actuations kept in `actuations`. Defaults to 100.
+    """
+
+    def __init__(self, pin, gpio, on_level, off_level, history_size=100):
+        self.pin = pin
+        self.gpio = gpio
+        self.on_level = on_level
+        self.off_level = off_level
+        # (time.monotonic(), level) of every write to the pin, newest last
+        self.actuations = collections.deque(maxlen=history_size)
+
+        self._condition = threading.Condition()
+        self._deadline = None
+        self._reassert_interval = None
+        self._is_on = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=f"relay-{pin}", daemon=True)
+        self._thread.start()
+
+    def open(self, duration, pulses=1):
+        """
+        Keep the relay closed for at least `duration` seconds from now.
+
+        With ``pulses > 1`` the on level is re-asserted every ``duration / pulses`` seconds while
+        the window is open, like the OPEN_N_TIMES setting always did.
+        """
+        with self._condition:
+            deadline = time.monotonic() + duration
+            if self._deadline is not None and self._deadline >= deadline:
+                return
+            self._deadline = deadline
+            self._reassert_interval = duration / pulses if pulses > 1 else None
+            self._condition.notify()
+
+    @property
+    def is_open(self):
+        with self._condition:
+            return self._is_on
+
+    def stop(self):
+        """Release the relay and terminate the worker thread."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _write(self, level):
+        self.gpio.output(self.pin, level)
+        self.actuations.append((time.monotonic(), level))
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+
+                remaining = self._deadline - time.monotonic()
+                if remaining <= 0:
+                    self._write(self.off_level)
+                    self._is_on = False
+                    self._deadline = None
+                    continue
+
+                if not self._is_on:
+                    self._write(self.on_level)
+                    self._is_on = True
+
+                if self._reassert_interval and self._reassert_interval < remaining:
+                    if not self._condition.wait(self._reassert_interval):
+                        self._write(self.on_level)
+                else:
+                    self._condition.wait(remaining)
+
+            if self._is_on:
+                self._write(self.off_level)
+                self._is_on = False
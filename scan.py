@@ -2,16 +2,19 @@ import argparse
 import json
 import logging
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import imutils
 import requests
 from dotenv import load_dotenv
-from imutils.video import VideoStream
-from pyzbar import pyzbar
-from rpi_lcd import LCD
 from unidecode import unidecode
-import RPi.GPIO as GPIO
+
+from camera.motion import MotionMeter
+from camera.qr_pipeline import QrScanPipeline, select_decoder
+from hardware import load_backend
+from relay_driver import RelayDriver
+from utils import TokenManager
 
 
 # Configure logging
@@ -26,22 +29,31 @@ USERNAME = os.getenv("USERNAME")
 PASSWORD = os.getenv("PASSWORD")
 DIRECTION = os.getenv("DIRECTION")
 JWT_TOKEN = os.getenv("JWT_TOKEN")
+SCAN_FPS = int(os.getenv("SCAN_FPS", 30))
+SCAN_WIDTH = int(os.getenv("SCAN_WIDTH", 400))
+QR_DECODER = os.getenv("QR_DECODER", "auto")  # "zbar" or "opencv"
+STATS_INTERVAL = 300  # Seconds between pipeline reports in the log
 
+# HARDWARE_BACKEND=simulated runs everything without the Pi's devices
+hardware = load_backend()
+GPIO = hardware.gpio()
 
 # Initialize Relay
 relay_pin = 24  # Relay is connected to GPIO 24
 GPIO.setmode(GPIO.BCM)  # Use Broadcom pin numbering
 GPIO.setup(relay_pin, GPIO.OUT)  # Set pin as an output pin
+door_relay = RelayDriver(relay_pin, GPIO, GPIO.HIGH, GPIO.LOW)
 
 
 def toggle_relay(duration=1):
-    GPIO.output(relay_pin, GPIO.HIGH)
-    time.sleep(duration)
-    GPIO.output(relay_pin, GPIO.LOW)
+    """Open the door for `duration` seconds. Returns immediately, the relay driver closes it again."""
+    door_relay.open(duration)
 
 
 # Initialize LCD
-lcd = LCD()
+lcd = hardware.lcd(0x27)
+
+token_manager = TokenManager(HOSTNAME, USERNAME, PASSWORD, logging.getLogger("scan"))
 
 
 def display_on_lcd(line1, line2, timeout=None):
@@ -61,13 +73,8 @@ def log_unsuccessful_request(response):
 def login():
     if JWT_TOKEN is not None:
         return JWT_TOKEN
-    url = f"{HOSTNAME}/api/token/"
-    payload = json.dumps({"email": USERNAME, "password": PASSWORD})
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(url, headers=headers, data=payload)
-    if response.status_code != 200:
-        log_unsuccessful_request(response)
-    return response.json()["access"]
+    # Logs in once and renews the token before it expires, not on every scan
+    return token_manager.get_token()
 
 
 def unpack_barcode(barcode_data):
@@ -116,6 +123,9 @@ def verify_customer(customer_uuid, timestamp):
         }
     )
     jwt_token = login()
+    if jwt_token is None:
+        logging.error("Could not get JWT token.")
+        return handle_server_response(None)
     headers = {
         "Authorization": f"Bearer {jwt_token}",
         "Content-Type": "application/json",
@@ -124,7 +134,7 @@ def verify_customer(customer_uuid, timestamp):
 
     if response.status_code != 200:
         log_unsuccessful_request(response)
-        handle_server_response(None)  # This will hit the 'else' in `handle_server_response`
+        return handle_server_response(None)  # This will hit the 'else' in `handle_server_response`
 
     json_response = response.json()
     status_code = json_response.get("status_code")
@@ -133,11 +143,27 @@ def verify_customer(customer_uuid, timestamp):
     return handle_server_response(status_code, first_name)
 
 
-def handle_keyboard_interrupt(vs):
-    logging.warning("Keyboard interrupt received. Stopping video stream and exiting...")
-    vs.stop()
-    lcd.clear()
-    exit()
+def handle_scan(scan):
+    """Verify a decoded code, runs on the verify thread so decoding goes on meanwhile."""
+    logging.info(f"Decoded QR code {(scan.decoded_at - scan.captured_at) * 1000:.0f}ms after capture")
+    try:
+        customer_uuid, timestamp = unpack_barcode(scan.data)
+        if customer_uuid and timestamp:
+            display_on_lcd("Verificando", "usuario...")  # Display message in Spanish for verifying user
+            verify_customer(customer_uuid, timestamp)
+    except Exception as e:
+        logging.exception(f"Error verifying scan: {e}")
+
+
+def open_camera():
+    """`read_frame` and `release` of the Pi camera, or of the backend's camera when it is simulated."""
+    if hardware.name == "real":
+        from imutils.video import VideoStream
+
+        stream = VideoStream(usePiCamera=True).start()
+        return stream.read, stream.stop
+    camera = hardware.camera(0)
+    return (lambda: camera.read()[1]), camera.release
 
 
 def main():
@@ -152,30 +178,53 @@ def main():
     )
     args = vars(ap.parse_args())
     logging.info("Starting video stream...")
-    vs = VideoStream(usePiCamera=True).start()
+    read_frame, release_camera = open_camera()
     time.sleep(2.0)
+
+    # One scan is verified at a time, codes decoded meanwhile are dropped like before the pipeline.
+    # The same code is only reported again 3s after its verification finished.
+    verifier = ThreadPoolExecutor(max_workers=1, thread_name_prefix="verify")
+    verifying = threading.Lock()
+
+    def verify(scan):
+        try:
+            handle_scan(scan)
+        finally:
+            pipeline.restart_repeat(scan.data)
+            verifying.release()
+
+    def on_scan(scan):
+        if not verifying.acquire(blocking=False):
+            logging.info("Dropping a scan decoded while the previous one is verified")
+            return
+        verifier.submit(verify, scan)
+
+    pipeline = QrScanPipeline(
+        read_frame,
+        on_scan,
+        decoder=select_decoder(QR_DECODER)(),
+        fps=SCAN_FPS,
+        width=SCAN_WIDTH,
+        motion=MotionMeter(step=4),
+        repeat_after=3.0,
+    ).start()
     logging.info("Now scan")
     display_on_lcd("Escanea", "codigo QR")
 
     try:
         while True:
-            frame = vs.read()
-            frame = imutils.resize(frame, width=400)
-            barcodes = pyzbar.decode(frame)
-            for barcode in barcodes:
-                try:
-                    barcode_data = barcode.data.decode("utf-8")
-                    customer_uuid, timestamp = unpack_barcode(barcode_data)
-                    if customer_uuid and timestamp:
-                        display_on_lcd("Verificando", "usuario...")  # Display message in Spanish for verifying user
-                        verify_customer(customer_uuid, timestamp)
-                    logging.info("Pausing for 3 seconds...")
-                    time.sleep(3)
-                    break  # break the for loop, to wait for next QR code
-                except KeyboardInterrupt:
-                    handle_keyboard_interrupt(vs)
+            time.sleep(STATS_INTERVAL)
+            logging.info(f"QR pipeline: {dict(pipeline.stats)}, decoder capacity {pipeline.decode_fps()} fps")
     except KeyboardInterrupt:
-        handle_keyboard_interrupt(vs)
+        logging.warning("Keyboard interrupt received. Stopping video stream and exiting...")
+    finally:
+        pipeline.stop()
+        verifier.shutdown(cancel_futures=True)
+        release_camera()
+        door_relay.stop()
+        lcd.clear()
+        GPIO.cleanup()
+        hardware.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+"""
+Minimal in-process MQTT 3.1.1 broker for tests.
+
+Supports CONNECT, PUBLISH with QoS 0 and 1, SUBSCRIBE with wildcards (forwarded as QoS 0),
+UNSUBSCRIBE, PINGREQ and DISCONNECT. It runs its own event loop in a thread so it works with
+paho's threaded clients and with asyncio code alike.
+"""
+import asyncio
+import struct
+import threading
+
+from paho.mqtt.client import topic_matches_sub
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def _packet(packet_type, body, flags=0):
+    return bytes([packet_type << 4 | flags]) + _encode_length(len(body)) + body
+
+
+def _string(data, offset):
+    (length,) = struct.unpack_from("!H", data, offset)
+    return data[offset + 2: offset + 2 + length], offset + 2 + length
+
+
+class BrokerStub:
+    """
+    Args:
+        ack_publishes (bool): Set to False to leave QoS 1 publishes unacknowledged.
+    """
+
+    def __init__(self, ack_publishes=True):
+        self.ack_publishes = ack_publishes
+        self.port = None
+        self.received = []  # (topic, payload, qos, dup)
+        self.connections = 0
+        self._subscriptions = {}  # writer -> set of topic filters
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._changed = threading.Condition()
+
+    def start(self, port=0):
+        self._thread = threading.Thread(target=self._run, args=(port,), daemon=True)
+        self._thread.start()
+        self._ready.wait(5)
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+        self._loop = None
+
+    def drop_clients(self):
+        """Close every client connection, e.g. to simulate a network outage."""
+        future = asyncio.run_coroutine_threadsafe(self._drop_clients(), self._loop)
+        future.result(5)
+
+    def wait_for(self, count, timeout=5):
+        """Wait until `count` publishes were received, returns whether they were."""
+        with self._changed:
+            return self._changed.wait_for(lambda: len(self.received) >= count, timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self, port):
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            for writer in list(self._subscriptions):
+                writer.close()
+            self._loop.run_until_complete(self._cancel_handlers())
+            self._loop.close()
+
+    async def _cancel_handlers(self):
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _drop_clients(self):
+        for writer in list(self._subscriptions):
+            writer.close()
+        self._subscriptions.clear()
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header[0] >> 4, header[0] & 0x0F, await reader.readexactly(length)
+
+    async def _handle(self, reader, writer):
+        self._subscriptions[writer] = set()
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == CONNECT:
+                    self.connections += 1
+                    writer.write(_packet(CONNACK, b"\x00\x00"))
+                elif packet_type == PUBLISH:
+                    self._on_publish(writer, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    packet_id, offset, granted = body[:2], 2, b""
+                    while offset < len(body):
+                        topic_filter, offset = _string(body, offset)
+                        offset += 1  # requested QoS, everything is forwarded with QoS 0
+                        self._subscriptions[writer].add(topic_filter.decode())
+                        granted += b"\x00"
+                    writer.write(_packet(SUBACK, packet_id + granted, flags=0))
+                elif packet_type == UNSUBSCRIBE:
+                    packet_id, offset = body[:2], 2
+                    while offset < len(body):
+                        topic_filter, offset = _string(body, offset)
+                        self._subscriptions[writer].discard(topic_filter.decode())
+                    writer.write(_packet(UNSUBACK, packet_id))
+                elif packet_type == PINGREQ:
+                    writer.write(_packet(PINGRESP, b""))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._subscriptions.pop(writer, None)
+            writer.close()
+
+    def _on_publish(self, writer, flags, body):
+        qos, dup = (flags >> 1) & 0x03, bool(flags & 0x08)
+        topic, offset = _string(body, 0)
+        packet_id = None
+        if qos:
+            packet_id, offset = body[offset: offset + 2], offset + 2
+        topic, payload = topic.decode(), body[offset:]
+        with self._changed:
+            self.received.append((topic, payload, qos, dup))
+            self._changed.notify_all()
+        if qos and self.ack_publishes:
+            writer.write(_packet(PUBACK, packet_id))
+        forwarded = _packet(PUBLISH, struct.pack("!H", len(topic)) + topic.encode() + payload)
+        for subscriber, filters in self._subscriptions.items():
+            if any(topic_matches_sub(topic_filter, topic) for topic_filter in filters):
+                subscriber.write(forwarded)
@@ -0,0 +1,157 @@
+import errno
+import json
+import os
+
+import pytest
+
+import audit_log
+from audit_log import AuditLog, list_segments, query, verify
+
+
+def fill(directory, count, segment_bytes=audit_log.SEGMENT_BYTES):
+    log = AuditLog(str(directory), segment_bytes=segment_bytes, fsync=False)
+    records = [log.append("granted", customer_uuid=f"customer-{i}", name="Ana") for i in range(count)]
+    log.close()
+    return records
+
+
+def test_appends_are_chained_and_verified(tmp_path):
+    records = fill(tmp_path, 10)
+
+    assert [record["seq"] for record in records] == list(range(1, 11))
+    assert records[0]["prev"] == audit_log.GENESIS
+    assert all(record["prev"] == previous["hash"] for previous, record in zip(records, records[1:]))
+    assert verify(str(tmp_path)) == {"ok": True, "records": 10, "seq": 10, "error": None}
+
+
+def test_flush_waits_for_the_group_commit(tmp_path):
+    log = AuditLog(str(tmp_path), fsync=False)
+    for i in range(500):
+        log.append("denied", reason="MembershipInactive")
+
+    assert log.flush(timeout=5)
+    assert len(list(log.query())) == 500
+    # Lines queued while the writer was busy share a commit
+    assert log.commits < 500
+    log.close()
+
+
+@pytest.mark.parametrize(
+    "tamper",
+    [
+        lambda lines: lines[:3] + lines[4:],  # removed
+        lambda lines: lines[:3] + [lines[3].replace('"Ana"', '"Eve"')] + lines[4:],  # edited
+        lambda lines: lines[:3] + [lines[4], lines[3]] + lines[5:],  # reordered
+    ],
+)
+def test_verify_detects_tampering(tmp_path, tamper):
+    fill(tmp_path, 8)
+    (path,) = list_segments(str(tmp_path))
+    with open(path) as f:
+        lines = f.readlines()
+    with open(path, "w") as f:
+        f.writelines(tamper(lines))
+
+    result = verify(str(tmp_path))
+
+    assert not result["ok"]
+    assert result["records"] <= 5
+
+
+def test_segments_rotate_and_range_query_uses_them(tmp_path):
+    records = fill(tmp_path, 300, segment_bytes=4096)
+    assert len(list_segments(str(tmp_path))) > 5
+
+    since, until = records[100]["ts"], records[200]["ts"]
+    found = list(query(str(tmp_path), since, until))
+
+    assert found == [record for record in records if since <= record["ts"] < until]
+    assert list(query(str(tmp_path))) == records
+    assert verify(str(tmp_path))["ok"]
+
+
+def test_reopening_continues_the_chain_after_a_torn_line(tmp_path):
+    fill(tmp_path, 5)
+    (path,) = list_segments(str(tmp_path))
+    with open(path, "a") as f:
+        f.write('{"seq": 6, "ts": 1')  # crash in the middle of a write
+
+    log = AuditLog(str(tmp_path), fsync=False)
+    record = log.append("denied", reason="TimestampExpired")
+    log.close()
+
+    assert record["seq"] == 6
+    assert verify(str(tmp_path)) == {"ok": True, "records": 6, "seq": 6, "error": None}
+
+
+def test_failed_write_is_cut_off_and_not_counted_as_durable(tmp_path, monkeypatch):
+    log = AuditLog(str(tmp_path), fsync=True)
+    for i in range(3):
+        log.append("granted", name="Ana")
+    assert log.flush(timeout=5)
+
+    def failing_fsync(fd):
+        os.write(fd, b'{"seq": 4, "ts": 1')  # torn by the failing disk
+        raise OSError(errno.EIO, "Input/output error")
+
+    monkeypatch.setattr(audit_log.os, "fsync", failing_fsync)
+    log.append("denied", reason="MembershipInactive")
+    log.flush(timeout=5)
+    assert (log.durable_seq, log.lost) == (3, 1)
+
+    monkeypatch.undo()
+    log.append("granted", name="Ana")
+    assert log.flush(timeout=5)
+    log.close()
+    log = AuditLog(str(tmp_path), fsync=False)
+    log.append("granted", name="Ana")
+    log.close()
+
+    assert [(record["seq"], record["event"]) for record in query(str(tmp_path))] == [(i, "granted") for i in range(1, 6)]
+    # A failing disk must not look like tampering
+    assert verify(str(tmp_path)) == {"ok": True, "records": 5, "seq": 5, "error": None}
+
+
+def test_events_queued_during_a_failed_write_are_rechained(tmp_path, monkeypatch):
+    log = AuditLog(str(tmp_path), fsync=True)
+    log.append("granted", name="Ana")
+    assert log.flush(timeout=5)
+    queued = []
+
+    def failing_fsync(fd):
+        monkeypatch.undo()
+        # Appended while the writer is busy with the failing batch
+        queued.extend(log.append("granted", name=name) for name in ("Bea", "Cid"))
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(audit_log.os, "fsync", failing_fsync)
+    log.append("denied", reason="MembershipInactive")
+    log.flush(timeout=5)
+    assert log.flush(timeout=5)
+    assert log.lost == 1
+    log.close()
+
+    assert [record["seq"] for record in queued] == [2, 3]
+    assert [record["name"] for record in query(str(tmp_path))] == ["Ana", "Bea", "Cid"]
+    assert verify(str(tmp_path))["ok"]
+
+
+def test_cli_exports_merged_directions_as_csv(tmp_path, capsys):
+    fill(tmp_path / "A", 3)
+    fill(tmp_path / "B", 2)
+    output = tmp_path / "events.csv"
+    directories = ["--dir", str(tmp_path / "A"), "--dir", str(tmp_path / "B")]
+
+    assert audit_log.main([*directories, "export", "--output", str(output)]) == 0
+    assert audit_log.main([*directories, "verify"]) == 0
+    assert all(result["ok"] for result in json.loads(capsys.readouterr().out).values())
+
+    with open(output) as f:
+        lines = f.read().splitlines()
+    assert lines[0].split(",") == audit_log.CSV_FIELDS
+    assert len(lines) == 6
+
+
+def test_instance_has_no_side_effects_before_the_first_append(tmp_path):
+    AuditLog(str(tmp_path / "log")).close()
+    assert not os.path.exists(tmp_path / "log")
@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+import pytest
+
+from busy_signal import BusySignal, is_busy
+from camera.bandwidth import ThrottledBody, TokenBucket, UploadThrottle, in_hours, parse_hours
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_paces_to_rate_and_lets_large_requests_into_debt():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1000, clock=clock)
+
+    assert bucket.delay(500) == pytest.approx(0.5)  # starts empty
+    clock.now = 1.0
+    assert bucket.delay(5000) == 0  # larger than the bucket, goes through once it is full
+    bucket.consume(5000)
+    assert bucket.delay(100) == pytest.approx(4.1)  # the debt is paid off first
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket(rate=0)
+    bucket.consume(10 ** 9)
+    assert bucket.delay(10 ** 9) == 0
+
+
+@pytest.mark.parametrize(
+    "hours, hour, expected",
+    [
+        ("22-6", 23, True),
+        ("22-6", 3, True),
+        ("22-6", 6, False),
+        ("22-6", 12, False),
+        ("1-5", 1, True),
+        ("1-5", 5, False),
+    ],
+)
+def test_off_peak_hours(hours, hour, expected):
+    assert in_hours(hour, parse_hours(hours)) is expected
+
+
+@pytest.mark.parametrize("hours", ["25-3", "abc", "3"])
+def test_invalid_off_peak_hours(hours):
+    with pytest.raises(ValueError):
+        parse_hours(hours)
+
+
+def test_busy_signal_marks_verifications_in_flight(tmp_path):
+    signal = BusySignal("qr-A", directory=str(tmp_path))
+    assert not is_busy(str(tmp_path))
+    with signal:
+        with signal:
+            assert is_busy(str(tmp_path))
+        assert is_busy(str(tmp_path))
+    assert not is_busy(str(tmp_path))
+
+
+def test_throttle_pauses_while_busy_and_reports_deferred_bytes(tmp_path):
+    throttle = UploadThrottle(rate=0, busy_dir=str(tmp_path), busy_poll_interval=0.02)
+    signal = BusySignal("qr-A", directory=str(tmp_path))
+
+    async def scenario():
+        signal.__enter__()
+        upload = asyncio.create_task(throttle.acquire(1000))
+        await asyncio.sleep(0.1)
+        deferred_while_busy = throttle.deferred_bytes
+        assert not upload.done()
+        signal.__exit__(None, None, None)
+        start = time.monotonic()
+        await upload
+        return deferred_while_busy, time.monotonic() - start
+
+    deferred_while_busy, resume_delay = asyncio.run(scenario())
+    throttle.record(1000)
+
+    assert deferred_while_busy == 1000
+    assert resume_delay < 0.1
+    stats = throttle.stats()
+    assert stats["deferred_bytes"] == 0
+    assert stats["deferred_bytes_total"] == 1000
+    assert stats["uploaded_bytes"] == 1000
+    assert stats["paused_seconds"] > 0
+
+
+def test_body_is_paced_and_paused_while_it_is_sent(tmp_path):
+    throttle = UploadThrottle(rate=0, busy_dir=str(tmp_path), busy_poll_interval=0.02)
+    signal = BusySignal("qr-A", directory=str(tmp_path))
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        body = ThrottledBody(bytes(range(256)) * 4, throttle, loop)
+        assert len(body.read()) == 1024  # a checksum on the event loop isn't throttled
+        body.seek(0)
+        first = await loop.run_in_executor(None, body.read, 512)
+        signal.__enter__()
+        rest = loop.run_in_executor(None, body.read, 512)
+        await asyncio.sleep(0.1)
+        paused = not rest.done()
+        signal.__exit__(None, None, None)
+        return first + await rest, paused
+
+    data, paused = asyncio.run(scenario())
+
+    assert data == bytes(range(256)) * 4
+    assert paused
+    assert throttle.stats()["uploaded_bytes"] == 1024
+    assert throttle.stats()["deferred_bytes_total"] == 512
+
+
+def test_body_is_sent_at_the_rate_limit():
+    throttle = UploadThrottle(rate=200_000)
+
+    async def send():
+        body = ThrottledBody(bytes(100_000), throttle, asyncio.get_running_loop())
+        start = time.monotonic()
+        while await asyncio.get_running_loop().run_in_executor(None, body.read, 10_000):
+            pass
+        return time.monotonic() - start
+
+    # The bucket starts empty, 100 kB at 200 kB/s take half a second
+    assert asyncio.run(send()) == pytest.approx(0.5, abs=0.15)
@@ -0,0 +1,62 @@
+import queue
+import time
+
+import numpy as np
+
+from camera.capture import FrameCapture, FrameEncoder
+from camera.frame_buffer import FrameRingBuffer, compress_frame
+
+
+def synthetic_frame():
+    return np.zeros((24, 32, 3), dtype=np.uint8)
+
+
+class FakeWriter:
+    def __init__(self):
+        self.frames = []
+        self.released = False
+
+    def write(self, frame):
+        self.frames.append(frame)
+
+    def release(self):
+        self.released = True
+
+
+def test_idle_frames_go_to_preroll():
+    preroll = FrameRingBuffer(max_frames=100, max_bytes=10 ** 6)
+    capture = FrameCapture(synthetic_frame, fps=100, preroll=preroll)
+    capture.start()
+    time.sleep(0.2)
+    capture.stop()
+
+    assert len(preroll) > 5
+
+
+def test_frames_are_dropped_and_counted_when_encoder_falls_behind():
+    preroll = FrameRingBuffer(max_frames=100, max_bytes=10 ** 6)
+    capture = FrameCapture(synthetic_frame, fps=100, preroll=preroll)
+    frame_queue = queue.Queue(maxsize=2)
+    capture.start_recording(frame_queue)
+    capture.start()
+    time.sleep(0.2)
+    capture.stop()
+
+    assert frame_queue.qsize() == 2
+    assert capture.dropped_frames == capture.captured_frames - 2 > 0
+
+
+def test_encoder_writes_preroll_before_live_frames():
+    writer = FakeWriter()
+    frame_queue = queue.Queue()
+    preroll = [(0.0, compress_frame(synthetic_frame()))] * 3
+    encoder = FrameEncoder(writer, frame_queue, preroll)
+    encoder.start()
+    live_frame = synthetic_frame()
+    frame_queue.put(live_frame)
+    frame_queue.put(None)
+    encoder.join(timeout=1)
+
+    assert encoder.written_frames == 4
+    assert writer.frames[-1] is live_frame
+    assert writer.released
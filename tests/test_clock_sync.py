@@ -0,0 +1,110 @@
+import asyncio
+import json
+
+import pytest
+
+from clock_sync import REQUEST_TOPIC, ClockSyncClient, ClockSyncResponder, OffsetEstimator, reply_topic
+from mqtt_broker_stub import BrokerStub
+from mqtt_publisher import MqttPublisher
+
+
+@pytest.mark.parametrize("offset", [0.0, 0.25, -3.5])
+def test_estimator_picks_the_sample_with_the_shortest_round_trip(offset):
+    estimator = OffsetEstimator(window=8)
+    # (request leg, reply leg) in seconds, asymmetric legs bias a sample by half their difference
+    for index, (out, back) in enumerate([(0.040, 0.010), (0.002, 0.003), (0.015, 0.030)]):
+        t0 = 1000.0 + index
+        t1 = t0 + out + offset
+        t2 = t1 + 0.001
+        t3 = t2 - offset + back
+        estimator.add(t0, t1, t2, t3)
+
+    assert estimator.offset == pytest.approx(offset - 0.0005, abs=1e-9)
+    assert estimator.best.delay == pytest.approx(0.005)
+    assert estimator.to_local(2000.0 + offset) == pytest.approx(2000.0005)
+    assert estimator.jitter > 0
+    assert estimator.stats()["samples"] == 3
+
+
+def test_estimator_rejects_slow_round_trips():
+    estimator = OffsetEstimator(max_delay=0.1)
+
+    assert estimator.add(0.0, 0.5, 0.5, 1.0) is None
+    assert estimator.offset is None
+    assert estimator.to_local(5.0) == 5.0
+    assert estimator.rejected == 1
+
+
+def test_client_and_responder_exchange():
+    local_time = [100.0]
+    remote_offset = 7.0
+    client = ClockSyncClient("camera-1", clock=lambda: local_time[0])
+    replies = []
+    responder = ClockSyncResponder(
+        "turnstile/gym1/main/A", lambda topic, payload: replies.append((topic, payload)) or True, "scanner-1",
+        clock=lambda: local_time[0] + remote_offset + 0.002,
+    )
+
+    for _ in range(3):
+        request = client.request()
+        local_time[0] += 0.010
+        responder.handle_request(REQUEST_TOPIC, request, received=local_time[0] + remote_offset)
+        local_time[0] += 0.012
+        topic, payload = replies[-1]
+        assert topic == reply_topic("camera-1")
+        node, sample = client.handle_reply(payload)
+        local_time[0] += 1
+
+    assert node == "scanner-1"
+    assert sample.offset == pytest.approx(remote_offset, abs=0.002)
+    assert client.to_local(500.0, "scanner-1") == pytest.approx(500.0 - remote_offset, abs=0.002)
+    # Legacy triggers without a node, the topic has a single sender
+    assert client.to_local(500.0, topic="turnstile/gym1/main/A") == pytest.approx(500.0 - remote_offset, abs=0.002)
+    assert client.to_local(500.0, "scanner-2") == 500.0
+    assert client.to_local(500.0, topic="turnstile/other") == 500.0
+    assert json.loads(replies[0][1])["seq"] == 1
+
+
+def test_senders_sharing_a_topic_keep_their_own_offsets():
+    client = ClockSyncClient("camera-1", clock=lambda: 100.0)
+    for node_id, offset in [("scanner-1", 7.0), ("scanner-2", -3.0)]:
+        replies = []
+        responder = ClockSyncResponder(
+            "home/raspberry", lambda topic, payload: replies.append(payload) or True, node_id, clock=lambda: 100.0 + offset
+        )
+        for _ in range(3):
+            responder.handle_request(REQUEST_TOPIC, client.request(), received=100.0 + offset)
+            client.handle_reply(replies[-1])
+
+    assert client.to_local(500.0, "scanner-1") == pytest.approx(493.0)
+    assert client.to_local(500.0, "scanner-2") == pytest.approx(503.0)
+    # Without a node there is no telling which clock a scan time comes from
+    assert client.to_local(500.0, topic="home/raspberry") == 500.0
+    assert set(client.stats()) == {"scanner-1", "scanner-2"}
+
+
+def test_responder_answers_over_mqtt():
+    async def scenario(port):
+        source = MqttPublisher("127.0.0.1", port)
+        await source.start()
+        responder = ClockSyncResponder("turnstile/gym1/main/A", source.publish_now, "scanner-1")
+        source.subscribe(REQUEST_TOPIC, responder.handle_request)
+
+        camera = MqttPublisher("127.0.0.1", port)
+        await camera.start()
+        client = ClockSyncClient("camera-1")
+        samples = asyncio.Queue()
+        camera.subscribe(reply_topic("camera-1"), lambda topic, payload, received: samples.put_nowait(client.handle_reply(payload, received)))
+        await asyncio.gather(source.wait_connected(5), camera.wait_connected(5))
+        await asyncio.sleep(0.1)  # let the subscriptions reach the broker
+
+        camera.publish_now(REQUEST_TOPIC, client.request())
+        result = await asyncio.wait_for(samples.get(), 5)
+        await asyncio.gather(source.stop(), camera.stop())
+        return result
+
+    with BrokerStub() as broker:
+        node, sample = asyncio.run(scenario(broker.port))
+
+    assert node == "scanner-1"
+    assert abs(sample.offset) < 0.05  # same clock on both ends
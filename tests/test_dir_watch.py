@@ -0,0 +1,47 @@
+import asyncio
+import os
+
+import pytest
+
+from dir_watch import CLOSED, CREATED, MOVED, DirectoryWatcher
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_reports_written_and_moved_files(tmp_path, use_inotify):
+    (tmp_path / "existing.txt").write_text("")
+
+    async def scenario():
+        watcher = DirectoryWatcher(str(tmp_path), poll_interval=0.05, use_inotify=use_inotify)
+        watcher.open()
+        await asyncio.sleep(0.1)  # let the polling fallback take its first snapshot
+        (tmp_path / "written.txt").write_text("data")
+        (tmp_path / "outside.part").write_text("data")
+        os.rename(tmp_path / "outside.part", tmp_path / "moved.mp4")
+
+        events = []
+        while not any(event.name == "moved.mp4" for event in events):
+            received = await watcher.wait(timeout=1)
+            assert received, f"no events, got {events}"
+            events += received
+        backend = watcher.backend
+        watcher.close()
+        return backend, events
+
+    backend, events = asyncio.run(scenario())
+
+    assert backend == ("inotify" if use_inotify else "polling")
+    assert (CREATED, "written.txt") in events
+    assert (CLOSED, "written.txt") in events
+    assert any(event.name == "moved.mp4" and event.kind in (MOVED, CLOSED) for event in events)
+    assert all(event.name != "existing.txt" for event in events)
+
+
+def test_wait_times_out_without_events(tmp_path):
+    async def scenario():
+        watcher = DirectoryWatcher(str(tmp_path))
+        watcher.open()
+        events = await watcher.wait(timeout=0.05)
+        watcher.close()
+        return events
+
+    assert asyncio.run(scenario()) == []
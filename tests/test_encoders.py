@@ -0,0 +1,34 @@
+import cv2
+import pytest
+
+from camera.encoders import SoftwareEncoder, V4L2M2MEncoder, select_encoder
+from camera.synthetic import SyntheticFrameSource
+
+
+def test_software_encoder_writes_synthetic_frames(tmp_path):
+    source = SyntheticFrameSource(width=160, height=120, max_frames=30)
+    path = str(tmp_path / "clip.mp4")
+    # avc1 depends on how OpenCV was built, mp4v is available everywhere
+    encoder = SoftwareEncoder(path, 15, (160, 120), codec="mp4v")
+    while True:
+        ret, frame = source.read()
+        if not ret:
+            break
+        encoder.write(frame)
+    encoder.release()
+
+    clip = cv2.VideoCapture(path)
+    assert clip.get(cv2.CAP_PROP_FRAME_COUNT) == 30
+    assert int(clip.get(cv2.CAP_PROP_FRAME_WIDTH)) == 160
+
+
+def test_unavailable_backend_falls_back_to_software(monkeypatch):
+    monkeypatch.setattr(V4L2M2MEncoder, "is_available", staticmethod(lambda: False))
+
+    assert select_encoder("auto") is SoftwareEncoder
+    assert select_encoder("v4l2m2m") is SoftwareEncoder
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        select_encoder("quicksync")
@@ -0,0 +1,42 @@
+import numpy as np
+
+from camera.frame_buffer import FrameRingBuffer, compress_frame, decompress_frame
+
+
+def test_buffer_keeps_only_the_newest_frames():
+    buffer = FrameRingBuffer(max_frames=3, max_bytes=1024)
+    for i in range(5):
+        buffer.append(float(i), b"x" * 10)
+
+    assert len(buffer) == 3
+    assert [timestamp for timestamp, _ in buffer.drain()] == [2.0, 3.0, 4.0]
+    assert len(buffer) == 0
+    assert buffer.size == 0
+
+
+def test_drain_selects_frames_since_a_time():
+    buffer = FrameRingBuffer(max_frames=10, max_bytes=1024)
+    for i in range(5):
+        buffer.append(float(i), b"x" * 10)
+
+    assert [timestamp for timestamp, _ in buffer.drain(since=2.5)] == [3.0, 4.0]
+    assert len(buffer) == 0
+
+
+def test_buffer_memory_is_bounded_by_bytes():
+    buffer = FrameRingBuffer(max_frames=100, max_bytes=250)
+    for i in range(10):
+        buffer.append(float(i), b"x" * 100)
+
+    assert buffer.size <= 250
+    assert len(buffer) == 2
+
+
+def test_frames_survive_compression():
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    frame[:, 32:] = 255
+
+    restored = decompress_frame(compress_frame(frame))
+
+    assert restored.shape == frame.shape
+    assert np.abs(restored.astype(int) - frame).mean() < 5
@@ -0,0 +1,118 @@
+import asyncio
+import json
+
+import pytest
+
+from hardware import RealBackend, SimulatedBackend, load_backend
+from hardware.simulated import KEYBOARD_SCANNER_PATH, SERIAL_SCANNER_PATH, SimulatedLCD
+from keymap import KEYMAP
+
+
+@pytest.mark.parametrize("name, backend_class", [(None, RealBackend), ("real", RealBackend), ("Simulated", SimulatedBackend)])
+def test_load_backend(monkeypatch, name, backend_class):
+    monkeypatch.delenv("HARDWARE_BACKEND", raising=False)
+    assert isinstance(load_backend(name), backend_class)
+
+
+def test_load_backend_rejects_unknown_names():
+    with pytest.raises(ValueError):
+        load_backend("arduino")
+
+
+def test_gpio_traces_writes_and_requires_setup():
+    gpio = SimulatedBackend().gpio()
+    with pytest.raises(RuntimeError):
+        gpio.output(10, gpio.HIGH)
+
+    gpio.setmode(gpio.BCM)
+    gpio.setup(10, gpio.OUT)
+    gpio.output(10, gpio.HIGH)
+    gpio.output(10, gpio.LOW)
+
+    assert [(pin, level) for _, pin, level in gpio.trace] == [(10, gpio.HIGH), (10, gpio.LOW)]
+    assert gpio.report()[10]["high_writes"] == 1
+
+
+def test_lcd_framebuffer_and_i2c_cost():
+    lcd = SimulatedLCD(0x27, realtime=False)
+    lcd.text("Hola", 1)
+    lcd.text("Ana Maria Gonzalez", 2)
+
+    assert lcd.rows == ["Hola".ljust(16), "Ana Maria Gonzal"]
+    # A command and 16 characters per line, six I2C writes per byte
+    assert lcd.i2c_writes == 2 * 17 * 6
+    assert lcd.busy_seconds == pytest.approx(2 * 17 * lcd.byte_seconds)
+
+    lcd.clear()
+    assert lcd.rows == [" " * 16] * 2
+    assert len(lcd.frames) == 3
+
+
+def test_serial_scanner_delivers_fed_lines():
+    backend = SimulatedBackend()
+    (device,) = backend.find_serial_scanners()
+    assert device.path == SERIAL_SCANNER_PATH
+
+    with backend.serial_scanner(device.path, timeout=0.01) as serial:
+        assert serial.in_waiting == 0
+        assert serial.readline() == b""
+        backend.scanner(device.path).feed('{"customer_uuid":"x"}')
+        assert serial.in_waiting > 0
+        assert serial.readline() == b'{"customer_uuid":"x"}\r\n'
+
+    assert backend.report()["scanners"][SERIAL_SCANNER_PATH]["scans"] == 1
+
+
+def test_scanner_plays_back_its_script(tmp_path):
+    script = tmp_path / "scans.jsonl"
+    script.write_text(json.dumps({"at": 0.05, "data": "second"}) + "\n" + json.dumps({"at": 0, "data": "first"}) + "\n")
+    backend = SimulatedBackend(scanner_script=str(script))
+
+    serial = backend.serial_scanner(SERIAL_SCANNER_PATH, timeout=1)
+
+    assert [serial.readline(), serial.readline()] == [b"first\r\n", b"second\r\n"]
+
+
+def test_keyboard_scanner_types_lines_as_key_events():
+    backend = SimulatedBackend()
+    keyboard = backend.keyboard_scanner(KEYBOARD_SCANNER_PATH)
+
+    async def read_line():
+        typed = ""
+        async for event in keyboard.async_read_loop():
+            key = backend.categorize(event)
+            if event.type == backend.EV_KEY and key.keystate == backend.KEY_UP:
+                if key.keycode == "KEY_ENTER":
+                    return typed
+                typed += KEYMAP[key.keycode]
+
+    async def scenario():
+        reader = asyncio.create_task(read_line())
+        await asyncio.sleep(0.01)
+        backend.scanner(KEYBOARD_SCANNER_PATH).feed('{"customer-uuid":"ab12"}')
+        return await asyncio.wait_for(reader, 1)
+
+    assert asyncio.run(scenario()) == '{"customer-uuid":"ab12"}'
+
+
+def test_camera_delivers_synthetic_frames():
+    cv2 = pytest.importorskip("cv2")
+    backend = SimulatedBackend(realtime=False)
+    camera = backend.camera(0)
+    camera.set(cv2.CAP_PROP_FRAME_WIDTH, 320)
+    camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 240)
+
+    ret, frame = camera.read()
+
+    assert ret and camera.isOpened()
+    assert frame.shape == (240, 320, 3)
+    assert backend.report()["cameras"][0]["frames"] == 1
+
+
+def test_close_writes_the_trace(tmp_path):
+    trace = tmp_path / "trace.json"
+    backend = SimulatedBackend(trace_path=str(trace))
+    backend.lcd(0x27).text("Escanea", 1)
+    backend.close()
+
+    assert json.loads(trace.read_text())["lcd"]["0x27"]["rows"][0].strip() == "Escanea"
@@ -0,0 +1,55 @@
+import pytest
+
+from camera.motion import MotionMeter, StaticFrameHold, idle_tail_end, select_profile
+from camera.recording_session import RecordingSession
+from camera.synthetic import SyntheticFrameSource
+
+
+def scores(source, frames):
+    meter = MotionMeter()
+    result = []
+    for _ in range(frames):
+        _, frame = source.read()
+        result.append((meter.measure(frame), meter.moving))
+    return meter, result[1:]
+
+
+def test_sensor_noise_is_not_motion():
+    meter, result = scores(SyntheticFrameSource(160, 120, moving=lambda i: False, noise=8), 10)
+    assert not any(moving for _, moving in result)
+    assert meter.last_motion_time is None
+    assert select_profile(meter.level) == "static"
+
+
+def test_moving_block_is_motion():
+    meter, result = scores(SyntheticFrameSource(160, 120, noise=8), 10)
+    assert all(moving for _, moving in result)
+    assert meter.last_motion_time is not None
+
+
+def test_static_frames_are_held():
+    hold = StaticFrameHold(3)
+    frames = [object() for _ in range(7)]
+    output = [hold.next(frame, moving=False) for frame in frames[:6]] + [hold.next(frames[6], moving=True)]
+    assert output == [frames[0]] * 3 + [frames[3]] * 3 + [frames[6]]
+
+
+@pytest.mark.parametrize(
+    "last_motion_time, expected",
+    [(None, 12.0), (9.0, 12.0), (11.0, 12.5)],
+)
+def test_idle_tail_end(last_motion_time, expected):
+    assert idle_tail_end(10.0, last_motion_time, min_after_trigger=2, idle_seconds=1.5) == expected
+
+
+def test_trim_cuts_session_and_ranges():
+    session = RecordingSession(clip_start=100.0, duration=6, max_duration=30)
+    session.add("a", 102.0)
+    session.add("b", 104.0)
+
+    session.trim(106.5)
+
+    assert session.end_time == 106.5
+    assert session.ranges == {"a": (2.0, 6.5), "b": (4.0, 6.5)}
+    session.trim(200.0)  # never extends the clip
+    assert session.end_time == 106.5
@@ -0,0 +1,121 @@
+import asyncio
+import socket
+
+import pytest
+
+from mqtt_broker_stub import BrokerStub
+from mqtt_publisher import LatencyHistogram, MqttPublisher, Outbox
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_publishes_with_qos_1_and_records_latency(tmp_path):
+    outbox_path = str(tmp_path / "outbox.jsonl")
+
+    async def scenario(port):
+        publisher = MqttPublisher("127.0.0.1", port, outbox_path=outbox_path)
+        await publisher.start()
+        latencies = await asyncio.wait_for(asyncio.gather(*(publisher.publish("home/raspberry", f"trigger {i}") for i in range(5))), 5)
+        stats = publisher.stats()
+        await publisher.stop()
+        return latencies, stats
+
+    with BrokerStub() as broker:
+        latencies, stats = asyncio.run(scenario(broker.port))
+
+    assert [payload for _, payload, _, _ in broker.received] == [f"trigger {i}".encode() for i in range(5)]
+    assert all(qos == 1 for _, _, qos, _ in broker.received)
+    assert all(latency >= 0 for latency in latencies)
+    assert stats["outbox"] == 0 and stats["latency"]["count"] == 5
+    assert broker.connections == 1
+
+    outbox = Outbox(outbox_path)
+    outbox.load()
+    assert len(outbox) == 0
+
+
+def test_triggers_wait_in_the_outbox_until_the_broker_is_reachable():
+    port = free_port()
+    broker = BrokerStub()
+
+    async def scenario():
+        publisher = MqttPublisher("127.0.0.1", port)
+        await publisher.start()
+        pending = [publisher.publish("home/raspberry", f"trigger {i}") for i in range(3)]
+        await asyncio.sleep(0.2)
+        assert not publisher.connected and len(publisher.outbox) == 3
+        broker.start(port)
+        await asyncio.wait_for(asyncio.gather(*pending), 10)
+        # Survives the broker dropping the connection as well
+        broker.drop_clients()
+        await asyncio.sleep(0.2)
+        later = publisher.publish("home/raspberry", "trigger 3")
+        await asyncio.wait_for(later, 10)
+        await publisher.stop()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        broker.stop()
+
+    assert [payload for _, payload, _, _ in broker.received] == [f"trigger {i}".encode() for i in range(4)]
+    assert broker.connections == 2
+
+
+def test_unacknowledged_messages_survive_a_restart(tmp_path):
+    outbox_path = str(tmp_path / "outbox.jsonl")
+
+    async def publish_unacknowledged(port):
+        publisher = MqttPublisher("127.0.0.1", port, outbox_path=outbox_path)
+        await publisher.start()
+        await publisher.wait_connected(5)
+        publisher.publish("home/raspberry", b"\x01binary")
+        await publisher.stop(timeout=0.2)
+
+    async def resend(port):
+        publisher = MqttPublisher("127.0.0.1", port, outbox_path=outbox_path)
+        await publisher.start()
+        await publisher.wait_connected(5)
+        while len(publisher.outbox):
+            await asyncio.sleep(0.01)
+        await publisher.stop()
+
+    with BrokerStub(ack_publishes=False) as broker:
+        asyncio.run(publish_unacknowledged(broker.port))
+    with BrokerStub() as broker:
+        asyncio.run(asyncio.wait_for(resend(broker.port), 5))
+
+    assert [payload for _, payload, _, _ in broker.received] == [b"\x01binary"]
+
+
+@pytest.mark.parametrize("persistent", [True, False])
+def test_outbox_drops_the_oldest_messages_when_full(tmp_path, persistent):
+    path = str(tmp_path / "outbox.jsonl") if persistent else None
+    outbox = Outbox(path, max_messages=3)
+    for i in range(5):
+        outbox.add("topic", f"message {i}")
+    outbox.remove(next(iter(outbox)).id)
+    outbox.close()
+
+    assert [message.payload for message in outbox] == [b"message 3", b"message 4"]
+    assert outbox.dropped == 2
+    if persistent:
+        reloaded = Outbox(path, max_messages=3)
+        reloaded.load()
+        assert [message.payload for message in reloaded] == [b"message 3", b"message 4"]
+        assert reloaded.add("topic", "next")[0].id == 6
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram(buckets=(0.01, 0.1, 1.0, float("inf")))
+    for latency in (0.005, 0.005, 0.05, 0.5, 3.0):
+        histogram.observe(latency)
+
+    assert histogram.counts == [2, 1, 1, 1]
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(1.0) == 3.0
+    assert histogram.snapshot()["buckets"]["+Inf"] == 1
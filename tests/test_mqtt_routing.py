@@ -0,0 +1,106 @@
+import threading
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from mqtt_broker_stub import BrokerStub
+from mqtt_routing import LEGACY_TOPIC, Route, RoutingTable, parse_routes, publish_topic, trigger_topic
+
+ROUTES = """{
+    "turnstile/gym1/main/+": "/recordings/main",
+    "turnstile/gym1/side/A": {"recording_dir": "/recordings/side", "trigger_socket": "/run/side.sock"},
+    "turnstile/gym1/#": "/recordings/main"
+}"""
+
+
+@pytest.mark.parametrize("topic, recording_dirs", [
+    ("turnstile/gym1/main/A", ["/recordings/main"]),
+    ("turnstile/gym1/side/A", ["/recordings/main", "/recordings/side"]),
+    ("turnstile/gym1/side/B", ["/recordings/main"]),
+    ("turnstile/gym2/main/A", []),
+    (LEGACY_TOPIC, []),
+])
+def test_routes_topics_to_each_recorder_once(topic, recording_dirs):
+    table = RoutingTable(parse_routes(ROUTES))
+
+    assert sorted(route.recording_dir for route in table.match(topic)) == recording_dirs
+
+
+def test_parse_routes():
+    routes = parse_routes(ROUTES)
+
+    assert routes[1] == Route("turnstile/gym1/side/A", "/recordings/side", "/run/side.sock")
+    assert RoutingTable(routes).subscriptions() == ["turnstile/gym1/main/+", "turnstile/gym1/side/A", "turnstile/gym1/#"]
+
+
+@pytest.mark.parametrize("spec", ["not json", "[]", "{}", '{"turnstile/#": {"trigger_socket": "/run/a.sock"}}'])
+def test_parse_routes_rejects_invalid_tables(spec):
+    with pytest.raises(ValueError):
+        parse_routes(spec)
+
+
+def test_without_routes_everything_goes_to_recording_dir(monkeypatch):
+    monkeypatch.delenv("MQTT_ROUTES", raising=False)
+    monkeypatch.delenv("MQTT_TOPIC", raising=False)
+    monkeypatch.delenv("TRIGGER_SOCKET", raising=False)
+    monkeypatch.setenv("RECORDING_DIR", "/recordings")
+
+    assert RoutingTable.from_env().routes == [Route(LEGACY_TOPIC, "/recordings")]
+
+
+@pytest.mark.parametrize("env, topic", [
+    ({}, LEGACY_TOPIC),
+    ({"MQTT_TOPIC": "custom/topic", "MQTT_SITE": "gym1"}, "custom/topic"),
+    ({"MQTT_SITE": "gym1", "MQTT_ENTRANCE": "main"}, "turnstile/gym1/main/A"),
+    ({"MQTT_SITE": "gym1", "ENTRANCE_UUID": "e1"}, "turnstile/gym1/e1/A"),
+])
+def test_publish_topic(monkeypatch, env, topic):
+    for name in ("MQTT_TOPIC", "MQTT_SITE", "MQTT_ENTRANCE", "ENTRANCE_UUID"):
+        monkeypatch.delenv(name, raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+
+    assert publish_topic("A") == topic
+
+
+def test_trigger_topic_rejects_wildcards():
+    assert trigger_topic("gym1", None, None) == "turnstile/gym1/_/_"
+    with pytest.raises(ValueError):
+        trigger_topic("gym/1", "main", "A")
+    with pytest.raises(ValueError):
+        trigger_topic("gym1", "+", "A")
+
+
+def test_broker_only_forwards_routed_topics():
+    table = RoutingTable(parse_routes('{"turnstile/gym1/main/+": "/recordings/main"}'))
+    received = []
+    subscribed = threading.Event()
+    done = threading.Event()
+
+    def on_message(client, userdata, msg):
+        received.append(msg.topic)
+        if msg.payload == b"last":
+            done.set()
+
+    with BrokerStub() as broker:
+        subscriber = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        subscriber.on_message = on_message
+        subscriber.on_subscribe = lambda *args: subscribed.set()
+        subscriber.connect("127.0.0.1", broker.port)
+        subscriber.subscribe([(topic_filter, 1) for topic_filter in table.subscriptions()])
+        subscriber.loop_start()
+        assert subscribed.wait(5)
+
+        publisher = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        publisher.connect("127.0.0.1", broker.port)
+        publisher.loop_start()
+        for topic in ("turnstile/gym1/main/A", "turnstile/gym1/side/A", "turnstile/gym2/main/A", LEGACY_TOPIC):
+            publisher.publish(topic, b"trigger", qos=1).wait_for_publish(5)
+        publisher.publish("turnstile/gym1/main/B", b"last", qos=1).wait_for_publish(5)
+        assert done.wait(5)
+
+        for client in (subscriber, publisher):
+            client.disconnect()
+            client.loop_stop()
+
+    assert received == ["turnstile/gym1/main/A", "turnstile/gym1/main/B"]
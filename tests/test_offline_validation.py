@@ -71,3 +71,16 @@ def test_validate_customer(mock_load_customers_cache, frozen_time, expected_stat
     with freeze_time(frozen_time):
         status_code, customer = _find_customer_in_cache("bd832dfc-f986-49a9-b028-5915a45b3bb1")
         assert status_code == expected_status
+
+
+@pytest.mark.parametrize("raw_data, as_hex, expected", [
+    ("3735928559", True, "dc10a2ef-9752-522c-a971-2d07396b91dd"),
+    ("deadbeef", False, "6090978a-d160-59bc-b185-30388d8c1276"),
+])
+def test_process_ascii_data_is_memoized(raw_data, as_hex, expected):
+    import qr
+
+    qr._credential_index.clear()
+
+    assert qr._process_ascii_data(raw_data, as_hex) == expected
+    assert qr._credential_index[(raw_data, as_hex)] == expected
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import profiler
+from profiler import SamplingProfiler
+
+
+@pytest.fixture
+def door_loop():
+    """An event loop thread named "worker" whose task "door" blocks it, like a slow verification."""
+    loop = asyncio.new_event_loop()
+    stop = threading.Event()
+
+    async def verify():
+        while not stop.is_set():
+            time.sleep(0.005)
+            await asyncio.sleep(0)
+
+    def run():
+        loop.run_until_complete(loop.create_task(verify(), name="door"))
+
+    thread = threading.Thread(target=run, name="worker")
+    thread.start()
+    yield
+    stop.set()
+    thread.join()
+    loop.close()
+
+
+def test_capture_includes_thread_and_task_names(door_loop):
+    stacks, summary = SamplingProfiler("test", interval=0.002).capture(0.3)
+
+    door_stacks = [stack for stack in stacks if stack.startswith("worker;task:door;")]
+    assert door_stacks
+    assert any("verify (test_profiler.py:" in stack for stack in door_stacks)
+    assert summary["samples"] == sum(count for stack, count in stacks.items() if stack.startswith("worker;"))
+
+
+def test_interval_is_stretched_to_bound_the_overhead(door_loop):
+    _, summary = SamplingProfiler("test", interval=0.0001, max_overhead=0.001).capture(0.5)
+
+    assert summary["mean_interval_ms"] > 10 * summary["interval_ms"]
+    assert summary["overhead"] < 0.01
+
+
+def test_profile_writes_collapsed_stacks(tmp_path, door_loop):
+    summary = SamplingProfiler("qr-A", directory=str(tmp_path), interval=0.005).profile(0.1)
+
+    lines = (tmp_path / os.path.basename(summary["path"])).read_text().splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert stack and int(count) > 0
+    assert os.path.basename(summary["path"]).startswith(f"qr-A-{os.getpid()}-")
+    assert (tmp_path / os.path.basename(summary["path"]).replace(".folded", ".json")).exists()
+
+
+def test_install_is_opt_in(monkeypatch):
+    monkeypatch.delenv("PROFILER_ENABLED", raising=False)
+
+    assert profiler.install("test") is None
+
+
+def test_signal_triggers_a_capture(monkeypatch, tmp_path):
+    monkeypatch.setenv("PROFILER_ENABLED", "true")
+    monkeypatch.setenv("PROFILE_SECONDS", "0.1")
+    monkeypatch.setenv("PROFILE_DIR", str(tmp_path))
+    previous = signal.getsignal(profiler.SIGNAL)
+    try:
+        assert profiler.install("test") is not None
+        os.kill(os.getpid(), profiler.SIGNAL)
+        for _ in range(100):
+            if list(tmp_path.glob("test-*.json")):
+                break
+            time.sleep(0.05)
+    finally:
+        signal.signal(profiler.SIGNAL, previous)
+
+    assert len(list(tmp_path.glob("test-*.folded"))) == 1
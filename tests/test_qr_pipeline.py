@@ -0,0 +1,139 @@
+import time
+
+import numpy as np
+import pytest
+
+from camera.motion import MotionMeter
+from camera.qr_pipeline import (
+    Detection,
+    OpenCVDecoder,
+    QrScanPipeline,
+    expand_rect,
+    prepare_frame,
+    select_decoder,
+)
+from camera.synthetic import cv2
+
+
+class FakeDecoder:
+    """Finds the code "A" wherever the image has pixels brighter than 200."""
+
+    def __init__(self):
+        self.shapes = []
+
+    def decode(self, image):
+        self.shapes.append(image.shape)
+        ys, xs = np.nonzero(image > 200)
+        if not len(xs):
+            return []
+        return [Detection("A", (int(xs.min()), int(ys.min()), int(np.ptp(xs)) + 1, int(np.ptp(ys)) + 1))]
+
+
+def frame_with_code(x=100, y=80):
+    frame = np.full((300, 400), 100, np.uint8)
+    frame[y:y + 50, x:x + 50] = 255
+    return frame
+
+
+def test_unknown_decoder_is_rejected():
+    with pytest.raises(ValueError):
+        select_decoder("zxing")
+
+
+@pytest.mark.parametrize(
+    "rect, expected",
+    [((100, 100, 40, 20), (80, 90, 80, 40)), ((5, 0, 40, 20), (0, 0, 65, 30)), ((370, 280, 40, 20), (350, 270, 50, 30))],
+)
+def test_expand_rect_is_clipped(rect, expected):
+    assert expand_rect(rect, 0.5, (300, 400)) == expected
+
+
+def test_prepare_frame_shrinks_and_drops_color():
+    frame = prepare_frame(np.zeros((480, 640, 3), np.uint8), 400)
+    assert frame.shape == (300, 400)
+    assert prepare_frame(np.zeros((240, 320, 3), np.uint8), 400, grayscale=False).shape == (240, 320, 3)
+
+
+def test_roi_follows_the_last_code():
+    decoder = FakeDecoder()
+    pipeline = QrScanPipeline(None, lambda scan: None, decoder=decoder)
+
+    pipeline.process(frame_with_code(), 0.0)
+    pipeline.process(frame_with_code(102, 81), 0.1)
+    pipeline.process(frame_with_code(), 0.2)
+
+    assert decoder.shapes == [(300, 400), (100, 100), (100, 100)]
+    assert pipeline.stats["roi_hits"] == 2
+    assert pipeline.stats["full_frames"] == 1
+
+
+def test_code_moving_out_of_the_roi_falls_back_to_the_full_frame():
+    decoder = FakeDecoder()
+    pipeline = QrScanPipeline(None, lambda scan: None, decoder=decoder)
+
+    pipeline.process(frame_with_code(), 0.0)
+    pipeline.process(frame_with_code(300, 200), 0.1)
+
+    assert decoder.shapes == [(300, 400), (100, 100), (300, 400)]
+    assert pipeline.roi == (275, 175, 100, 100)
+
+
+def test_still_frames_are_skipped_but_decoded_now_and_then():
+    pipeline = QrScanPipeline(None, lambda scan: None, decoder=FakeDecoder(), motion=MotionMeter(), full_frame_every=4)
+
+    for i in range(9):
+        pipeline.process(frame_with_code(), i / 10)
+
+    assert pipeline.stats["decoded"] == 3
+    assert pipeline.stats["still"] == 6
+
+
+def test_repeated_code_is_reported_once():
+    scans = []
+    pipeline = QrScanPipeline(None, scans.append, decoder=FakeDecoder(), repeat_after=60)
+
+    for i in range(5):
+        pipeline.process(frame_with_code(), i / 10)
+
+    assert [scan.data for scan in scans] == ["A"]
+    assert scans[0].captured_at == 0.0
+
+
+def test_repeat_window_restarts_when_the_verification_finished():
+    scans = []
+    pipeline = QrScanPipeline(None, scans.append, decoder=FakeDecoder(), repeat_after=60)
+
+    pipeline.process(frame_with_code(), 0.0)
+    pipeline._last_scan = ("A", time.monotonic() - 61)  # the first report was a minute ago
+    pipeline.restart_repeat("A")  # but its verification only finished now
+    pipeline.process(frame_with_code(), 0.1)
+
+    assert [scan.data for scan in scans] == ["A"]
+
+
+def test_threads_report_scans_of_the_camera():
+    scans = []
+    frames = iter([frame_with_code()] * 3)
+    pipeline = QrScanPipeline(lambda: next(frames, None), scans.append, decoder=FakeDecoder(), fps=100).start()
+    for _ in range(100):
+        if scans:
+            break
+        time.sleep(0.01)
+    pipeline.stop()
+
+    assert [scan.data for scan in scans] == ["A"]
+    assert scans[0].decoded_at >= scans[0].captured_at
+
+
+@pytest.mark.skipif(not OpenCVDecoder.is_available(), reason="OpenCV without QR support")
+def test_opencv_decodes_a_code_in_a_camera_frame():
+    code = cv2.QRCodeEncoder.create().encode('{"customer_uuid": "7"}')
+    code = cv2.copyMakeBorder(code, 4, 4, 4, 4, cv2.BORDER_CONSTANT, value=255)
+    frame = np.full((480, 640, 3), 90, np.uint8)
+    frame[60:360, 100:400] = cv2.cvtColor(cv2.resize(code, (300, 300), interpolation=cv2.INTER_NEAREST), cv2.COLOR_GRAY2BGR)
+
+    detections = OpenCVDecoder().decode(prepare_frame(frame, 400))
+
+    assert [detection.data for detection in detections] == ['{"customer_uuid": "7"}']
+    x, y, width, height = detections[0].rect
+    assert 80 < x < 100 and 55 < y < 75 and 120 < width < 150
@@ -0,0 +1,37 @@
+import os
+
+from camera.recording_session import RecordingSession, read_range
+
+
+def test_triggers_extend_the_session_up_to_the_maximum():
+    session = RecordingSession(clip_start=100.0, duration=6, max_duration=10)
+    session.add("first", 102.0)
+    session.add("second", 103.0)
+    assert session.end_time == 109.0
+
+    session.add("third", 108.0)
+    assert session.end_time == 110.0
+    assert session.ranges == {"first": (2.0, 8.0), "second": (3.0, 9.0), "third": (8.0, 10.0)}
+
+
+def test_scans_before_the_clip_start_at_its_beginning():
+    session = RecordingSession(clip_start=100.0, duration=6, max_duration=30)
+    session.add("late", 99.2)
+
+    assert session.ranges == {"late": (0, 5.2)}
+    assert session.end_time == 105.2
+
+
+def test_save_hardlinks_the_clip_for_every_uuid(tmp_path):
+    clip = tmp_path / "temp_1_.mp4"
+    clip.write_bytes(b"video")
+    session = RecordingSession(clip_start=100.0, duration=6, max_duration=30)
+    session.add("first", 101.0)
+    session.add("second", 104.0)
+
+    paths = session.save(str(clip), str(tmp_path), "mp4")
+
+    assert paths == [str(tmp_path / "first.mp4"), str(tmp_path / "second.mp4")]
+    assert not clip.exists()
+    assert os.path.samefile(paths[0], paths[1])
+    assert read_range(str(tmp_path), "second") == (4.0, 10.0)
@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+from relay_driver import RelayDriver
+
+ON, OFF = 1, 0
+# Generous bound so the tests don't flake on a loaded CI box, a Pi does far better
+MAX_JITTER = 0.05
+
+
+class FakeGPIO:
+    """Records every pin write with a monotonic timestamp."""
+
+    def __init__(self):
+        self.trace = []
+
+    def output(self, pin, level):
+        self.trace.append((time.monotonic(), pin, level))
+
+
+@pytest.fixture
+def gpio():
+    return FakeGPIO()
+
+
+@pytest.fixture
+def relay(gpio):
+    driver = RelayDriver(24, gpio, ON, OFF)
+    yield driver
+    driver.stop()
+
+
+def wait_until_closed(relay, timeout=2):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if relay.actuations and relay.actuations[-1][1] == OFF:
+            return
+        time.sleep(0.005)
+    raise AssertionError("relay was not released in time")
+
+
+def test_open_returns_immediately_and_pulse_has_requested_length(relay, gpio):
+    requested_at = time.monotonic()
+    relay.open(0.2)
+    assert time.monotonic() - requested_at < 0.01
+
+    wait_until_closed(relay)
+    (on_time, _, on_level), (off_time, _, off_level) = gpio.trace
+
+    assert (on_level, off_level) == (ON, OFF)
+    assert on_time - requested_at < MAX_JITTER
+    assert abs((off_time - on_time) - 0.2) < MAX_JITTER
+
+
+def test_overlapping_opens_are_merged_into_one_window(relay, gpio):
+    first_request = time.monotonic()
+    relay.open(0.2)
+    time.sleep(0.1)
+    relay.open(0.2)
+
+    wait_until_closed(relay)
+    levels = [level for _, _, level in gpio.trace]
+    off_time = gpio.trace[-1][0]
+
+    assert levels == [ON, OFF]
+    assert abs((off_time - first_request) - 0.3) < MAX_JITTER
+
+
+def test_shorter_request_does_not_cut_an_open_window(relay, gpio):
+    relay.open(0.3)
+    relay.open(0.05)
+
+    wait_until_closed(relay)
+    on_time, off_time = gpio.trace[0][0], gpio.trace[-1][0]
+
+    assert abs((off_time - on_time) - 0.3) < MAX_JITTER
+
+
+def test_pulses_reassert_the_on_level(relay, gpio):
+    relay.open(0.3, pulses=3)
+
+    wait_until_closed(relay)
+    levels = [level for _, _, level in gpio.trace]
+
+    assert levels == [ON, ON, ON, OFF]
+
+
+def test_stop_releases_an_open_relay(gpio):
+    driver = RelayDriver(24, gpio, ON, OFF)
+    driver.open(10)
+    time.sleep(0.05)
+    driver.stop()
+
+    assert gpio.trace[-1][2] == OFF
+    assert not driver.is_open
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from camera.recording_session import denied_marker_path, range_path, write_denied_marker
+from camera.retention import KEEP_DENIED, OLDEST_FIRST, RetentionManager
+
+KB = 1024
+
+
+@pytest.fixture
+def recording_dir():
+    """A tmpfs directory like the /dev/shm recording directories on the devices."""
+    if not os.path.isdir("/dev/shm"):
+        pytest.skip("no tmpfs at /dev/shm")
+    path = tempfile.mkdtemp(dir="/dev/shm")
+    yield path
+    shutil.rmtree(path)
+
+
+def is_clip(name):
+    return name.endswith(".mp4")
+
+
+def write_clip(recording_dir, name, size, mtime):
+    path = os.path.join(recording_dir, f"{name}.mp4")
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_index_tracks_size_and_counts_hardlinks_once(recording_dir):
+    first = write_clip(recording_dir, "a", 10 * KB, 1)
+    os.link(first, os.path.join(recording_dir, "b.mp4"))
+    write_clip(recording_dir, "c", 5 * KB, 2)
+    retention = RetentionManager(recording_dir, high_water=100 * KB, low_water=50 * KB)
+
+    retention.rescan(is_clip)
+    assert retention.total_bytes == 15 * KB
+
+    retention.discard(first)
+    assert retention.total_bytes == 15 * KB  # b.mp4 still holds the data
+    retention.discard(os.path.join(recording_dir, "b.mp4"))
+    assert retention.total_bytes == 5 * KB
+
+    retention.add(write_clip(recording_dir, "d", 7 * KB, 3))
+    assert retention.total_bytes == 12 * KB
+    assert retention.headroom()["headroom_bytes"] == 88 * KB
+
+
+def test_evicts_oldest_clips_down_to_low_water(recording_dir):
+    retention = RetentionManager(recording_dir, high_water=35 * KB, low_water=20 * KB, policy=OLDEST_FIRST)
+    for index in range(4):
+        retention.add(write_clip(recording_dir, f"clip-{index}", 10 * KB, index))
+    open(range_path(recording_dir, "clip-0"), "w").close()
+
+    evicted = retention.enforce()
+
+    assert [os.path.basename(path) for path in evicted] == ["clip-0.mp4", "clip-1.mp4"]
+    assert sorted(os.listdir(recording_dir)) == ["clip-2.mp4", "clip-3.mp4"]
+    assert retention.total_bytes == 20 * KB
+    assert retention.evicted_bytes == 20 * KB
+    assert retention.enforce() == []
+
+
+def test_keep_denied_evicts_denied_clips_last_and_skips_kept_clips(recording_dir):
+    retention = RetentionManager(recording_dir, high_water=35 * KB, low_water=20 * KB, policy=KEEP_DENIED)
+    for index in range(4):
+        retention.add(write_clip(recording_dir, f"clip-{index}", 10 * KB, index))
+    write_denied_marker(recording_dir, "clip-0")
+
+    evicted = retention.enforce(keep={os.path.join(recording_dir, "clip-1.mp4")})
+
+    assert [os.path.basename(path) for path in evicted] == ["clip-2.mp4", "clip-3.mp4"]
+    assert os.path.exists(denied_marker_path(recording_dir, "clip-0"))
+
+
+def test_evicts_when_the_disk_runs_out_of_space(recording_dir):
+    retention = RetentionManager(recording_dir, high_water=10 ** 12, low_water=10 ** 12)
+    for index in range(3):
+        retention.add(write_clip(recording_dir, f"clip-{index}", 10 * KB, index))
+    retention.min_free = retention.free_bytes() + 15 * KB
+
+    evicted = retention.enforce()
+
+    assert [os.path.basename(path) for path in evicted] == ["clip-0.mp4", "clip-1.mp4"]
+
+
+def test_rescan_removes_stale_denied_markers_without_a_clip(recording_dir):
+    retention = RetentionManager(recording_dir, high_water=100 * KB, low_water=50 * KB, marker_ttl=60)
+    write_clip(recording_dir, "recorded", KB, 1)
+    for uuid in ("recorded", "never-recorded", "being-recorded"):
+        write_denied_marker(recording_dir, uuid)
+    os.utime(denied_marker_path(recording_dir, "recorded"), (1, 1))
+    os.utime(denied_marker_path(recording_dir, "never-recorded"), (1, 1))
+
+    retention.rescan(is_clip)
+
+    assert sorted(os.listdir(recording_dir)) == ["being-recorded.denied", "recorded.denied", "recorded.mp4"]
+
+
+def test_rejects_unknown_policy(recording_dir):
+    with pytest.raises(ValueError):
+        RetentionManager(recording_dir, high_water=1, low_water=1, policy="newest")
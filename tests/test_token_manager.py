@@ -0,0 +1,134 @@
+import base64
+import json
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from utils import TokenManager, decode_jwt_expiry
+
+
+def make_jwt(exp, iat=None):
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+
+    claims = {"exp": exp, **({"iat": iat} if iat is not None else {})}
+    return f"{encode({'alg': 'HS256'})}.{encode(claims)}.signature"
+
+
+def token_response(access, refresh=None):
+    response = MagicMock()
+    response.status_code = 200
+    response.json.return_value = {"access": access, **({"refresh": refresh} if refresh else {})}
+    return response
+
+
+@pytest.mark.parametrize("token, expected", [
+    (make_jwt(1700000000), 1700000000),
+    ("not-a-jwt", None),
+    (None, None),
+])
+def test_decode_jwt_expiry(token, expected):
+    assert decode_jwt_expiry(token) == expected
+
+
+def test_token_is_cached_until_it_expires():
+    post_request = MagicMock(return_value=token_response(make_jwt(time.time() + 3600)))
+    manager = TokenManager("http://backend", "user", "secret", MagicMock(), post_request=post_request)
+
+    first = manager.get_token()
+    assert manager.get_token() == first
+    assert post_request.call_count == 1
+    manager.stop()
+
+
+def test_expired_token_is_renewed_with_refresh_token():
+    post_request = MagicMock(side_effect=[
+        token_response(make_jwt(time.time() - 1), refresh="refresh-token"),
+        token_response(make_jwt(time.time() + 3600)),
+    ])
+    manager = TokenManager("http://backend", "user", "secret", MagicMock(), post_request=post_request)
+
+    manager.get_token()
+    manager.get_token()
+
+    url, _, payload = post_request.call_args_list[1].args
+    assert url == "http://backend/api/token/refresh/"
+    assert payload == {"refresh": "refresh-token"}
+    manager.stop()
+
+
+def test_short_lived_token_is_refreshed_in_background_at_half_its_lifetime():
+    now = time.time()
+    renewed = make_jwt(now + 3600, iat=now)
+    post_request = MagicMock(side_effect=[
+        token_response(make_jwt(now + 0.4, iat=now)),  # lives shorter than the refresh margin
+        token_response(renewed),
+    ])
+    manager = TokenManager("http://backend", "user", "secret", MagicMock(), post_request=post_request, refresh_margin=60)
+
+    manager.get_token()
+    assert manager._timer.interval == pytest.approx(0.2, abs=0.05)
+    time.sleep(0.5)
+
+    assert post_request.call_count == 2
+    assert manager.get_token() == renewed
+    assert manager._timer.interval == pytest.approx(3540, abs=1)
+    manager.stop()
+
+
+def test_token_lifetime_is_immune_to_clock_skew():
+    server_time = time.time() - 7200  # the device clock is ahead, e.g. after booting without an RTC
+    post_request = MagicMock(return_value=token_response(make_jwt(server_time + 600, iat=server_time)))
+    manager = TokenManager("http://backend", "user", "secret", MagicMock(), post_request=post_request)
+
+    token = manager.get_token()
+
+    assert manager.get_token() == token
+    assert post_request.call_count == 1
+    assert manager._timer.interval == pytest.approx(540, abs=1)
+    manager.stop()
+
+
+def test_valid_token_is_served_while_the_background_renewal_waits_for_the_backend():
+    current = make_jwt(time.time() + 3600)
+    renewing = threading.Event()
+    backend_answers = threading.Event()
+
+    def post_request(url, headers, payload):
+        if post_request.calls:
+            renewing.set()
+            backend_answers.wait(5)
+        post_request.calls += 1
+        return token_response(current if post_request.calls == 1 else make_jwt(time.time() + 7200))
+
+    post_request.calls = 0
+    manager = TokenManager("http://backend", "user", "secret", MagicMock(), post_request=post_request)
+    manager.get_token()
+    renewal = threading.Thread(target=manager._background_refresh)
+    renewal.start()
+    assert renewing.wait(5)
+
+    started = time.monotonic()
+    assert manager.get_token() == current
+    assert time.monotonic() - started < 0.1
+
+    backend_answers.set()
+    renewal.join()
+    assert manager.get_token() != current
+    manager.stop()
+
+
+def test_failed_renewal_is_reported_as_none():
+    post_request = MagicMock(side_effect=[token_response(make_jwt(time.time() + 3600)), None, None])
+    manager = TokenManager("http://backend", "user", "secret", MagicMock(), post_request=post_request)
+    current = manager.get_token()
+
+    manager._background_refresh()  # fails, the current token stays valid
+    assert manager.get_token() == current
+
+    post_request.side_effect = [None, None]
+    assert manager.refresh() is None  # rejected by the backend, not handed out again
+    assert manager.auth_header() is None
+    manager.stop()
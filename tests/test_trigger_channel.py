@@ -0,0 +1,93 @@
+import asyncio
+import uuid
+
+from trigger_channel import TriggerListener, TriggerSender
+
+
+def test_trigger_is_delivered_and_acknowledged(tmp_path):
+    path = str(tmp_path / "trigger.sock")
+    entrance_log_uuid = str(uuid.uuid4())
+
+    async def scenario():
+        listener = TriggerListener(path)
+        listener.open()
+        sender = TriggerSender(path)
+
+        async def recorder():
+            triggers = await listener.wait(timeout=1)
+            for received_uuid, address in triggers:
+                listener.ack(received_uuid, address)
+            return triggers
+
+        recorder_task = asyncio.create_task(recorder())
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        delivered = await sender.send(entrance_log_uuid, ack_timeout=1)
+        elapsed = loop.time() - start
+        triggers = await recorder_task
+
+        sender.close()
+        listener.close()
+        return delivered, elapsed, triggers
+
+    delivered, elapsed, triggers = asyncio.run(scenario())
+
+    assert delivered
+    assert elapsed < 0.1
+    assert [received_uuid for received_uuid, _ in triggers] == [entrance_log_uuid]
+
+
+def test_send_reports_missing_recorder(tmp_path):
+    sender = TriggerSender(str(tmp_path / "trigger.sock"))
+
+    assert asyncio.run(sender.send(str(uuid.uuid4()), ack_timeout=0.1)) is False
+    sender.close()
+
+
+def test_invalid_triggers_are_ignored(tmp_path):
+    path = str(tmp_path / "trigger.sock")
+
+    async def scenario():
+        listener = TriggerListener(path)
+        listener.open()
+        sender = TriggerSender(path)
+        sender._get_socket().sendto(b"not-a-uuid", path)
+        triggers = await listener.wait(timeout=0.1)
+        sender.close()
+        listener.close()
+        return triggers
+
+    assert asyncio.run(scenario()) == []
+
+
+def test_oneway_trigger_carries_the_scan_time(tmp_path):
+    path = str(tmp_path / "trigger.sock")
+    entrance_log_uuid = str(uuid.uuid4())
+
+    async def scenario():
+        listener = TriggerListener(path)
+        listener.open()
+        sender = TriggerSender(path)
+        delivered = sender.send_nowait(entrance_log_uuid, scan_time=1700000000.123456)
+        triggers = await listener.wait(timeout=1)
+        scan_times = dict(listener.scan_times)
+        for received_uuid, address in triggers:
+            listener.ack(received_uuid, address)  # nothing to reply to
+        remaining = dict(listener.scan_times)
+        sender.close()
+        listener.close()
+        return delivered, triggers, scan_times, remaining
+
+    delivered, triggers, scan_times, remaining = asyncio.run(scenario())
+
+    assert delivered
+    assert [received_uuid for received_uuid, _ in triggers] == [entrance_log_uuid]
+    assert scan_times == {entrance_log_uuid: 1700000000.123456}
+    assert remaining == {}
+
+
+def test_send_nowait_reports_missing_recorder(tmp_path):
+    sender = TriggerSender(str(tmp_path / "trigger.sock"))
+
+    assert sender.send_nowait(str(uuid.uuid4())) is False
+    sender.close()
@@ -0,0 +1,73 @@
+import json
+import uuid
+
+import pytest
+
+import trigger_payload
+from trigger_payload import Trigger
+
+
+def make_triggers(count):
+    return [Trigger(str(uuid.uuid4()), 1700000000.123456 + i, "A" if i % 2 else None) for i in range(count)]
+
+
+@pytest.mark.parametrize("count", [1, 3, trigger_payload.MAX_BATCH])
+def test_binary_round_trip(count):
+    triggers = make_triggers(count)
+    payload = trigger_payload.encode(triggers)
+
+    assert len(payload) == trigger_payload.HEADER.size + count * trigger_payload.TRIGGER.size
+    assert trigger_payload.decode(payload) == triggers
+
+
+def test_binary_batch_carries_the_node_of_the_sender():
+    triggers = [trigger._replace(node="scanner-1") for trigger in make_triggers(3)]
+    payload = trigger_payload.encode(triggers)
+
+    assert payload[0] == trigger_payload.VERSION_WITH_NODE
+    assert trigger_payload.decode(payload) == triggers
+    # The legacy format has no room for it
+    assert trigger_payload.decode(trigger_payload.encode(triggers[:1], trigger_payload.JSON))[0].node is None
+
+
+@pytest.mark.parametrize("payload, expected", [
+    (b'["6a1b2f1e-64c4-4a26-9a8b-3c1f4e4f2a10", 1700000000]', 1700000000.0),
+    (b' ["6a1b2f1e-64c4-4a26-9a8b-3c1f4e4f2a10", 1700000000.25]\n', 1700000000.25),
+])
+def test_legacy_json_is_detected(payload, expected):
+    assert trigger_payload.decode(payload) == [Trigger("6a1b2f1e-64c4-4a26-9a8b-3c1f4e4f2a10", expected)]
+
+
+def test_json_encoding_matches_the_legacy_format():
+    trigger = make_triggers(1)[0]
+    payload = trigger_payload.encode([trigger], trigger_payload.JSON)
+
+    assert json.loads(payload) == [trigger.uuid, trigger.timestamp]
+    assert trigger_payload.decode(payload) == [trigger._replace(direction=None)]
+
+
+@pytest.mark.parametrize("payload", [
+    b"",
+    b"\x03\x01" + bytes(25),  # unknown version
+    b"\x01\x02" + bytes(25),  # count doesn't match the length
+    b"\x01",  # truncated header
+    b"\x02\x01\x05abc" + bytes(25),  # node id longer than the payload
+    b"\x02\x01\x01\xff" + bytes(25),  # node id not UTF-8
+    b'["not-a-uuid", 1700000000]',
+    b'["6a1b2f1e-64c4-4a26-9a8b-3c1f4e4f2a10"]',
+    b"\xff\xfe",
+])
+def test_malformed_payloads_are_rejected(payload):
+    with pytest.raises(ValueError):
+        trigger_payload.decode(payload)
+
+
+def test_encode_rejects_invalid_batches():
+    with pytest.raises(ValueError):
+        trigger_payload.encode(make_triggers(2), trigger_payload.JSON)
+    with pytest.raises(ValueError):
+        trigger_payload.encode(make_triggers(trigger_payload.MAX_BATCH + 1))
+    with pytest.raises(ValueError):
+        trigger_payload.encode([Trigger(str(uuid.uuid4()), 0.0, "AB")])
+    with pytest.raises(ValueError):
+        trigger_payload.encode([trigger._replace(node=f"scanner-{i}") for i, trigger in enumerate(make_triggers(2))])
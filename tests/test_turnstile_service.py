@@ -0,0 +1,243 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import qr
+from audit_log import query
+from hardware import SimulatedBackend
+from hardware.simulated import KEYBOARD_SCANNER_PATH, SERIAL_SCANNER_PATH
+from trigger_channel import TriggerListener, TriggerSender, socket_path
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KNOWN_CUSTOMER = "bd832dfc-f986-49a9-b028-5915a45b3bb1"
+UNKNOWN_CUSTOMER = "0f1e2d3c-4b5a-4968-8776-a5b4c3d2e1f0"
+
+
+class FakeTokenManager:
+    def get_token(self):
+        return "token"
+
+    def refresh(self):
+        return "token"
+
+    def stop(self):
+        pass
+
+
+class FakeHttp:
+    """Answers every verification with `status_code`, records the entrance logs."""
+
+    def __init__(self, status_code="UserDoesNotExist"):
+        self.status_code = status_code
+        self.entrance_logs = []
+
+    def post(self, url, headers, json):
+        return SimpleNamespace(status_code=200, json=lambda: {"status_code": self.status_code}, headers={}, text="", url=url)
+
+    def put(self, url, headers, json):
+        self.entrance_logs.append(json)
+        return SimpleNamespace(status_code=200, text="", url=url)
+
+
+def test_import_has_no_side_effects():
+    code = "import sys, qr; print(sorted(m for m in ('RPi', 'requests', 'sentry_sdk', 'paho', 'systemd') if m in sys.modules))"
+    env = {"PATH": os.environ.get("PATH", ""), "DIRECTION": "A", "HARDWARE_BACKEND": "real"}
+    output = subprocess.run([sys.executable, "-c", code], cwd=REPO, env=env, capture_output=True, text=True, check=True)
+
+    assert output.stdout.strip() == "[]"
+
+
+@pytest.mark.parametrize("direction, scanner_path, is_serial_device, relay_pin_door, relay_pin_display, lcd_address", [
+    ("A", SERIAL_SCANNER_PATH, True, 24, 21, 0x26),  # the address the simulated i2c bus reports
+    ("B", KEYBOARD_SCANNER_PATH, False, 10, 20, 0x27),
+])
+def test_settings_from_env_discover_the_devices_of_a_direction(
+    direction, scanner_path, is_serial_device, relay_pin_door, relay_pin_display, lcd_address
+):
+    environ = {"DIRECTION": direction, f"ENTRANCE_UUID_{direction}": "entrance", "AS_HEX": "True", "RELAY_TRIGGER": "LOW"}
+
+    settings = qr.TurnstileSettings.from_env(SimulatedBackend(), environ)
+
+    assert (settings.scanner_path, settings.is_serial_device) == (scanner_path, is_serial_device)
+    assert (settings.relay_pin_door, settings.relay_pin_display) == (relay_pin_door, relay_pin_display)
+    assert settings.entrance_uuid == "entrance"
+    assert settings.as_hex and settings.relay_trigger == "LOW"
+    assert settings.lcd_i2c_address == lcd_address
+    assert settings.heartbeat_path.endswith(f"heartbeat-{direction}.json")
+
+
+def test_settings_from_env_without_lcd_address():
+    settings = qr.TurnstileSettings.from_env(SimulatedBackend(), {"LCD_I2C_ADDRESS": "lcd"})
+
+    assert not settings.use_lcd
+
+
+def test_services_of_both_directions_share_a_process(tmp_path):
+    hardware = SimulatedBackend(realtime=False)
+    http = FakeHttp()
+    customers = {KNOWN_CUSTOMER: {"first_name": "Ana", "active_membership": True, "is_staff": False}}
+
+    def service(direction, scanner_path, is_serial_device, relay_pin_door):
+        settings = qr.TurnstileSettings(
+            hostname="http://backend",
+            direction=direction,
+            scanner_path=scanner_path,
+            is_serial_device=is_serial_device,
+            use_lcd=False,
+            relay_pin_door=relay_pin_door,
+            heartbeat_path=str(tmp_path / f"heartbeat-{direction}.json"),
+            audit_log_dir=str(tmp_path / "audit_log"),
+        )
+        return qr.TurnstileService(settings, hardware=hardware, token_manager=FakeTokenManager(), http=http, customers=customers)
+
+    services = [service("A", SERIAL_SCANNER_PATH, True, 24), service("B", KEYBOARD_SCANNER_PATH, False, 10)]
+
+    async def scenario():
+        for turnstile in services:
+            await turnstile.start()
+        now = int(time.time())
+        hardware.scanner(SERIAL_SCANNER_PATH).feed(json.dumps({"customer_uuid": KNOWN_CUSTOMER, "timestamp": now}))
+        hardware.scanner(KEYBOARD_SCANNER_PATH).feed(json.dumps({"customer-uuid": UNKNOWN_CUSTOMER, "timestamp": now}))
+        for _ in range(100):
+            if len(http.entrance_logs) == 1 and all(turnstile.audit_log.commits for turnstile in services):
+                break
+            await asyncio.sleep(0.05)
+        for turnstile in services:
+            await turnstile.stop()
+
+    asyncio.run(scenario())
+
+    granted = query(str(tmp_path / "audit_log" / "A"))
+    denied = query(str(tmp_path / "audit_log" / "B"))
+    assert [(record["event"], record["customer_uuid"]) for record in granted] == [("granted", KNOWN_CUSTOMER)]
+    assert [(record["event"], record["reason"]) for record in denied] == [("denied", "UserDoesNotExist")]
+    assert [log["customer_uuid"] for log in http.entrance_logs] == [KNOWN_CUSTOMER]
+    assert {pin for _, pin, level in hardware.gpio().trace if level == hardware.gpio().HIGH} == {24}
+    assert all((tmp_path / f"heartbeat-{direction}.json").exists() for direction in "AB")
+
+
+class RecordingTokenManager(FakeTokenManager):
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class SlowHttp(FakeHttp):
+    def post(self, url, headers, json):
+        time.sleep(0.3)
+        return super().post(url, headers, json)
+
+
+def settings_of(tmp_path, direction="B"):
+    return qr.TurnstileSettings(
+        hostname="http://backend",
+        direction=direction,
+        scanner_path=KEYBOARD_SCANNER_PATH,
+        use_lcd=False,
+        heartbeat_path=str(tmp_path / f"heartbeat-{direction}.json"),
+        audit_log_dir=str(tmp_path / "audit_log"),
+    )
+
+
+def test_stop_leaves_shared_dependencies_open(tmp_path):
+    hardware = SimulatedBackend(realtime=False)
+    token_manager = RecordingTokenManager()
+    lcd = SimpleNamespace(cleared=0)
+    lcd.clear = lambda: setattr(lcd, "cleared", lcd.cleared + 1)
+    services = [
+        qr.TurnstileService(settings_of(tmp_path, direction), hardware=hardware, token_manager=token_manager, lcd=lcd)
+        for direction in "AB"
+    ]
+
+    asyncio.run(services[0].stop())
+
+    assert not token_manager.stopped
+    assert lcd.cleared == 0
+
+
+def test_stop_closes_the_trigger_socket(tmp_path):
+    settings = settings_of(tmp_path)
+    settings.has_camera, settings.entrance_direction, settings.recording_dir = True, "B", str(tmp_path)
+    service = qr.TurnstileService(settings, hardware=SimulatedBackend(realtime=False), token_manager=FakeTokenManager())
+
+    async def scenario():
+        await asyncio.to_thread(service.open_devices)
+        sender = service.camera_trigger
+        await sender.send(UNKNOWN_CUSTOMER, ack_timeout=0.1)  # opens the socket, nobody listens
+        await service.stop()
+        return sender
+
+    sender = asyncio.run(scenario())
+
+    assert service.camera_trigger is None
+    assert sender._sock is None
+
+
+def test_slow_backend_does_not_block_the_event_loop(tmp_path):
+    service = qr.TurnstileService(
+        settings_of(tmp_path), hardware=SimulatedBackend(realtime=False), token_manager=FakeTokenManager(),
+        http=SlowHttp(), customers={},
+    )
+
+    async def scenario():
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        granted = await service.verify_customer(UNKNOWN_CUSTOMER, int(time.time()))
+        ticker.cancel()
+        await service.stop()
+        return granted, max(later - earlier for earlier, later in zip(ticks, ticks[1:]))
+
+    granted, longest_stall = asyncio.run(scenario())
+
+    assert granted is False
+    assert longest_stall < 0.1
+
+
+@pytest.mark.parametrize("local_recorder", [True, False])
+def test_denied_entries_are_marked_only_for_a_local_recorder(tmp_path, local_recorder):
+    recording_dir = tmp_path / "recordings"
+    recording_dir.mkdir()
+    settings = settings_of(tmp_path)
+    settings.has_camera, settings.entrance_direction, settings.recording_dir = True, "B", str(recording_dir)
+    settings.camera_sleep_duration = 0.1
+    service = qr.TurnstileService(
+        settings, hardware=SimulatedBackend(realtime=False), token_manager=FakeTokenManager(), http=FakeHttp(), customers={},
+    )
+    service.camera_trigger = TriggerSender(socket_path(str(recording_dir)))
+
+    async def scenario():
+        listener = TriggerListener(socket_path(str(recording_dir)))
+        if local_recorder:
+            listener.open()
+
+        async def recorder():
+            for received_uuid, address in await listener.wait(timeout=1):
+                listener.ack(received_uuid, address)
+
+        recording = asyncio.create_task(recorder()) if local_recorder else None
+        granted = await service.verify_customer(UNKNOWN_CUSTOMER, int(time.time()))
+        if recording:
+            await recording
+        listener.close()
+        await service.stop()
+        return granted
+
+    assert asyncio.run(scenario()) is False
+    markers = [name for name in os.listdir(recording_dir) if name.endswith(".denied")]
+    # Without a recorder on this device the trigger is left for mqtt_sender, whose camera has its own directory
+    assert len(markers) == (1 if local_recorder else 0)
+    assert not service.recorded_locally
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("aioboto3")
+moto_server = pytest.importorskip("moto.server")
+
+try:
+    import systemd.journal  # noqa: F401
+except ImportError:
+    # The journal only exists on the devices
+    journal = types.ModuleType("systemd.journal")
+    journal.JournalHandler = logging.NullHandler
+    sys.modules.setdefault("systemd", types.ModuleType("systemd")).journal = journal
+    sys.modules["systemd.journal"] = journal
+
+from camera import upload_to_s3
+from camera.recording_session import write_range
+from camera.upload_to_s3 import VideoUploader, read_upload_state, upload_state_path, write_upload_state
+
+MB = 1024 * 1024
+
+
+def get_logger(name=None):
+    """logging.getLogger as the standard library has it."""
+    if not name or name == logging.root.name:
+        return logging.root
+    return logging.Logger.manager.getLogger(name)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def real_logging():
+    """
+    Log through real loggers and handlers whatever other test modules left behind. A MagicMock in
+    place of logging.getLogger breaks the moto server, and a MagicMock systemd gives the uploader a
+    JournalHandler that raises on every record.
+    """
+    logger = get_logger("VideoUploader.test")
+    logger.handlers = [logging.NullHandler()]
+    logger.propagate = False
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(logging, "getLogger", get_logger)
+        monkeypatch.setattr(upload_to_s3, "logger", logger)
+        yield
+
+
+@pytest.fixture(scope="module")
+def endpoint_url():
+    server = moto_server.ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    yield f"http://{host}:{port}"
+    server.stop()
+
+
+@pytest.fixture
+def settings(endpoint_url, tmp_path):
+    class Settings:
+        S3_ACCESS_KEY = "test"
+        S3_SECRET_ACCESS_KEY = "test"
+        S3_ENDPOINT_URL = endpoint_url
+        GYM_UUID = f"test-bucket-{os.getpid()}-{tmp_path.name.lower()}"
+        RECORDING_DIR = str(tmp_path)
+        UPLOAD_CONCURRENCY = 2
+        MULTIPART_THRESHOLD = 6 * MB
+        MULTIPART_CHUNKSIZE = 5 * MB
+
+    return Settings()
+
+
+def write_clip(settings, name, size, mtime):
+    path = os.path.join(settings.RECORDING_DIR, name)
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+async def drain(uploader):
+    async with uploader.create_client() as s3_client:
+        workers = [asyncio.create_task(uploader.upload_worker(s3_client)) for _ in range(uploader.concurrency)]
+        uploader.enqueue_recordings()
+        await asyncio.wait_for(uploader.queue.join(), timeout=60)
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        return await s3_client.list_objects_v2(Bucket=uploader.settings.GYM_UUID)
+
+
+def test_enqueue_orders_newest_first_and_skips_temp_files(settings):
+    uploader = VideoUploader(settings)
+    write_clip(settings, "old.mp4", 10, 100)
+    write_clip(settings, "new.mp4", 10, 300)
+    write_clip(settings, "temp_recording.mp4", 10, 400)
+    write_clip(settings, "new.range.json", 10, 500)
+
+    assert uploader.enqueue_recordings() == 2
+    assert uploader.enqueue_recordings() == 0  # already queued
+    order = [uploader.queue.get_nowait()[1] for _ in range(2)]
+    assert [os.path.basename(path) for path in order] == ["new.mp4", "old.mp4"]
+
+
+def test_backlog_is_uploaded_and_removed(settings):
+    uploader = VideoUploader(settings)
+    for index in range(5):
+        write_clip(settings, f"clip-{index}.mp4", 1024, index)
+    write_range(settings.RECORDING_DIR, "clip-0", 1.5, 6.5)
+
+    listing = asyncio.run(drain(uploader))
+
+    assert sorted(obj["Key"] for obj in listing["Contents"]) == [f"clip-{index}.mp4" for index in range(5)]
+    assert uploader.uploaded_files == 5
+    assert os.listdir(settings.RECORDING_DIR) == []
+
+
+def test_multipart_upload_resumes_from_state(settings):
+    path = write_clip(settings, "large.mp4", 11 * MB, 0)
+    uploader = VideoUploader(settings)
+
+    async def upload_first_part():
+        async with uploader.create_client() as s3_client:
+            await uploader.ensure_bucket_exists(s3_client)
+            response = await s3_client.create_multipart_upload(Bucket=settings.GYM_UUID, Key="large.mp4", Metadata={})
+            with open(path, "rb") as f:
+                part = await s3_client.upload_part(
+                    Bucket=settings.GYM_UUID, Key="large.mp4", UploadId=response["UploadId"], PartNumber=1,
+                    Body=f.read(5 * MB),
+                )
+            return response["UploadId"], part["ETag"]
+
+    upload_id, etag = asyncio.run(upload_first_part())
+    write_upload_state(upload_state_path(path), {
+        "key": "large.mp4", "upload_id": upload_id, "size": 11 * MB, "part_size": 5 * MB,
+        "parts": [{"PartNumber": 1, "ETag": etag}],
+    })
+    assert read_upload_state(upload_state_path(path))["upload_id"] == upload_id
+
+    listing = asyncio.run(drain(uploader))
+
+    assert [(obj["Key"], obj["Size"]) for obj in listing["Contents"]] == [("large.mp4", 11 * MB)]
+    assert os.listdir(settings.RECORDING_DIR) == []
+
+
+def test_upload_loop_raises_when_a_worker_dies(settings, monkeypatch):
+    uploader = VideoUploader(settings)
+
+    async def broken_worker(s3_client):
+        raise TypeError("handler level is not a number")
+
+    monkeypatch.setattr(uploader, "upload_worker", broken_worker)
+
+    with pytest.raises(TypeError):
+        asyncio.run(asyncio.wait_for(uploader.upload_loop(), timeout=30))
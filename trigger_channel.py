@@ -0,0 +1,187 @@
+"""
+Low-latency trigger channel between qr.py and the video recorder on the same device.
+
+qr.py sends the entrance-log uuid as a single datagram over a Unix socket, the recorder answers
+with the same uuid once the recording has started. This replaces the `{uuid}.txt` + `record.txt`
+handoff and the fixed CAMERA_SLEEP_DURATION whenever a recorder is listening locally. The
+mqtt_receiver uses the same socket to hand over triggers of a scanner on another device.
+
+A datagram is ``"{uuid}"`` or ``"{uuid} {scan_time}"``, with the scan time in seconds since the
+epoch so the recorder can log the latency from the scan to the start of the recording.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from uuid import UUID
+
+SOCKET_NAME = "trigger.sock"
+MAX_DATAGRAM_SIZE = 1024
+
+logger = logging.getLogger("trigger_channel")
+
+
+def socket_path(recording_dir):
+    """Path of the trigger socket, TRIGGER_SOCKET overrides the default inside RECORDING_DIR."""
+    return os.getenv("TRIGGER_SOCKET") or os.path.join(recording_dir, SOCKET_NAME)
+
+
+class TriggerListener:
+    """Recorder side of the channel. Must be opened from within a running event loop."""
+
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+        self._queue = None
+        self.scan_times = {}  # uuid -> scan time of the triggers not acknowledged yet
+
+    def open(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)  # stale socket of a previous run
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._sock.bind(self.path)
+        self._queue = asyncio.Queue()
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), self._on_readable)
+        logger.info(f"Listening for triggers on {self.path}")
+
+    def close(self):
+        if self._sock is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        except RuntimeError:
+            pass  # loop already closed
+        self._sock.close()
+        self._sock = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    async def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for triggers.
+
+        Returns:
+            list[tuple[str, object]]: ``(uuid, reply_address)`` of every trigger received so far,
+            empty if none arrived in time.
+        """
+        try:
+            first = await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        triggers = [first]
+        while not self._queue.empty():
+            triggers.append(self._queue.get_nowait())
+        return triggers
+
+    def ack(self, uuid, address):
+        """Tell the sender that recording for `uuid` has started."""
+        scan_time = self.scan_times.pop(uuid, None)
+        if scan_time is not None:
+            logger.info(f"Recording for {uuid} started {(time.time() - scan_time) * 1000:.1f}ms after the scan")
+        if not address or self._sock is None:
+            return
+        try:
+            self._sock.sendto(uuid.encode(), address)
+        except OSError as e:
+            logger.warning(f"Could not acknowledge trigger {uuid}: {e}")
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, address = self._sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            uuid, _, scan_time = data.decode(errors="replace").strip().partition(" ")
+            try:
+                UUID(uuid)
+                scan_time = float(scan_time) if scan_time else None
+            except ValueError:
+                logger.warning(f"Ignoring invalid trigger: {data!r}")
+                continue
+            if scan_time is not None:
+                self.scan_times[uuid] = scan_time
+            self._queue.put_nowait((uuid, address))
+
+
+def encode_trigger(uuid, scan_time=None):
+    return (uuid if scan_time is None else f"{uuid} {scan_time:.6f}").encode()
+
+
+class TriggerSender:
+    """qr.py side of the channel. The socket is created lazily and reused for every scan."""
+
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+        self._oneway_sock = None
+
+    async def send(self, uuid, ack_timeout, scan_time=None):
+        """
+        Send a trigger and wait up to `ack_timeout` seconds for the recorder to acknowledge it.
+
+        Returns:
+            bool: False if no recorder is listening, so the caller can fall back to the file
+            handoff. True once the trigger was delivered, whether or not it was acknowledged in time.
+        """
+        sock = self._get_socket()
+        try:
+            sock.sendto(encode_trigger(uuid, scan_time), self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+        except OSError as e:
+            logger.warning(f"Failed to send trigger {uuid}: {e}")
+            return False
+
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._wait_for_ack(sock, uuid), ack_timeout)
+            logger.info(f"Recorder acknowledged {uuid} after {time.monotonic() - start:.3f}s")
+        except asyncio.TimeoutError:
+            logger.warning(f"Recorder did not acknowledge {uuid} within {ack_timeout}s")
+        return True
+
+    def send_nowait(self, uuid, scan_time=None):
+        """
+        Send a trigger without waiting for the acknowledgement, safe to call from any thread.
+
+        Returns:
+            bool: False if no recorder is listening.
+        """
+        if self._oneway_sock is None:
+            # Unbound, so the recorder has no address to acknowledge to
+            self._oneway_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._oneway_sock.setblocking(False)
+        try:
+            self._oneway_sock.sendto(encode_trigger(uuid, scan_time), self.path)
+        except OSError as e:
+            if not isinstance(e, (FileNotFoundError, ConnectionRefusedError)):
+                logger.warning(f"Failed to send trigger {uuid}: {e}")
+            return False
+        return True
+
+    def close(self):
+        for sock in (self._sock, self._oneway_sock):
+            if sock is not None:
+                sock.close()
+        self._sock = None
+        self._oneway_sock = None
+
+    def _get_socket(self):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+            self._sock.bind("")  # autobind an abstract address so the recorder can reply
+        return self._sock
+
+    @staticmethod
+    async def _wait_for_ack(sock, uuid):
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await loop.sock_recv(sock, MAX_DATAGRAM_SIZE)
+            if data.decode(errors="replace") == uuid:
+                return
+            # late ack of an earlier trigger that already timed out
@@ -0,0 +1,134 @@
+"""
+Wire format of the camera triggers sent over MQTT.
+
+Version 1 is a one-byte version and a one-byte trigger count, followed by 25 bytes per trigger:
+the entrance-log uuid as 16 raw bytes, the scan time as a signed 64-bit count of microseconds
+since the epoch and the entrance direction as one ASCII byte (0 if unknown). All big-endian.
+Version 2 inserts the sender's node id after the count, as a one-byte length and UTF-8 text,
+so receivers can tell the clocks of senders publishing to the same topic apart.
+
+The legacy format is a JSON list ``[uuid, timestamp]`` with one trigger per message. Its first
+byte is always printable, while a binary payload starts with its version byte, so `decode`
+tells them apart without any negotiation and both can be on the broker during a migration.
+"""
+import json
+import struct
+from collections import namedtuple
+from uuid import UUID
+
+VERSION = 1
+VERSION_WITH_NODE = 2
+HEADER = struct.Struct("!BB")  # version, count
+NODE_LENGTH = struct.Struct("!B")
+TRIGGER = struct.Struct("!16sqB")  # uuid, scan time in microseconds, direction
+MAX_BATCH = 255
+
+BINARY = "binary"
+JSON = "json"
+FORMATS = (BINARY, JSON)
+
+# `node` is the node id of the sender, see clock_sync.default_node_id
+Trigger = namedtuple("Trigger", ["uuid", "timestamp", "direction", "node"], defaults=[None, None])
+
+
+def encode(triggers, payload_format=BINARY):
+    """
+    Encode `triggers` into one message.
+
+    Args:
+        triggers (list[Trigger]): Triggers with the uuid as a string and the scan time in seconds.
+            JSON takes exactly one, binary up to `MAX_BATCH`. Binary batches carry the node of
+            the triggers, they all come from the same sender. The legacy JSON format drops it.
+        payload_format (str): One of `FORMATS`.
+
+    Returns:
+        bytes: The payload.
+    """
+    if payload_format == JSON:
+        if len(triggers) != 1:
+            raise ValueError("The JSON format holds exactly one trigger")
+        trigger = triggers[0]
+        return json.dumps([trigger.uuid, trigger.timestamp]).encode()
+    if payload_format != BINARY:
+        raise ValueError(f"Unknown payload format {payload_format!r}, expected one of {list(FORMATS)}")
+    if not 0 < len(triggers) <= MAX_BATCH:
+        raise ValueError(f"A batch holds 1 to {MAX_BATCH} triggers, got {len(triggers)}")
+    node = triggers[0].node
+    if any(trigger.node != node for trigger in triggers):
+        raise ValueError("The triggers of a batch come from one node")
+    if node:
+        node_bytes = node.encode()
+        if len(node_bytes) > 255:
+            raise ValueError(f"The node id takes at most 255 bytes, got {len(node_bytes)}")
+        parts = [HEADER.pack(VERSION_WITH_NODE, len(triggers)), NODE_LENGTH.pack(len(node_bytes)), node_bytes]
+    else:
+        parts = [HEADER.pack(VERSION, len(triggers))]
+    for trigger in triggers:
+        direction = _direction_byte(trigger.direction)
+        parts.append(TRIGGER.pack(UUID(trigger.uuid).bytes, round(trigger.timestamp * 1_000_000), direction))
+    return b"".join(parts)
+
+
+def _direction_byte(direction):
+    if not direction:
+        return 0
+    if len(direction) != 1 or not direction.isascii():
+        raise ValueError(f"The direction must be a single ASCII character, got {direction!r}")
+    return ord(direction)
+
+
+def decode(payload):
+    """
+    Decode a binary or legacy JSON payload.
+
+    Returns:
+        list[Trigger]: The triggers, the timestamp in seconds as a float.
+
+    Raises:
+        ValueError: If the payload is malformed in either format.
+    """
+    if not payload:
+        raise ValueError("Empty payload")
+    if payload[0] in (VERSION, VERSION_WITH_NODE):
+        return _decode_binary(payload)
+    if payload[0] < 0x20 and payload[0] not in b"\t\n\r":
+        raise ValueError(f"Unsupported payload version {payload[0]}")
+    return _decode_json(payload)
+
+
+def _decode_binary(payload):
+    if len(payload) < HEADER.size:
+        raise ValueError("Binary payload without a header")
+    version, count = HEADER.unpack_from(payload)
+    offset, node = HEADER.size, None
+    if version == VERSION_WITH_NODE:
+        if len(payload) < offset + NODE_LENGTH.size:
+            raise ValueError("Binary payload without a node id")
+        (length,) = NODE_LENGTH.unpack_from(payload, offset)
+        offset += NODE_LENGTH.size
+        try:
+            node = payload[offset:offset + length].decode()
+        except UnicodeDecodeError:
+            raise ValueError("Node id is not UTF-8")
+        offset += length
+    if len(payload) != offset + count * TRIGGER.size:
+        raise ValueError(f"Binary payload of {len(payload)} bytes doesn't hold {count} triggers")
+    triggers = []
+    for uuid_bytes, micros, direction in TRIGGER.iter_unpack(payload[offset:]):
+        triggers.append(Trigger(str(UUID(bytes=uuid_bytes)), micros / 1_000_000, chr(direction) if direction else None, node))
+    return triggers
+
+
+def _decode_json(payload):
+    try:
+        message = json.loads(payload)
+    except (UnicodeDecodeError, ValueError):
+        raise ValueError("Neither a binary nor a JSON payload")
+    # Expect payload in the format: [uuid, timestamp]
+    if not (isinstance(message, list) and len(message) == 2 and isinstance(message[0], str)):
+        raise ValueError("JSON payload is not [uuid, timestamp]")
+    uuid, timestamp = message
+    UUID(uuid)  # raises ValueError for an invalid uuid
+    if not isinstance(timestamp, (int, float)):
+        raise ValueError("JSON payload has no numeric timestamp")
+    return [Trigger(uuid, float(timestamp))]
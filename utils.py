@@ -1,22 +1,191 @@
+import base64
+import json
 import logging
 import sys
+import threading
+import time
 
 import requests
 import sentry_sdk
 
 
-def login(hostname, username, password, logger):
-    url = f"{hostname}/api/token/"
-    payload = {"email": username, "password": password}
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(url, headers=headers, json=payload)
+class TokenManager:
+    """
+    Keeps a JWT access token for the backend API fresh.
 
-    if response is None or response.status_code != 200:
-        log_unsuccessful_request(response, logger)
-        return None
+    The token's ``exp`` claim is decoded on every login so the token can be renewed in a
+    background thread ``refresh_margin`` seconds before it expires, but no earlier than half its
+    lifetime. The lifetime is taken from ``iat`` to ``exp`` and counted from when the token was
+    requested, so a device clock that is off, e.g. after booting without an RTC, neither makes
+    the token look expired nor renews it back to back. The refresh token is used for renewal
+    when the backend issued one, falling back to a full login otherwise.
+
+    Renewals talk to the backend without holding the lock that guards the tokens, so callers
+    keep getting the current token while the background thread renews it. Only callers without
+    a valid token wait for the renewal. `get_token` and `refresh` return ``None`` if no valid
+    token could be obtained, never an expired one.
+
+    Args:
+        hostname (str): Base url of the backend, e.g. ``https://example.com``.
+        username (str): Email used to log in.
+        password (str): Password used to log in.
+        logger (logging.Logger): Logger used for reporting failures.
+        post_request (callable, optional): ``post_request(url, headers, payload)`` returning a
+            response or ``None``. Lets callers plug in their own retry behaviour.
+        refresh_margin (int, optional): Seconds before expiry at which to refresh. Defaults to 60.
+    """
+
+    RETRY_INTERVAL = 30  # Seconds to wait before retrying a failed background refresh
+
+    def __init__(self, hostname, username, password, logger, post_request=None, refresh_margin=60):
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.logger = logger
+        self.post_request = post_request or self._post_request
+        self.refresh_margin = refresh_margin
+
+        self._lock = threading.Lock()  # Guards the tokens and the timer
+        self._renew_lock = threading.Lock()  # One renewal at a time
+        self._access_token = None
+        self._refresh_token = None
+        self._expires_at = None
+        self._timer = None
+        self._stopped = False
+
+    def get_token(self):
+        """Return a valid access token, logging in first if there is none or it has expired. None if that failed."""
+        with self._lock:
+            if self._is_valid():
+                return self._access_token
+        return self._renew(force=False)
+
+    def refresh(self):
+        """Force a renewal, e.g. after the backend rejected the current token. None if it failed."""
+        with self._lock:
+            # Rejected, it must not be handed out again even if the renewal fails
+            self._access_token = None
+            self._expires_at = None
+        return self._renew(force=True)
+
+    def auth_header(self):
+        token = self.get_token()
+        return f"Bearer {token}" if token is not None else None
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+    def _is_valid(self):
+        if self._access_token is None:
+            return False
+        return self._expires_at is None or time.time() < self._expires_at
+
+    def _renew(self, force):
+        """Fetch new tokens unless another caller renewed them while we waited. Returns the valid token or None."""
+        with self._renew_lock:
+            with self._lock:
+                if not force and self._is_valid():
+                    return self._access_token
+                refresh_token = self._refresh_token
+
+            requested = time.time()
+            tokens = None
+            if refresh_token:
+                tokens = self._post_token("api/token/refresh/", {"refresh": refresh_token})
+            if tokens is None:
+                tokens = self._post_token("api/token/", {"email": self.username, "password": self.password})
+            access_token = tokens.get("access") if tokens is not None else None
 
-    jwt_token = response.json().get("access", None)
-    return jwt_token
+            with self._lock:
+                if access_token is None:
+                    if tokens is not None:
+                        self.logger.error("Token response without an access token.")
+                    # The current token is served until it expires
+                    self._schedule_refresh(self.RETRY_INTERVAL)
+                    return self._access_token if self._is_valid() else None
+                self._access_token = access_token
+                self._refresh_token = tokens.get("refresh", self._refresh_token)
+                self._expires_at = self._local_expiry(access_token, requested)
+                if self._expires_at is not None:
+                    lifetime = self._expires_at - requested
+                    if lifetime > 0:
+                        renew_at = requested + max(lifetime - self.refresh_margin, lifetime / 2)
+                        self._schedule_refresh(renew_at - time.time())
+                    else:
+                        self._schedule_refresh(self.RETRY_INTERVAL)  # expired on arrival by our clock
+                return access_token
+
+    @staticmethod
+    def _local_expiry(token, requested):
+        """Expiry of `token` in the local clock, None if it has none. Taken as is without an ``iat`` claim."""
+        claims = decode_jwt_claims(token)
+        expires = _number(claims.get("exp"))
+        issued = _number(claims.get("iat"))
+        if expires is None or issued is None:
+            return expires
+        return requested + max(expires - issued, 0)
+
+    def _post_token(self, path, payload):
+        url = f"{self.hostname}/{path}"
+        headers = {"Content-Type": "application/json"}
+        response = self.post_request(url, headers, payload)
+        if response is None or response.status_code != 200:
+            if response is not None:
+                log_unsuccessful_request(response, self.logger)
+            return None
+        return response.json()
+
+    def _post_request(self, url, headers, payload):
+        try:
+            return requests.post(url, headers=headers, json=payload)
+        except requests.exceptions.RequestException as e:
+            self.logger.warning(f"Internet connection error when requesting a token: {e}")
+            return None
+
+    def _schedule_refresh(self, delay):
+        """Called with the lock held."""
+        if self._stopped:
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(delay, 0), self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        try:
+            self._renew(force=True)
+        except Exception as e:
+            self.logger.error(f"Background token refresh failed: {e}")
+            with self._lock:
+                self._schedule_refresh(self.RETRY_INTERVAL)
+
+
+def decode_jwt_claims(token):
+    """Return the payload of a JWT as a dict, empty if it can't be read. The signature is not checked."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+    except (AttributeError, IndexError, ValueError, TypeError):
+        return {}
+    return claims if isinstance(claims, dict) else {}
+
+
+def decode_jwt_expiry(token):
+    """Return the ``exp`` claim of a JWT as a unix timestamp, or ``None`` if it can't be read."""
+    return _number(decode_jwt_claims(token).get("exp"))
+
+
+def _number(value):
+    try:
+        return float(value) if value is not None else None
+    except (ValueError, TypeError):
+        return None
 
 
 def log_unsuccessful_request(response, logger):